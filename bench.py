@@ -0,0 +1,332 @@
+'''
+End-to-end benchmark of the data pipeline on synthetic inputs (see synth.py)
+
+For each scale factor a fresh synthetic data set is generated and every
+stage is run on it in order, each in its own freshly spawned process.
+Per stage the wall time, the peak of python allocations (tracemalloc,
+which includes numpy buffers) and the process max RSS are recorded.
+Stages that fail, e.g. for a missing dependency, are recorded with their
+error and the run carries on. Results go to a JSON file stamped with the
+git revision, so scaling curves can be compared across commits.
+
+Usage:
+    python bench.py [options] workdir
+
+Options:
+    --scales   comma separated scale factors (default 1,2,4)
+    --stages   comma separated stages to run (default all, in order below)
+    --out      results file (default workdir/bench_<rev>.json)
+    --compare  earlier results file to print time ratios against
+    --seed     random seed (default 0)
+    --imports  instead time importing each module of IMPORT_MODULES in a
+               fresh interpreter, and list the heavy stacks each pulls in
+
+Stages: synth ingest nodes veldf velarr snapper snapper_segment
+        covariance mfactor inputset snap2graph train_step
+'''
+import os
+import sys, getopt
+import json
+import time
+import platform
+import resource
+import subprocess
+import traceback
+import tracemalloc
+import multiprocessing as mp
+import runpy
+import numpy as np
+
+import synth
+
+
+# Synthetic data set at scale 1; drivers and roads grow linearly with the scale
+BASE = {"nroads": 10, "ndrivers": 1000, "npts": 40, "tglen": 10}
+VELDF_ROWS = 2000
+
+
+def stage_synth(paths, params):
+    synth.generate(paths["dir"], seed=params["seed"],
+                   **{k: params[k] for k in BASE})
+
+
+def stage_ingest(paths, params):
+    argv = sys.argv
+    sys.argv = ["gen_vels.py", "--source", paths["out0"], "--runpath", paths["dir"]+os.sep,
+                "--runname", "gen_vels", "--tglen", str(params["tglen"])]
+    try:
+        runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "gen_vels.py"),
+                       run_name="__main__")
+    finally:
+        sys.argv = argv
+
+
+def stage_nodes(paths, params):
+    import graphtools as gt
+    region = synth.REGION
+    gt.generate_nodes(paths["hwy"], region=region, mindist=0.5, maxdist=2., maxnbr=8)
+
+
+def stage_veldf(paths, params):
+    # get_veldf is far too slow for whole files, so only its first VELDF_ROWS rows
+    import graphtools as gt
+    nodes, _ = synth.road_graph(synth.make_roads(params["nroads"],
+                                                 rng=np.random.RandomState(params["seed"])))
+    gt.get_veldf(paths["vels"], nodes, nTG=60*24//params["tglen"], nvel=VELDF_ROWS)
+
+
+def stage_velarr(paths, params):
+    import graphtools as gt
+    gt.get_velarr(paths["vels"], nTG=60*24//params["tglen"])
+
+
+def stage_snapper(paths, params):
+    import graphtools as gt
+    # Same roads and velocities synth.generate made, rebuilt and snapped again
+    roads = synth.make_roads(params["nroads"], rng=np.random.RandomState(params["seed"]))
+    nodes, edges = synth.road_graph(roads)
+    vels = gt.get_velarr(paths["vels"], unique=False)
+    synth.write_nn_inputs(paths["nn_inputs"], nodes, edges, vels, 60*24//params["tglen"])
+
+
+def stage_snapper_segment(paths, params):
+    # stage_snapper with map matching onto edges instead of the radius fan-out
+    import graphtools as gt
+    roads = synth.make_roads(params["nroads"], rng=np.random.RandomState(params["seed"]))
+    nodes, edges = synth.road_graph(roads)
+    vels = gt.get_velarr(paths["vels"], unique=False)
+    synth.write_nn_inputs(paths["dir"]+os.sep+"nn_inputs_segment.hdf5", nodes, edges, vels,
+                          60*24//params["tglen"], snapping="segment")
+
+
+def stage_covariance(paths, params):
+    import prep
+    prep.EdgeNodeCovariance(paths["nn_inputs"])
+
+
+def stage_mfactor(paths, params):
+    import prep
+    prep.CalcMFactor(paths["nn_inputs"])
+
+
+def stage_inputset(paths, params):
+    import prep
+    prep.create_nn_inputset(paths["nn_inputs"], seed=params["seed"])
+
+
+def stage_snap2graph(paths, params):
+    import h5py
+    import my_graph_tools as mgt
+    with h5py.File(paths["nn_inputs"], 'r') as h5f:
+        ntg = mgt.file_ntg(h5f)
+        for day in range(7):
+            for tg in range(ntg):
+                mgt.snap2graph(h5f, day, tg)
+
+
+def stage_train_step(paths, params, nstep=10):
+    # nstep optimizer steps on consecutive snapshots, after one warm-up step
+    import h5py
+    import tensorflow as tf
+    import my_graph_tools as mgt
+    with h5py.File(paths["nn_inputs"], 'r') as h5f:
+        ntg = mgt.file_ntg(h5f)
+        input_ph = mgt.snap2graph(h5f, 0, 0, use_tf=True, placeholder=True, name="input")
+        target_ph = mgt.snap2graph(h5f, 0, 1, use_tf=True, placeholder=True, name="target")
+        feeds = [mgt.snap2graph(h5f, 0, tg) for tg in range(min(nstep+2, ntg))]
+    tf.reset_default_graph()
+    _, output = mgt.build_forecast_model(input_ph)
+    loss = tf.losses.mean_squared_error(target_ph.nodes, output.nodes) + \
+        tf.losses.mean_squared_error(target_ph.edges[:,:3], output.edges)
+    step = tf.train.AdamOptimizer(1e-3).minimize(loss)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for i in range(len(feeds)-1):
+            sess.run(step, feed_dict={input_ph: feeds[i], target_ph: feeds[i+1]})
+
+
+STAGES = ["synth", "ingest", "nodes", "veldf", "velarr", "snapper", "snapper_segment",
+          "covariance", "mfactor", "inputset", "snap2graph", "train_step"]
+
+
+def _run_stage(name, paths, params, out_q):
+    # Runs in a spawned process, so max RSS is this stage's alone
+    result = {"stage": name, "status": "ok"}
+    tracemalloc.start()
+    t0 = time.time()
+    try:
+        globals()["stage_"+name](paths, params)
+    except Exception:
+        result["status"] = "error"
+        result["error"] = traceback.format_exception_only(*sys.exc_info()[:2])[-1].splitlines()[0]
+    result["seconds"] = time.time()-t0
+    result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1]/2**20
+    tracemalloc.stop()
+    # ru_maxrss is in kB on linux
+    result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+    out_q.put(result)
+
+
+def run_stage(name, paths, params):
+    ctx = mp.get_context("spawn")
+    out_q = ctx.Queue()
+    proc = ctx.Process(target=_run_stage, args=(name, paths, params, out_q))
+    proc.start()
+    result = out_q.get()
+    proc.join()
+    return result
+
+
+# Modules timed by --imports, and the stacks data-prep imports should avoid
+IMPORT_MODULES = ["dtypes", "snapstore", "prep", "graphtools", "partition", "npmodel",
+                  "my_graph_tools"]
+HEAVY_MODULES = ["tensorflow", "sonnet", "graph_nets", "matplotlib", "networkx",
+                 "sklearn", "progressbar"]
+
+_IMPORT_PROBE = """
+import sys, time, json, resource
+t0 = time.time()
+try:
+    __import__(sys.argv[1])
+    error = ""
+except Exception as err:
+    error = repr(err)
+seconds = time.time()-t0
+# ru_maxrss survives exec, so it would include bench.py's own peak; VmHWM does not
+try:
+    with open("/proc/self/status") as f:
+        peak_kb = [int(l.split()[1]) for l in f if l.startswith("VmHWM")][0]
+except (OSError, IndexError):
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"seconds": seconds, "error": error, "max_rss_mb": peak_kb/2**10,
+                  "heavy": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+
+def import_times(modules=IMPORT_MODULES):
+    # Each import in a fresh interpreter, so nothing is cached from the others
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for module in modules:
+        out = subprocess.run([sys.executable, "-c", _IMPORT_PROBE, module]+HEAVY_MODULES,
+                             cwd=here, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        result = dict(module=module, **json.loads(out.stdout.decode().splitlines()[-1]))
+        results.append(result)
+        print("import", module.ljust(16), "%7.2f s %9.1f MB rss" % (result["seconds"], result["max_rss_mb"]),
+              " ".join(result["heavy"]), result["error"])
+    return results
+
+
+def sizes(paths):
+    # Graph and data set sizes at one scale, for the report
+    import h5py
+    out = {}
+    if os.path.exists(paths["nn_inputs"]):
+        with h5py.File(paths["nn_inputs"], 'r') as h5f:
+            out.update({"n_nodes": int(h5f.attrs["n_nodes"]),
+                        "n_edges": int(h5f.attrs["n_edges"])})
+    if os.path.exists(paths["veldat"]):
+        with h5py.File(paths["veldat"], 'r') as h5f:
+            out["n_vels"] = int(h5f.attrs["nvel"])
+    return out
+
+
+def git_rev():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        rev = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                                      stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                        cwd=here).decode().strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return rev, dirty
+
+
+def new_report():
+    rev, dirty = git_rev()
+    return {"git_rev": rev, "dirty": dirty, "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "base": BASE, "runs": []}
+
+
+def run_bench(workdir, scales=(1, 2, 4), stages=STAGES, seed=0):
+    report = new_report()
+    for scale in scales:
+        params = {"nroads": int(BASE["nroads"]*scale), "ndrivers": int(BASE["ndrivers"]*scale),
+                  "npts": BASE["npts"], "tglen": BASE["tglen"], "seed": seed}
+        sdir = os.path.join(workdir, "scale"+str(scale))
+        os.makedirs(sdir, exist_ok=True)
+        paths = {key: os.path.join(sdir, name) for key, name in
+                 [("hwy", "hwy_pts.csv"), ("out0", "OUT0"), ("vels", "vels"),
+                  ("veldat", "vels.hdf5"), ("nn_inputs", "nn_inputs.hdf5")]}
+        paths["dir"] = sdir
+        for name in [s for s in STAGES if s in stages]:
+            result = run_stage(name, paths, params)
+            result["scale"] = scale
+            report["runs"].append(result)
+            print("scale", scale, name.ljust(12), result["status"].ljust(6),
+                  "%9.2f s %9.1f MB traced %9.1f MB rss" % (
+                      result["seconds"], result["peak_traced_mb"], result["max_rss_mb"]),
+                  result.get("error", ""))
+        report["runs"].append(dict(scale=scale, stage="sizes", **sizes(paths)))
+    return report
+
+
+def compare(report, old):
+    # Time ratio new/old per (scale, stage) that ran ok in both
+    old_t = {(r["scale"], r["stage"]): r["seconds"] for r in old["runs"]
+             if r.get("status") == "ok"}
+    print("vs", old["git_rev"], "(ratio < 1 is faster)")
+    for r in report["runs"]:
+        key = (r["scale"], r["stage"])
+        if r.get("status") == "ok" and old_t.get(key):
+            print("scale", key[0], key[1].ljust(12), "%.2fx" % (r["seconds"]/old_t[key]))
+    old_i = {r["module"]: r["seconds"] for r in old.get("imports", []) if not r["error"]}
+    for r in report.get("imports", []):
+        if not r["error"] and old_i.get(r["module"]):
+            print("import", r["module"].ljust(12), "%.2fx" % (r["seconds"]/old_i[r["module"]]))
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["scales=", "stages=", "out=",
+                                                      "compare=", "seed=", "imports"])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    if len(args) != 1:
+        print(__doc__)
+        sys.exit(2)
+
+    workdir = args[0]
+    scales, stages, outname, oldname, seed = [1, 2, 4], STAGES, None, None, 0
+    imports = False
+    for opt, arg in opts:
+        if opt == "--scales":
+            scales = [float(s) if "." in s else int(s) for s in arg.split(",")]
+        elif opt == "--stages":
+            stages = arg.split(",")
+        elif opt == "--out":
+            outname = arg
+        elif opt == "--compare":
+            oldname = arg
+        elif opt == "--seed":
+            seed = int(arg)
+        elif opt == "--imports":
+            imports = True
+
+    if imports:
+        os.makedirs(workdir, exist_ok=True)
+        report = new_report()
+        report["imports"] = import_times()
+    else:
+        report = run_bench(workdir, scales, stages, seed)
+    outname = outname if outname else os.path.join(workdir, "bench_"+report["git_rev"]+".json")
+    with open(outname, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("Wrote", outname)
+    if oldname:
+        with open(oldname) as f:
+            compare(report, json.load(f))
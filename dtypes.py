@@ -0,0 +1,127 @@
+'''
+Dtype policy for features, counts, day/tg values and graph indices, on
+disk and in memory
+
+    float64  float64 everywhere; the default, and what existing files
+             and checkpoints were made with
+    compact  float32 features, int16 day/tg, int32 indices
+
+Set the policy with the GRAPHNN_DTYPES environment variable or with
+set_policy before loading or writing anything. Writers store datasets in
+the policy's dtypes, and readers cast whatever is on disk to them, so a
+float64 file can be read compactly and vice versa. Car counts are
+columns of the feature arrays, so they take the feature dtype (float32
+holds integers exactly up to 2**24), and veldat positions in float32
+resolve to about a metre. Models take the
+dtype of their inputs, so a float64 checkpoint needs the float64 policy.
+
+Check a file against the float64 baseline with
+
+    python dtypes.py --validate [--policy compact] inputfname
+
+which defaults to the GRAPHNN_DTYPES policy
+'''
+import os
+import sys, getopt
+import numpy as np
+
+
+POLICIES = {
+    "float64": {"feature": np.float64, "daytime": np.float64, "index": np.int64},
+    "compact": {"feature": np.float32, "daytime": np.int16, "index": np.int32},
+}
+
+_policy = {}
+
+
+def set_policy(name):
+    if name not in POLICIES:
+        raise ValueError("Unknown dtype policy "+name+", use one of "+", ".join(POLICIES))
+    _policy.clear()
+    _policy.update({kind: np.dtype(dt) for kind, dt in POLICIES[name].items()})
+    _policy["name"] = name
+
+
+def policy_name():
+    return _policy["name"]
+
+
+def dtype(kind):
+    # "feature", "daytime" or "index"
+    return _policy[kind]
+
+
+def cast(kind, arr):
+    # arr in the policy dtype of kind, without copying if it already is
+    arr = np.asarray(arr)
+    if _policy[kind].kind in "iu" and arr.size:
+        info = np.iinfo(_policy[kind])
+        if arr.min() < info.min or arr.max() > info.max:
+            raise OverflowError(kind+" values out of range for "+str(_policy[kind]))
+    return arr.astype(_policy[kind], copy=False)
+
+
+set_policy(os.environ.get("GRAPHNN_DTYPES", "float64"))
+
+
+def _max_errors(base, test):
+    # Max abs error, and that relative to the largest baseline value
+    if not np.size(base):
+        return 0., 0.
+    err = np.abs(np.asarray(test, dtype=np.float64) - base).max()
+    return err, err/max(np.abs(base).max(), 1e-300)
+
+
+def validate(h5_name, name=None):
+    '''
+    Compares the normalized snapshots SnapshotStore serves under the
+    current policy (or policy name) with the float64 baseline, plus norm
+    stats recomputed from each. Returns {check: (max abs err, max rel err)}
+    '''
+    from snapstore import SnapshotStore
+    from prep import block_stats, stats_to_norm
+
+    current = policy_name()
+    results = {}
+    try:
+        set_policy("float64")
+        base = SnapshotStore(h5_name)
+        set_policy(name if name else current)
+        test = SnapshotStore(h5_name)
+        for kind in ("nodes", "edges", "globals"):
+            a, b = getattr(base, kind), getattr(test, kind)
+            results[kind] = _max_errors(a, b)
+            results[kind+" stats"] = _max_errors(
+                stats_to_norm(block_stats(a.reshape(-1, a.shape[-1]))),
+                stats_to_norm(block_stats(b.reshape(-1, b.shape[-1]).astype(np.float64))))
+        results["senders"] = _max_errors(base.senders, test.senders)
+        results["receivers"] = _max_errors(base.receivers, test.receivers)
+        results["memory MB"] = (sum(getattr(base, k).nbytes for k in ("nodes", "edges", "globals"))/2**20,
+                                sum(getattr(test, k).nbytes for k in ("nodes", "edges", "globals"))/2**20)
+    finally:
+        set_policy(current)
+    return results
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["validate", "policy="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    opts = dict(opts)
+    if "--validate" not in opts or len(args) != 1:
+        print(__doc__)
+        sys.exit(2)
+
+    # Run as a script this is __main__, while snapstore and prep read the
+    # policy of the imported dtypes module, so validate through that one
+    import dtypes
+    name = opts.get("--policy", dtypes.policy_name())
+    print(name, "against float64")
+    for check, (a, b) in dtypes.validate(args[0], name).items():
+        if check == "memory MB":
+            print(check.ljust(16), "%.1f -> %.1f" % (a, b))
+        else:
+            print(check.ljust(16), "max abs %.3e  max rel %.3e" % (a, b))
@@ -0,0 +1,153 @@
+'''
+Score the predictions written by infer.py against their labels
+
+Row day*NTG + tg of pred_node_features / pred_edge_features forecasts the
+following time group, so its label is the next snapshot's nn features,
+wrapping into the next day and from the last day back to the first as
+in loader.label_daytime. Labels are read in physical units: raw input
+files as they are, files normalized in place through their stats.
+
+Absolute, squared and absolute percentage errors are summed over blocks
+of snapshots as whole-array reductions, once over snapshots (per node
+or edge) and once over nodes or edges (per snapshot). The per snapshot
+sums are keyed by the time group forecast and folded into time of day
+and day of week tables. Percentage errors skip labels with
+|label| <= floor, e.g. empty cells with zero speed.
+
+Each of nodes/ and edges/ in the output gets (..., F, 3) tables of
+[MAE, RMSE, MAPE %] per feature F:
+
+    overall  (F, 3)
+    by_elem  (n, F, 3)     per node or edge
+    by_tg    (NTG, F, 3)   per time of day
+    by_day   (7, F, 3)     per day of week
+
+Usage:
+    python evaluate.py [options] predfname [inputfname]
+
+inputfname defaults to the source infer.py recorded in predfname
+
+Options:
+    --out     write the tables here (default: group "evaluation" of predfname)
+    --block   snapshots per block (default 32)
+    --floor   smallest |label| scored by MAPE (default 1e-6)
+'''
+import sys, getopt
+import time
+import numpy as np
+import h5py
+
+from snapstore import Normalizer, is_raw, open_snapshots
+
+
+METRICS = ("mae", "rmse", "mape")
+
+
+def error_sums(pred, label, floor=1e-6):
+    # (4, B, n, F) [|err|, err^2, |err|/|label|, scored by MAPE] of a block
+    err = pred.astype(np.float64) - label
+    scored = np.abs(label) > floor
+    ape = np.divide(np.abs(err), np.abs(label), out=np.zeros_like(err), where=scored)
+    return np.stack([np.abs(err), err*err, ape, scored])
+
+
+def metrics(sums, count):
+    # (..., F, 3) [MAE, RMSE, MAPE %] from (4, ..., F) error sums over count entries each
+    abs_sum, sq_sum, ape_sum, n_scored = sums
+    mape = np.divide(100.*ape_sum, n_scored, out=np.full_like(ape_sum, np.nan), where=n_scored > 0)
+    return np.stack([abs_sum/count, np.sqrt(sq_sum/count), mape], axis=-1)
+
+
+class ErrorTables(object):
+    '''
+    Running error sums of one feature set (nodes or edges) of shape
+    (nsnap, n, F), added a block of snapshots at a time
+    '''
+    def __init__(self, nsnap, n, nft, ntg):
+        self.nsnap, self.n, self.ntg = nsnap, n, ntg
+        self.by_elem = np.zeros((4, n, nft))
+        self.by_snap = np.zeros((4, nsnap, nft))
+
+    def add(self, lo, pred, label, floor=1e-6):
+        sums = error_sums(pred, label, floor)
+        self.by_elem += sums.sum(axis=1)
+        self.by_snap[:, lo:lo+len(pred)] = sums.sum(axis=2)
+
+    def tables(self):
+        # Row i forecasts snapshot i+1, so shift the per snapshot sums onto the forecast time
+        target = np.roll(self.by_snap, 1, axis=1).reshape(4, 7, self.ntg, -1)
+        return {"overall": metrics(self.by_elem.sum(axis=1), self.nsnap*self.n),
+                "by_elem": metrics(self.by_elem, self.nsnap),
+                "by_tg": metrics(target.sum(axis=1), 7*self.n),
+                "by_day": metrics(target.sum(axis=2), self.ntg*self.n)}
+
+
+def evaluate(predfname, inputfname=None, block=32, floor=1e-6):
+    '''
+    Returns {"nodes": tables, "edges": tables}, tables as ErrorTables.tables
+    '''
+    with h5py.File(predfname, 'r') as h5p:
+        inputfname = inputfname if inputfname else h5p.attrs["source"]
+        with h5py.File(inputfname, 'r') as h5f:
+            ntg = int(h5p.attrs["nTG"])
+            normalizer = None if is_raw(h5f) else Normalizer.from_h5(h5f)
+            out = {}
+            for kind, pname, lname in (("nodes", "pred_node_features", "nn_node_features"),
+                                       ("edges", "pred_edge_features", "nn_edge_features")):
+                preds = h5p[pname]
+                nsnap, n, nft = preds.shape
+                labels = open_snapshots(h5f, lname, ntg)
+                errs = ErrorTables(nsnap, n, nft, ntg)
+                for lo in range(0, nsnap, block):
+                    pred = preds[lo:min(lo+block, nsnap)]
+                    label = np.stack([labels[(i+1)%nsnap][:, :nft] for i in range(lo, lo+len(pred))])
+                    label = label.astype(np.float64)
+                    if normalizer:
+                        normalizer.unnorm(kind, label, out=label)
+                    errs.add(lo, pred, label, floor)
+                out[kind] = errs.tables()
+    return out
+
+
+def save_tables(h5f, results, name="evaluation"):
+    if name in h5f:
+        del h5f[name]
+    grp = h5f.create_group(name)
+    grp.attrs["metrics"] = ",".join(METRICS)
+    for kind, tables in results.items():
+        kgrp = grp.create_group(kind)
+        for key, table in tables.items():
+            kgrp.create_dataset(key, data=table.astype(np.float32))
+
+
+def print_tables(results):
+    # Overall and day of week tables, one row per feature or day
+    for kind, tables in results.items():
+        print(kind.ljust(6), "".join(m.upper().rjust(10) for m in METRICS))
+        for f, row in enumerate(tables["overall"]):
+            print(("ft"+str(f)).ljust(6), "".join(("%.4g" % x).rjust(10) for x in row))
+        print("day".ljust(6), "  (mean over features)")
+        for day, row in enumerate(tables["by_day"].mean(axis=1)):
+            print(str(day).ljust(6), "".join(("%.4g" % x).rjust(10) for x in row))
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["out=", "block=", "floor="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    if len(args) not in (1, 2):
+        print(__doc__)
+        sys.exit(2)
+    opts = dict(opts)
+
+    t0 = time.time()
+    results = evaluate(*args, block=int(opts.get("--block", 32)),
+                       floor=float(opts.get("--floor", 1e-6)))
+    outfname = opts.get("--out", args[0])
+    with h5py.File(outfname, 'a') as h5f:
+        save_tables(h5f, results)
+    print_tables(results)
+    print("Evaluated in", round(time.time()-t0, 2), "s, tables saved to", outfname)
@@ -4,9 +4,13 @@ import os
 import sys, getopt
 from datetime import date
 import time
+import queue
+import threading
 import numpy as np
 import h5py
 
+import dtypes
+
 global_start = time.time()
 
 long2km = 1/0.011741652782473
@@ -21,7 +25,68 @@ def get_row(df,i):
     day, tg = int(df['day'][i]), int(df['timegroup'][i])
     return [t,x,y,ID,day,tg]
 
-def add(h5dset, f5, df, tcutoff, minvel, silent=True):
+class AsyncVelWriter(object):
+    '''
+    Appends finished velocity blocks to the veldat dataset from a
+    background thread, so parsing carries on while blocks are written
+
+    put() hands a block over through a queue of at most maxqueue blocks
+    and only blocks (a stall) when the writer is that far behind. The
+    dataset grows geometrically, by growth times its size, rather than
+    by an exact resize per block, and is trimmed to the rows written and
+    nvel set on close(). Blocks must not be modified after put().
+    '''
+    def __init__(self, f5, h5dset, maxqueue=2, growth=2.):
+        self.f5, self.h5dset = f5, h5dset
+        self.nvel = int(f5.attrs["nvel"])
+        self.growth = growth
+        self.q = queue.Queue(maxqueue)
+        self.error = None
+        self.stats = {"blocks": 0, "stall": 0., "write": 0., "max_depth": 0, "resizes": 0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            block = self.q.get()
+            if block is None:
+                return
+            if self.error:
+                continue
+            try:
+                t0 = time.time()
+                n = len(block)
+                if self.nvel + n > self.h5dset.shape[0]:
+                    size = max(self.nvel + n, int(self.h5dset.shape[0]*self.growth))
+                    self.h5dset.resize((size, 7))
+                    self.stats["resizes"] += 1
+                self.h5dset[self.nvel:self.nvel+n] = block
+                self.nvel += n
+                self.stats["write"] += time.time() - t0
+            except Exception as err:
+                # Raised again in the parsing thread, by put or close
+                self.error = err
+
+    def put(self, block):
+        if self.error:
+            raise self.error
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.q.qsize())
+        t0 = time.time()
+        self.q.put(block)
+        self.stats["stall"] += time.time() - t0
+        self.stats["blocks"] += 1
+
+    def close(self):
+        self.q.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+        self.h5dset.resize((self.nvel, 7))
+        self.f5.attrs["nvel"] = self.nvel
+        return self.stats
+
+
+def add(writer, df, tcutoff, minvel, silent=True):
     '''
     Function for dumping dataframe to file
     df is a pandas DataFrame and should be
@@ -40,7 +105,7 @@ def add(h5dset, f5, df, tcutoff, minvel, silent=True):
     t0, x0, y0, ID0, day0, tg0 = get_row(df,0)
     i=0
 
-    nparr = np.empty((N,7),dtype=np.float)
+    nparr = np.empty((N,7),dtype=np.float64)
 
     iadd = 0
     while (i<N-2):
@@ -79,11 +144,8 @@ def add(h5dset, f5, df, tcutoff, minvel, silent=True):
         # Second pt is new ref point
         t0, x0, y0, ID0, day0, tg0 = t1, x1, y1, ID1, day1, tg1
 
-    # Add to hdf5
-    Nold = f5.attrs["nvel"]
-    h5dset.resize((Nold+iadd, 7))
-    h5dset[Nold:Nold+iadd] = nparr[:iadd]
-    f5.attrs["nvel"] = Nold+iadd
+    # Written to hdf5 in the background; nparr is new each call so it can be handed over
+    writer.put(nparr[:iadd])
 
     N = iadd
     if not silent:
@@ -100,10 +162,11 @@ velmin = 0.0
 runname = ""
 runpath = "/scratch/walterms/traffic/graphnn/veldata/"
 tglen = 10
+sourcename = "/home/walterms/traffic/OUT0_FiveRing150buffer"
 
 try:
-    opts, args = getopt.getopt(arglist,"t:v:l:",["tcutoff=","velmin=",\
-        "runpath=","runname=","tglen="])
+    opts, args = getopt.getopt(arglist,"t:v:l:s:",["tcutoff=","velmin=",\
+        "runpath=","runname=","tglen=","source="])
 except:
     stdout("Error in opt retrival...")
     sys.exit(2)
@@ -124,6 +187,9 @@ for opt, arg in opts:
     elif opt in ("--tglen", "-l"):
         tglen = int(arg)
         print("tglen "+str(tglen))
+    elif opt in ("--source", "-s"):
+        sourcename = arg
+        print("source "+str(sourcename))
 
 # Fifth ring
 xmin = 116.1904 * long2km
@@ -137,8 +203,6 @@ xmax = 116.44826879600 * long2km
 ymin = 39.85573366870 * lat2km
 ymax = 39.96366920310 * lat2km
 
-sourcename = "/home/walterms/traffic/OUT0_FiveRing150buffer"
-
 nTG = 60*24//tglen
 
 finfo = open(runpath+runname+".info",'w')
@@ -167,7 +231,9 @@ f5.attrs.update({"nvel": 0,
                  "nTG": nTG,
                  "source": sourcename
                 })
-h5dset = f5.create_dataset("veldat", (1,7), maxshape=(None,7), dtype=np.float)
+h5dset = f5.create_dataset("veldat", (0,7), maxshape=(None,7), chunks=(16384,7),
+                           dtype=dtypes.dtype("feature"))
+writer = AsyncVelWriter(f5, h5dset)
 
 buffersize = int(1e5)
 rawdata = np.empty(shape=[buffersize,6])
@@ -232,7 +298,7 @@ for d in fsource.readlines():
             df = pd.DataFrame(data=rawdata, columns=['ID','x','y','timeU70','timegroup','day'])
             t4 = time.time()
             stdout("Adding rawdata...")
-            cnt_success += add(h5dset,f5,df,tcutoff,velmin,silent=True)
+            cnt_success += add(writer,df,tcutoff,velmin,silent=True)
             t5 =time.time()
             stdout(str(t5-t4)+" seconds")
             df = None
@@ -251,10 +317,14 @@ if cnt_i != 0:
     rawdata = rawdata[:cnt_i]
     rawdata = rawdata[np.lexsort(rawdata.T)]
     df = pd.DataFrame(data=rawdata, columns=['ID','x','y','timeU70','timegroup','day'])
-    cnt_success += add(h5dset,f5,df,tcutoff,velmin,silent=True)
+    cnt_success += add(writer,df,tcutoff,velmin,silent=True)
     df = None   
     rawdata = None
+wstats = writer.close()
 stdout("Done")
+stdout("Writer: "+str(wstats["blocks"])+" blocks, "+str(wstats["resizes"])+" resizes, "
+       +"%.2f s writing, %.2f s parsing stalled on the writer, max queue depth %d"
+       % (wstats["write"], wstats["stall"], wstats["max_depth"]))
 
 f5.close()
 
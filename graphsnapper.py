@@ -1,5 +1,26 @@
+'''
+Per-snapshot node and edge features from a velocity file, saved as .npy
+under nn_inputs/
+
+Usage:
+    python graphsnapper.py [--snapping radius|segment]
+
+--snapping chooses how velocities are assigned to the graph:
+    radius   every node within 1 km; the default, and what existing
+             nn_inputs, norm stats and checkpoints were made with
+    segment  map-match onto the nearest road segment; node counts come
+             from its nearer end only and incoming edges from the reverse
+             twin, so its features are not comparable with radius ones.
+             Also saves the matches and p10/p50/p90 speed percentiles,
+             per snapshot and over the week (*_percentiles_week)
+The mode is saved as nn_inputs/snapping.npy, to be carried into the
+nn_inputs file as its "snapping" attr (see synth.write_nn_inputs)
+'''
+import sys, getopt
 import numpy as np
 import graphtools as gt
+import sketches
+import dtypes
 from importlib import reload
 import pandas as pd
 
@@ -23,10 +44,32 @@ n_nodes, n_edges = len(nodes.index), len(edges.index)
 print("Number of nodes", n_nodes)
 print("Number of edges", n_edges)
 
-# 5000 pts takes about 30 seconds
-vdf = gt.get_veldf(vfname,nodedf=nodes,days=[],nTG=info["nTG"])
-vdf.drop_duplicates(inplace=True)
-print(len(vdf.index))
+# "radius" assigns each velocity to every node within 1 km,
+# "segment" map-matches it onto its nearest road segment
+snapping = dict(getopt.getopt(sys.argv[1:], "", ["snapping="])[0]).get("--snapping", "radius")
+if snapping not in gt.SNAPPING_MODES:
+    raise ValueError("Unknown snapping "+snapping+", use one of "+", ".join(gt.SNAPPING_MODES))
+print("Snapping", snapping)
+
+# Velocities are kept once each, grouped by snapshot
+vels = gt.get_velarr(vfname, nTG=info["nTG"])
+offsets = gt.snap_offsets(vels, info["nTG"])
+if snapping == "segment":
+    matcher = gt.SegmentMatcher(nodes, edges)
+    edge_ids, ts, dists, headings = matcher.match(vels, maxdist=1.0)
+    print(len(vels), "velocities,", (edge_ids >= 0).sum(), "matched to a segment")
+    # Speed histograms per node and per edge direction, refilled each snapshot
+    node_hist = sketches.SpeedHistogram(n_nodes)
+    edge_hist = sketches.SpeedHistogram(2*n_edges)
+    # and their sum over the week
+    node_week = sketches.SpeedHistogram(n_nodes)
+    edge_week = sketches.SpeedHistogram(2*n_edges)
+else:
+    # Their assignment to every node within 1 km is a sparse matrix built once
+    A = gt.vel_node_matrix(vels, nodes, within=1.0)
+    S = gt.sender_matrix(edges, n_nodes)
+    edge_angles = edges["angle"].to_numpy(dtype=np.float64)
+    print(len(vels), "velocities,", A.nnz, "velocity-node assignments")
 
 # five files
 node_fname = "nn_inputs/node_features"
@@ -34,69 +77,39 @@ edge_fname = "nn_inputs/edge_features"
 send_fname = "nn_inputs/senders"
 receive_fname = "nn_inputs/receivers"
 glbl_fname = "nn_inputs/glbls"
-
-nodes["ncar"] = 0
-nodes["v_avg"] = 0.
-nodes["v_std"] = 0.
-
-edges["ncar_out"] = 0
-edges["ncar_in"] = 0
-edges["v_avg_out"] = 0.
-edges["v_avg_in"] = 0.
-edges["v_std_out"] = 0.
-edges["v_std_in"] = 0.
+snapping_fname = "nn_inputs/snapping"
+match_fname = "nn_inputs/vel_segments"
+node_pctl_fname = "nn_inputs/node_percentiles"
+edge_pctl_fname = "nn_inputs/edge_percentiles"
 
 nsnap = 7*info["nTG"]
-node_feat_arr = np.zeros(shape=(nsnap, n_nodes, 3), dtype=np.float)
-edge_feat_arr = np.zeros(shape=(nsnap, n_edges, 6), dtype=np.float)
-send_arr = edges[["sender"]].to_numpy(dtype=np.float).reshape((n_edges))
-rece_arr = edges[["receiver"]].to_numpy(dtype=np.float).reshape((n_edges))
-glbl_arr = np.zeros(shape=(nsnap,2), dtype=np.float)
+# Stored in the dtypes.py policy: features, graph indices and day/tg
+node_feat_arr = np.zeros(shape=(nsnap, n_nodes, 3), dtype=dtypes.dtype("feature"))
+edge_feat_arr = np.zeros(shape=(nsnap, n_edges, 6), dtype=dtypes.dtype("feature"))
+send_arr = dtypes.cast("index", edges["sender"].to_numpy(dtype=np.int64))
+rece_arr = dtypes.cast("index", edges["receiver"].to_numpy(dtype=np.int64))
+glbl_arr = np.zeros(shape=(nsnap,2), dtype=dtypes.dtype("daytime"))
+if snapping == "segment":
+    # p10, p50, p90 speeds per node, and per edge outgoing then incoming
+    node_pctl_arr = np.zeros(shape=(nsnap, n_nodes, 3), dtype=dtypes.dtype("feature"))
+    edge_pctl_arr = np.zeros(shape=(nsnap, n_edges, 6), dtype=dtypes.dtype("feature"))
 
-i_edge = 0
 for day in range(7):
     for tg in range(info["nTG"]):
-# for day in [0]:
-#     for tg in [1]:
-        # Get velstats for this day, tg
-        vdf_ = vdf[(vdf['day']==day) & (vdf['tg']==tg)]
-        for idx, node in nodes.iterrows():
-            # Give this subset of vels, calc stats for each node
-            vels = vdf_[vdf_['nodeID'] == idx]
-            nodes.at[idx,'ncar'] = len(vels.index)
-            if len(vels.index) == 0:
-                continue
-            nodes.at[idx,'v_avg'] = vels.mean(axis=0)['v']
-            if len(vels.index) > 1:
-                nodes.at[idx,'v_std'] = vels.std(axis=0)['v']
-        
-            # Iterate over this nodes edges, adding vel stats as necessary
-            edges_ = edges[edges["sender"] == idx]
-            for eidx, e in edges_.iterrows():
-                v_out, v_in = [], []
-                for iv, v in vels.iterrows():
-                    dtheta = v['angle'] - e['angle']
-                    if (abs(dtheta) < 0.25*np.pi) | (abs(dtheta) > 1.75*np.pi):
-                        v_out.append(v['v'])
-                    if (abs(dtheta) > np.pi*0.75) & (abs(dtheta) < np.pi*1.25):
-                        v_in.append(v['v'])
-                
-                if len(v_out) > 0:
-                    edges.at[eidx, "ncar_out"] = len(v_out)
-                    v_avg_out, v_std_out = np.mean(v_out), np.std(v_out)
-                    edges.at[eidx, "v_avg_out"] = v_avg_out
-                    edges.at[eidx, "v_std_out"] = v_std_out
-                if len(v_in) > 0:
-                    edges.at[eidx, "ncar_in"] = len(v_in)
-                    v_avg_in, v_std_in = np.mean(v_in), np.std(v_in)
-                    edges.at[eidx, "v_avg_in"] = v_avg_in
-                    edges.at[eidx, "v_std_in"] = v_std_in
-                    
-        # Add to arrays
+        # Stats for this day, tg come from its block of velocity rows
         isnap = (day*info["nTG"]) + tg
-        node_feat_arr[isnap] = nodes[["ncar","v_avg","v_std"]].to_numpy()
-        edge_feat_arr[isnap] = edges[["ncar_out","v_avg_out","v_std_out",
-                                      "ncar_in","v_avg_in","v_std_in"]].to_numpy()
+        lo, hi = offsets[isnap], offsets[isnap+1]
+        if snapping == "segment":
+            node_feat_arr[isnap], edge_feat_arr[isnap] = gt.matched_snapshot_stats(
+                matcher, edge_ids[lo:hi], ts[lo:hi], headings[lo:hi], vels[lo:hi])
+            node_pctl_arr[isnap], edge_pctl_arr[isnap] = gt.matched_snapshot_percentiles(
+                matcher, edge_ids[lo:hi], ts[lo:hi], headings[lo:hi], vels[lo:hi],
+                node_hist, edge_hist)
+            node_week.merge(node_hist)
+            edge_week.merge(edge_hist)
+        else:
+            node_feat_arr[isnap], edge_feat_arr[isnap] = \
+                gt.snapshot_stats(A[lo:hi], S, vels[lo:hi], edge_angles)
         glbl_arr[isnap] = np.array([day,tg])
         
     print("Done writing day",day)
@@ -109,6 +122,23 @@ print("Saving",send_fname)
 np.save(send_fname, send_arr)
 print("Saving",receive_fname)
 np.save(receive_fname, rece_arr)
+print("Saving",snapping_fname)
+np.save(snapping_fname, np.array(snapping))
+if snapping == "segment":
+    # One row per velocity: matched edge (-1 for none), t along it, distance, heading agreement
+    print("Saving",match_fname)
+    np.save(match_fname, np.stack([edge_ids, ts, dists, headings], axis=1))
+    print("Saving",node_pctl_fname)
+    np.save(node_pctl_fname, node_pctl_arr)
+    print("Saving",edge_pctl_fname)
+    np.save(edge_pctl_fname, edge_pctl_arr)
+    edge_q = edge_week.quantiles()
+    print("Saving",node_pctl_fname+"_week")
+    np.save(node_pctl_fname+"_week", dtypes.cast("feature", node_week.quantiles()))
+    print("Saving",edge_pctl_fname+"_week")
+    np.save(edge_pctl_fname+"_week", dtypes.cast(
+        "feature", np.concatenate([edge_q[:n_edges], edge_q[n_edges:]], axis=1)))
+    del node_pctl_arr, edge_pctl_arr
 
 # Clear memory
 del node_feat_arr, edge_feat_arr, send_arr, rece_arr
@@ -1,11 +1,18 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.patches import Circle, Rectangle
 import csv
 import pandas as pd
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
+
+import profiling
 
 long2km = 1/0.011741652782473
 lat2km = 1/0.008994627867046
+# OUT0 timeU70 stamps are UTC ms; Beijing local time is UTC+8
+TZ_MS = 8*3600*1000
+# How velocities are assigned to the graph: every node within a radius
+# (vel_node_matrix, radius_cells) or one road segment (SegmentMatcher)
+SNAPPING_MODES = ("radius", "segment")
 # Fifth ring
 # xmin = 116.1904 * long2km
 # xmax = 116.583642 * long2km
@@ -42,11 +49,11 @@ def nodes_nearby(p, nodes_df, within):
     return nodes_return, d2n_return
 
 def node_coords_np(nodedict):
-    return np.array([node["coords"] for node in nodedict.values()],dtype=np.float)
+    return np.array([node["coords"] for node in nodedict.values()],dtype=np.float64)
 
 def get_edge_angle(nodedf,i,j):
     dr = np.array(nodedf.at[j,"coords_km"]) - np.array(nodedf.at[i,"coords_km"])
-    z = np.complex(dr[0], dr[1])
+    z = complex(dr[0], dr[1])
     return np.angle(z)   
     
     
@@ -60,7 +67,10 @@ def get_veldf(fname, nodedf, days=[], tgs=[], nTG=None, nvel=None):
             return
         tgs = np.arange(nTG)
     vfile = open(fname,'r')
-    vdf = pd.DataFrame(columns=["day","tg","x_km","y_km","vx","vy","v","nodeID","dist2node","angle"])
+    columns = ["day","tg","x_km","y_km","vx","vy","v","nodeID","dist2node","angle"]
+    # Rows are collected as dicts and made into the frame once at the end
+    # (DataFrame.append is gone from pandas 2), which keeps their dtypes
+    rows = []
     vi = 0
     for v in vfile.readlines():
         w = v.split()
@@ -68,9 +78,6 @@ def get_veldf(fname, nodedf, days=[], tgs=[], nTG=None, nvel=None):
         tg = int(w[1])
         if day not in days: continue
         if tg not in tgs: continue
-        # Apparently appending a list of dict
-        # preserves the datatype
-        # See: https://stackoverflow.com/questions/21281463/appending-to-a-dataframe-converts-dtypes
         x_km, y_km = float(w[2]), float(w[3])
         nbrnodes, d2ns = nodes_nearby([x_km, y_km], nodedf, within=1.0)
         if len(nbrnodes) == 0:
@@ -80,12 +87,12 @@ def get_veldf(fname, nodedf, days=[], tgs=[], nTG=None, nvel=None):
         
         # Get vel angle in [-pi,pi] format
         vx, vy = float(w[4]), float(w[5])
-        z = np.complex(vx,vy)
+        z = complex(vx,vy)
         angle = np.angle(z)
 
         # Iterate over neighbours and add to vdf
         for inbr in range(len(nbrnodes)):
-            vdf = vdf.append([{
+            rows.append({
                 "day": day,
                 "tg": tg,
                 "x_km": x_km,
@@ -96,16 +103,246 @@ def get_veldf(fname, nodedf, days=[], tgs=[], nTG=None, nvel=None):
                 "nodeID": nbrnodes[inbr],
                 "dist2node": d2ns[inbr],
                 "angle": angle
-            }], ignore_index=True)
+            })
 
             vi+=1
             if nvel and vi >= nvel: break
         if nvel and vi >= nvel: break
     vfile.close()
+    vdf = pd.DataFrame(rows, columns=columns)
     
     return vdf
 
 
+def get_velarr(fname, days=[], tgs=[], nTG=None, unique=True):
+    # Load a velocity file (d tg x y vx vy v per line) into an (nvel,7) array.
+    # With unique=True identical rows are dropped (what vdf.drop_duplicates did)
+    # and the rows come back sorted by day then tg, so every snapshot is
+    # a contiguous block; see snap_offsets
+    vels = np.loadtxt(fname, dtype=np.float64, ndmin=2)
+    if len(days) > 0:
+        vels = vels[np.isin(vels[:,0], days)]
+    if len(tgs) > 0:
+        vels = vels[np.isin(vels[:,1], tgs)]
+    if unique:
+        vels = np.unique(vels, axis=0)
+    else:
+        vels = vels[np.lexsort((vels[:,1], vels[:,0]))]
+    return vels
+
+
+def snap_offsets(vels, nTG):
+    # Row offsets of each (day,tg) block in a get_velarr array
+    # Snapshot isnap = day*nTG + tg spans rows offsets[isnap]:offsets[isnap+1]
+    isnap = vels[:,0].astype(np.int64)*nTG + vels[:,1].astype(np.int64)
+    return np.searchsorted(isnap, np.arange(7*nTG+1))
+
+
+def vel_node_matrix(vels, nodedf, within=1.0):
+    # Sparse (nvel, nnode) CSR matrix with a 1 wherever a velocity lies
+    # within "within" km of a node. This is the same assignment get_veldf
+    # makes, but each velocity is stored once instead of once per node
+    node_xy = np.asarray(nodedf['coords_km'].tolist(), dtype=np.float64)
+    pairs = cKDTree(vels[:,2:4]).sparse_distance_matrix(
+        cKDTree(node_xy), within, output_type='ndarray')
+    pairs = pairs[pairs['v'] < within]
+    A = sp.csr_matrix((np.ones(len(pairs)), (pairs['i'], pairs['j'])),
+                      shape=(len(vels), len(node_xy)))
+    A.sort_indices()
+    return A
+
+
+def sender_matrix(edgedf, n_nodes):
+    # Sparse (nnode, nedge) incidence with a 1 at (sender, edge)
+    senders = edgedf['sender'].to_numpy(dtype=np.int64)
+    n_edges = len(senders)
+    return sp.csr_matrix((np.ones(n_edges), (senders, np.arange(n_edges))),
+                         shape=(n_nodes, n_edges))
+
+
+def radius_cells(A, S, vels, edge_angles):
+    # Which velocities count towards which node, and which edge as outgoing
+    # or incoming, as (rows, cells) pairs for the radius fan-out (see matched_cells)
+    # A is the vel_node_matrix row block and vels the matching rows,
+    # S is the sender_matrix and edge_angles the edge angles in [-pi,pi]
+    A = A.tocoo()
+    # Every (velocity, edge) pair whose velocity is assigned to the edge's sender
+    P = (A.tocsr() @ S).tocoo()
+    iv, ie = P.row, P.col
+    dtheta = np.abs(np.angle(vels[iv,4] + 1j*vels[iv,5]) - edge_angles[ie])
+    outgoing = (dtheta < 0.25*np.pi) | (dtheta > 1.75*np.pi)
+    incoming = (dtheta > 0.75*np.pi) & (dtheta < 1.25*np.pi)
+    return (A.row, A.col), (iv[outgoing], ie[outgoing]), (iv[incoming], ie[incoming])
+
+
+def cell_sums(cells, vels, n_nodes, n_edges):
+    # Count, sum and sum of squares of the speeds assigned to each node,
+    # outgoing edge and incoming edge, (n, 3) each, from radius_cells or
+    # matched_cells. Sums of blocks of velocities add up, so a snapshot can
+    # be built incrementally (see stream.py)
+    v = vels[:,6]
+    return [np.stack([np.bincount(c, minlength=n).astype(np.float64),
+                      np.bincount(c, weights=v[rows], minlength=n),
+                      np.bincount(c, weights=v[rows]*v[rows], minlength=n)], axis=1)
+            for (rows, c), n in zip(cells, (n_nodes, n_edges, n_edges))]
+
+
+def _sums_to_stats(sums, ddof):
+    # (count, mean, std) columns from cell_sums
+    cnt, m1, m2 = sums[:,0], sums[:,1], sums[:,2]
+    out = np.zeros(sums.shape, dtype=np.float64)
+    out[:,0] = cnt
+    has = cnt > 0
+    out[has,1] = m1[has] / cnt[has]
+    many = cnt > ddof
+    var = (m2[many] - cnt[many]*out[many,1]**2) / (cnt[many] - ddof)
+    out[many,2] = np.sqrt(np.maximum(var, 0.))
+    return out
+
+
+def cell_stats(node_sums, out_sums, in_sums):
+    # Node features (ncar, v_avg, v_std) and edge features (ncar_out, v_avg_out,
+    # v_std_out, ncar_in, v_avg_in, v_std_in) from cell_sums. Nodes take the
+    # sample std the pandas loop version used, edges the population std of np.std
+    return _sums_to_stats(node_sums, 1), \
+        np.concatenate([_sums_to_stats(out_sums, 0), _sums_to_stats(in_sums, 0)], axis=1)
+
+
+def snapshot_stats(A, S, vels, edge_angles):
+    # Node and edge features for one snapshot, see radius_cells and cell_stats
+    n_nodes, n_edges = S.shape
+    return cell_stats(*cell_sums(radius_cells(A, S, vels, edge_angles), vels, n_nodes, n_edges))
+
+
+def reverse_edges(senders, receivers):
+    # Index of each edge's reverse twin (receiver -> sender), or -1 if there is none
+    n = max(senders.max(), receivers.max()) + 1 if len(senders) else 0
+    keys = senders*n + receivers
+    order = np.argsort(keys)
+    pos = np.searchsorted(keys[order], receivers*n + senders)
+    pos = np.minimum(pos, len(keys)-1)
+    found = keys[order[pos]] == receivers*n + senders
+    return np.where(found, order[pos], -1)
+
+
+class SegmentMatcher(object):
+    '''
+    Map matching of velocities onto the road segments (edges) of a graph
+
+    Each velocity goes to the one edge that minimizes its distance to the
+    segment plus heading_penalty*(1-cos)/2, cos being the agreement of its
+    heading with the edge direction. The penalty picks between the two
+    directions of a two-way road and otherwise barely moves the match.
+    Candidate edges come from a cKDTree over points every spacing km
+    along each segment, starting from the ncand closest and doubling
+    until no edge outside the candidates can score better, so the match
+    is exact.
+
+    matcher = SegmentMatcher(nodes, edges)
+    edge_ids, t, dist, heading = matcher.match(vels)
+    '''
+    def __init__(self, nodedf, edgedf, spacing=0.1, ncand=8, heading_penalty=0.05):
+        xy = np.asarray(nodedf['coords_km'].tolist(), dtype=np.float64)
+        self.senders = edgedf['sender'].to_numpy(dtype=np.int64)
+        self.receivers = edgedf['receiver'].to_numpy(dtype=np.int64)
+        self.n_nodes, self.n_edges = len(xy), len(self.senders)
+        self.p0 = xy[self.senders]
+        self.seg = xy[self.receivers] - self.p0
+        self.len2 = np.maximum(np.square(self.seg).sum(axis=1), 1e-12)
+        self.angle = np.arctan2(self.seg[:,1], self.seg[:,0])
+        self.reverse = reverse_edges(self.senders, self.receivers)
+        self.ncand = ncand
+        self.spacing = spacing
+        self.heading_penalty = heading_penalty
+
+        nsamp = np.ceil(np.sqrt(self.len2)/spacing).astype(np.int64) + 1
+        self.sample_edge = np.repeat(np.arange(self.n_edges), nsamp)
+        starts = np.cumsum(nsamp) - nsamp
+        frac = (np.arange(nsamp.sum()) - np.repeat(starts, nsamp)) / np.repeat(np.maximum(nsamp-1, 1), nsamp)
+        self.tree = cKDTree(self.p0[self.sample_edge] + frac[:,None]*self.seg[self.sample_edge])
+
+    def _best(self, v, k):
+        # Best of the edges of the k samples nearest each velocity, and
+        # whether a closer-scoring edge could lie beyond those k samples
+        xy = v[:,2:4]
+        sdist, cand = self.tree.query(xy, k=k)
+        sdist, cand = sdist.reshape(len(v), k), cand.reshape(len(v), k)
+        ce = self.sample_edge[cand]
+        rel = xy[:,None,:] - self.p0[ce]
+        ct = np.clip(np.einsum('ijk,ijk->ij', rel, self.seg[ce]) / self.len2[ce], 0., 1.)
+        cdist = np.linalg.norm(rel - ct[...,None]*self.seg[ce], axis=2)
+        moving = (v[:,4] != 0) | (v[:,5] != 0)
+        chead = np.where(moving[:,None],
+                         np.cos(np.arctan2(v[:,5], v[:,4])[:,None] - self.angle[ce]), 0.)
+        score = cdist + self.heading_penalty*(1.-chead)/2.
+        best = np.argmin(score, axis=1)
+        rows = np.arange(len(v))
+        # Any edge scoring below the best has a sample within spacing/2 of its closest point
+        unsure = (sdist[:,-1] < score[rows,best] + self.spacing/2.) & (k < self.tree.n)
+        return ce[rows,best], ct[rows,best], cdist[rows,best], chead[rows,best], unsure
+
+    def match(self, vels, maxdist=1.0, chunk=2**18):
+        '''
+        vels as get_velarr returns them. Per velocity returns the matched
+        edge (-1 if none within maxdist km), the projection parameter t in
+        [0,1] from sender to receiver, the distance in km to the segment
+        and the heading agreement cos(velocity angle - edge angle), 0 for
+        velocities without a direction
+        '''
+        nvel = len(vels)
+        edge_ids = np.full(nvel, -1, dtype=np.int64)
+        t, dist, heading = np.zeros(nvel), np.full(nvel, np.inf), np.zeros(nvel)
+        for lo in range(0, nvel, chunk):
+            idx = np.arange(lo, min(lo+chunk, nvel))
+            k = min(self.ncand, self.tree.n)
+            # Velocities whose best match isn't certain yet are redone with twice the candidates
+            while len(idx):
+                e, ct, cd, ch, unsure = self._best(vels[idx], k)
+                edge_ids[idx], t[idx], dist[idx], heading[idx] = e, ct, cd, ch
+                idx, k = idx[unsure], min(2*k, self.tree.n)
+        edge_ids[dist > maxdist] = -1
+        return edge_ids, t, dist, heading
+
+
+def matched_cells(matcher, edge_ids, t, heading):
+    # Which velocities count towards which node, and which edge as outgoing
+    # or incoming, as (rows, cells) pairs; rows index the velocities
+    # A velocity counts towards the nearer end node of its segment, and
+    # towards its edge as outgoing when it heads along the edge (within
+    # pi/4) or incoming when it heads against it. Going along an edge is
+    # going against its reverse twin, so it is incoming there as well
+    rows = np.flatnonzero(edge_ids >= 0)
+    e = edge_ids[rows]
+    nodes = np.where(t[rows] < 0.5, matcher.senders[e], matcher.receivers[e])
+    along = heading[rows] > np.cos(0.25*np.pi)
+    against = heading[rows] < -np.cos(0.25*np.pi)
+    twin = matcher.reverse[e]
+    into = along & (twin >= 0)
+    return ((rows, nodes), (rows[along], e[along]),
+            (np.concatenate([rows[against], rows[into]]), np.concatenate([e[against], twin[into]])))
+
+
+def matched_snapshot_stats(matcher, edge_ids, t, heading, vels):
+    # snapshot_stats for map-matched velocities, same feature layout
+    cells = matched_cells(matcher, edge_ids, t, heading)
+    return cell_stats(*cell_sums(cells, vels, matcher.n_nodes, matcher.n_edges))
+
+
+def matched_snapshot_percentiles(matcher, edge_ids, t, heading, vels, node_hist, edge_hist):
+    # Speed percentiles (sketches.PERCENTILES) for map-matched velocities,
+    # per node (n_nodes,3) and per edge, outgoing then incoming (n_edges,6)
+    # node_hist (n_nodes cells) and edge_hist (2*n_edges cells, outgoing
+    # first) are sketches.SpeedHistogram; they are cleared and refilled
+    (rn, nodes), (ro, e_out), (ri, e_in) = matched_cells(matcher, edge_ids, t, heading)
+    v = vels[:,6]
+    node_hist.clear()
+    edge_hist.clear()
+    node_hist.add(nodes, v[rn])
+    edge_hist.add(np.concatenate([e_out, matcher.n_edges + e_in]), np.concatenate([v[ro], v[ri]]))
+    edge_q = edge_hist.quantiles()
+    return node_hist.quantiles(), np.concatenate([edge_q[:matcher.n_edges], edge_q[matcher.n_edges:]], axis=1)
+
+
 def generate_nodes(fname="./hwy_pts.csv", 
                    mindist=0.05, 
                    region=None, 
@@ -155,16 +392,17 @@ def generate_nodes(fname="./hwy_pts.csv",
         df.at[key,'nbrs'] = list(newnbrs)
 
     # Generate edges
-    edges = pd.DataFrame(columns=["sender","receiver","angle"])
+    edgerows = []
     for key,node in df.iterrows():
         for nbr in node['nbrs']:
             # Get theta in [-pi,pi] radians
             theta = get_edge_angle(df,key,nbr)
-            edges = edges.append([{
+            edgerows.append({
                 "sender": key, 
                 "receiver": nbr, 
                 "angle": theta
-            }], ignore_index=True)
+            })
+    edges = pd.DataFrame(edgerows, columns=["sender","receiver","angle"])
 
     return df, edges
 
@@ -247,7 +485,7 @@ class graphplot:
             for ei in eidxs:
                 if ei in idxlist: new_eidxs.append(ei)
             self.edges.update({idx:list(new_eidxs)})
-        self.npnodes = np.array([node[self.coordunits] for node in self.nodes.values()],dtype=np.float)
+        self.npnodes = np.array([node[self.coordunits] for node in self.nodes.values()],dtype=np.float64)
         self.nnodes = len(self.npnodes)
         self.xlims = [np.min(self.npnodes[:,0]),np.max(self.npnodes[:,0])]
         self.ylims = [np.min(self.npnodes[:,1]),np.max(self.npnodes[:,1])]
@@ -269,6 +507,7 @@ class graphplot:
             if self.noderadius > 0.01: self.noderadius = 0.01
         
         if not axis or not figure:
+            import matplotlib.pyplot as plt
             self.fig, self.ax = plt.subplots(1,1,figsize=(9,9) if not figsize else figsize)
         else:
             self.fig, self.ax = figure, axis
@@ -285,6 +524,7 @@ class graphplot:
             self.plotnode(self.ax,node[0], node[1])            
         
     def plotnode(self,ax,x,y):
+        from matplotlib.patches import Circle
         circ = Circle((x,y),self.noderadius,color="b",alpha=0.8)
         ax.add_patch(circ)        
         
@@ -308,6 +548,9 @@ class viewer(graphplot):
     '''
     def __init__(self, nodes_obj, window=None, figsize=None, idxlist=[], usekm=False):
         # window are the [xmin,xmax,ymin,ymax] dimensions of the viewer
+        # matplotlib is only imported for plotting, so node building stays light
+        import matplotlib.pyplot as plt
+        from matplotlib.patches import Rectangle
         
         self.coordunits = "coords"
         if usekm: self.coordunits = "coords_km"
@@ -356,9 +599,17 @@ class viewer(graphplot):
         self.axs[1].set_xticks([])
         self.axs[1].set_yticks([])
         self.press = None
+        self.overlay = None
         
         self.updateinset()
         
+    def set_overlay(self, query, days=range(7), tgs=None):
+        # Draw the velocities of a velquery.VelQuery inside the window on the
+        # inset, coloured by speed, re-queried whenever the window moves
+        # query=None removes the overlay
+        self.overlay = None if query is None else (query, days, tgs)
+        self.updateinset()
+        
     def updateinset(self):
         # Remove any artists if present
         self.axs[1].clear()
@@ -377,6 +628,14 @@ class viewer(graphplot):
                         nbr = self.nodes[e][self.coordunits]
                         self.plotLine(self.axs[1],x,y,nbr[0],nbr[1])
 
+        if self.overlay:
+            query, days, tgs = self.overlay
+            # The store is in km, the window in degrees unless usekm
+            sx, sy = (1., 1.) if self.coordunits == "coords_km" else (long2km, lat2km)
+            vels = query.query((xmin*sx, xmax*sx, ymin*sy, ymax*sy), days, tgs)
+            self.axs[1].scatter(vels[:,2]/sx, vels[:,3]/sy, c=vels[:,6], s=2, cmap="viridis_r",
+                                vmin=0., vmax=60., zorder=3)
+
         self.axs[1].set_ylim(ymin,ymax)
         self.axs[1].set_xlim(xmin,xmax)
         #self.axs[1].set_aspect('equal', adjustable='box',anchor="NE")
@@ -455,3 +714,7 @@ def get_info_dict(fname, type="vel"):
       
     finfo.close()
     return info
+
+
+# Opt-in timing, hdf5 I/O and memory hooks on the functions above, see profiling.py
+profiling.instrument(globals())
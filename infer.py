@@ -0,0 +1,156 @@
+'''
+Run a trained EncodeProcessDecode checkpoint over every snapshot of an
+nn_inputs file and store the unnormalized predictions
+
+The checkpoint is restored once and the 7*NTG input snapshots are
+streamed through the model in batches. Predictions are written to
+outfname as stacked datasets pred_node_features (7*NTG, N, Fn) and
+pred_edge_features (7*NTG, E, Fe), where row day*NTG + tg holds the
+forecast made from (day, tg), i.e. for the following time group.
+
+Usage:
+    python infer.py [options] inputfname ckptpath outfname
+
+Options:
+    --batch      snapshots per batch (default 32)
+    --steps      message passing steps (default 3)
+    --name       model scope used in training (default output)
+    --node-out   predicted node features (default 4)
+    --edge-out   predicted edge features (default 3)
+    --concat     batch by concatenating graphs instead of sharing topology
+    --export     also save the weights for npmodel.py to this .npz and check
+                 its predictions against TF on the first batch
+'''
+import sys, getopt
+import time
+import numpy as np
+import h5py
+import tensorflow as tf
+from graph_nets import utils_np
+from graph_nets import utils_tf
+
+import my_graph_tools as mgt
+from npmodel import NumpyForecaster
+from snapstore import SnapshotStore, Normalizer
+import dtypes
+
+
+def predict_batches(sess, store, input_ph, output_graph, daytimes, batch_size, shared=True):
+    # Yields (snapshot indices, normalized node preds, edge preds, seconds in sess.run)
+    n_node, n_edge = store.n_node[0], store.n_edge[0]
+    for i in range(0, len(daytimes), batch_size):
+        batch = daytimes[i:i+batch_size]
+        if shared:
+            feed = mgt.shared_feed_dict(input_ph, store.shared_batch(batch))
+        else:
+            graphs = utils_np.data_dicts_to_graphs_tuple(
+                [store.data_dict(day, tg) for day, tg in batch])
+            feed = utils_tf.get_feed_dict(input_ph, graphs)
+        t0 = time.time()
+        nodes, edges = sess.run([output_graph.nodes, output_graph.edges], feed_dict=feed)
+        dt = time.time()-t0
+        idx = [store.index(day, tg) for day, tg in batch]
+        yield (idx, nodes.reshape(len(batch), n_node, -1),
+               edges.reshape(len(batch), n_edge, -1), dt)
+
+
+def check_numpy_export(sess, store, input_ph, output_graph, daytimes, npz_name,
+                       num_processing_steps, shared=True):
+    # Max abs difference between the TF and npmodel predictions on one batch
+    _, nodes, edges, _ = next(predict_batches(sess, store, input_ph, output_graph,
+                                                daytimes, len(daytimes), shared))
+    np_model = NumpyForecaster(npz_name, store.senders, store.receivers, store.n_node[0])
+    batch = store.shared_batch(daytimes)
+    np_nodes, np_edges = np_model(batch.nodes, batch.edges, batch.globals,
+                                  num_processing_steps)[-1]
+    return max(np.abs(np_nodes-nodes).max(), np.abs(np_edges-edges).max())
+
+
+def run_inference(inputfname, ckptpath, outfname, batch_size=32, num_processing_steps=3,
+                  name="output", node_output_size=4, edge_output_size=3, shared=True,
+                  export=None):
+    store = SnapshotStore(inputfname, normalize=True)
+    with h5py.File(inputfname, 'r') as h5f:
+        normalizer = Normalizer.from_h5(h5f)
+    daytimes = [(day, tg) for day in range(7) for tg in range(store.ntg)]
+
+    tf.reset_default_graph()
+    if shared:
+        input_ph = mgt.shared_placeholders(store.shared_batch(daytimes[:1]), name="input")
+    else:
+        input_ph = utils_tf.placeholders_from_data_dicts(
+            [store.data_dict(0, 0)], force_dynamic_num_graphs=True, name="input")
+    model, output_graph = mgt.build_forecast_model(
+        input_ph, num_processing_steps, node_output_size, edge_output_size,
+        shared_topology=shared, name=name)
+    saver = tf.train.Saver(var_list=mgt.forecast_variables(model))
+
+    latencies = []
+    t_start = time.time()
+    with h5py.File(outfname, 'w') as h5out, tf.Session() as sess:
+        saver.restore(sess, ckptpath)
+        if export:
+            mgt.export_numpy_weights(sess, model, export)
+            err = check_numpy_export(sess, store, input_ph, output_graph, daytimes[:batch_size],
+                                     export, num_processing_steps, shared)
+            print("Exported weights to", export, "- max abs difference from TF", err)
+        h5out.attrs.update({"nTG": store.ntg, "source": inputfname, "ckpt": ckptpath})
+        pred_nodes = h5out.create_dataset(
+            "pred_node_features", dtype=dtypes.dtype("feature"), compression="lzf",
+            shape=(store.nsnap, store.n_node[0], node_output_size),
+            chunks=(1, store.n_node[0], node_output_size))
+        pred_edges = h5out.create_dataset(
+            "pred_edge_features", dtype=dtypes.dtype("feature"), compression="lzf",
+            shape=(store.nsnap, store.n_edge[0], edge_output_size),
+            chunks=(1, store.n_edge[0], edge_output_size))
+        for idx, nodes, edges, dt in predict_batches(sess, store, input_ph, output_graph,
+                                                     daytimes, batch_size, shared):
+            latencies.append(dt)
+            # Batches run in snapshot order, so each is one contiguous slab
+            if len(idx) != idx[-1]-idx[0]+1:
+                raise ValueError("Batch snapshots "+str(idx)+" are not contiguous")
+            pred_nodes[idx[0]:idx[-1]+1] = normalizer.unnorm("nodes", nodes, out=nodes)
+            pred_edges[idx[0]:idx[-1]+1] = normalizer.unnorm("edges", edges, out=edges)
+    total = time.time()-t_start
+    store.close()
+
+    latencies = np.array(latencies)
+    print("Predicted", len(daytimes), "snapshots in", round(total, 2), "s,",
+          round(len(daytimes)/total, 1), "snapshots/s")
+    print("Batch latency ms: mean %.1f, p50 %.1f, p95 %.1f, max %.1f" %
+          tuple(1e3*np.array([latencies.mean(), np.percentile(latencies, 50),
+                              np.percentile(latencies, 95), latencies.max()])))
+    return latencies
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["batch=", "steps=", "name=",
+                                                      "node-out=", "edge-out=", "concat",
+                                                      "export="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    if len(args) != 3:
+        print(__doc__)
+        sys.exit(2)
+
+    kwargs = {}
+    for opt, arg in opts:
+        if opt == "--batch":
+            kwargs["batch_size"] = int(arg)
+        elif opt == "--steps":
+            kwargs["num_processing_steps"] = int(arg)
+        elif opt == "--name":
+            kwargs["name"] = arg
+        elif opt == "--node-out":
+            kwargs["node_output_size"] = int(arg)
+        elif opt == "--edge-out":
+            kwargs["edge_output_size"] = int(arg)
+        elif opt == "--concat":
+            kwargs["shared"] = False
+        elif opt == "--export":
+            kwargs["export"] = arg
+
+    run_inference(*args, **kwargs)
@@ -0,0 +1,145 @@
+import multiprocessing as mp
+import queue
+import threading
+import traceback
+import numpy as np
+import h5py
+from graph_nets import utils_np
+from graph_nets import utils_tf
+
+from snapstore import read_snapdict, is_raw, Normalizer
+
+
+def label_daytime(day, tg, ntg):
+    # The label of snapshot (day,tg) is the next time group
+    lbltg = (tg+1)%ntg
+    lblday = (day+1)%7 if (lbltg==0) else day
+    return lblday, lbltg
+
+
+def _worker(h5_name, ntg, normalize, index_q, out_q):
+    # h5py handles can't be shared across processes, so each worker opens its own
+    try:
+        with h5py.File(h5_name, 'r') as h5f:
+            static = (h5f['senders'][:], h5f['receivers'][:],
+                      Normalizer.from_h5(h5f) if is_raw(h5f) else None)
+            while True:
+                daytimes = index_q.get()
+                if daytimes is None:
+                    break
+                inps, lbls = [], []
+                for day, tg in daytimes:
+                    lblday, lbltg = label_daytime(day, tg, ntg)
+                    inps.append(read_snapdict(h5f, day, tg, ntg, normalize, *static))
+                    lbls.append(read_snapdict(h5f, lblday, lbltg, ntg, normalize, *static))
+                out_q.put((utils_np.data_dicts_to_graphs_tuple(inps),
+                           utils_np.data_dicts_to_graphs_tuple(lbls),
+                           daytimes))
+    except Exception:
+        out_q.put(("error", traceback.format_exc(), None))
+
+
+class SnapshotLoader(object):
+    '''
+    Shuffled, prefetching batches of (input, label) snapshots
+
+    The get_daytimes() pairs are reshuffled every epoch and cut into
+    batches of batch_size. nworkers background processes, each with
+    its own hdf5 handle, decode the batches and concatenate them into
+    batched GraphsTuples. At most prefetch batches wait in the queue.
+    The label of (day,tg) is the following time group.
+
+    loader = SnapshotLoader(inputfname, batch_size=8)
+    input_ph, lbl_ph = loader.placeholders()
+    for i, (inputs, lbls, daytimes) in zip(range(nstep), loader):
+        sess.run(..., feed_dict={input_ph: inputs, lbl_ph: lbls})
+    loader.close()
+    '''
+    def __init__(self, h5_name, batch_size=1, nworkers=2, prefetch=4,
+                 normalize=True, shuffle=True, seed=None, ntg=None):
+        with h5py.File(h5_name, 'r') as h5f:
+            self.ntg = int(ntg if ntg else h5f.attrs['nTG'])
+            self.sample = read_snapdict(h5f, 0, 0, self.ntg, normalize)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.daytimes = np.array([[d,tg] for d in range(7) for tg in range(self.ntg)], dtype=int)
+        self.epoch = 0
+
+        ctx = mp.get_context()
+        self._index_q = ctx.Queue(maxsize=2*nworkers)
+        self._out_q = ctx.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._workers = [ctx.Process(target=_worker, daemon=True,
+                                     args=(h5_name, self.ntg, normalize,
+                                           self._index_q, self._out_q))
+                         for _ in range(nworkers)]
+        for w in self._workers:
+            w.start()
+        # Feeds index batches to the workers, blocking once they're far enough ahead
+        self._feeder = threading.Thread(target=self._feed, daemon=True)
+        self._feeder.start()
+
+    def __len__(self):
+        # Batches per epoch
+        return -(-len(self.daytimes)//self.batch_size)
+
+    def _feed(self):
+        while not self._stop.is_set():
+            if self.shuffle:
+                self.rng.shuffle(self.daytimes)
+            for i in range(0, len(self.daytimes), self.batch_size):
+                batch = [(int(d), int(tg)) for d, tg in self.daytimes[i:i+self.batch_size]]
+                while not self._stop.is_set():
+                    try:
+                        self._index_q.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self._stop.is_set():
+                    return
+            self.epoch += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        inputs, lbls, daytimes = self._out_q.get()
+        if isinstance(inputs, str):
+            self.close()
+            raise RuntimeError("SnapshotLoader worker failed:\n"+lbls)
+        return inputs, lbls, daytimes
+
+    def placeholders(self, name="loader"):
+        # Input and label placeholders that accept any number of graphs per batch
+        ph = lambda n: utils_tf.placeholders_from_data_dicts(
+            [self.sample], force_dynamic_num_graphs=True, name=name+"_"+n)
+        return ph("input"), ph("label")
+
+    def close(self):
+        self._stop.set()
+        self._feeder.join()
+        # Drain so workers blocked on a full queue can see their sentinel
+        for w in self._workers:
+            while w.is_alive():
+                try:
+                    self._index_q.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    try:
+                        self._out_q.get_nowait()
+                    except queue.Empty:
+                        pass
+        for w in self._workers:
+            while w.is_alive():
+                try:
+                    self._out_q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            w.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -9,15 +9,18 @@ from graph_nets import utils_np
 from graph_nets import utils_tf
 
 import my_graph_tools as mgt
-import matplotlib.pyplot as plt
-import networkx as nx
+from snapstore import SnapshotStore, read_snapdict
+# The data-prep functions live in prep.py, which loads without TF and plotting
+from prep import (DTG, NTG, file_ntg, EdgeNodeCovariance, replace_dataset,
+                  edge_node_covariance, CalcMFactor, m_factor, nn_features, create_nn_inputset,
+                  glbl_norm_stats, save_norm_stats, mynorm, my_unnorm, get_daytimes,
+                  block_stats, merge_stats, stats_to_norm, get_norm_stats)
+import profiling
+import dtypes
 import numpy as np
 import sonnet as snt
 import tensorflow as tf
 import h5py
-from progressbar import progressbar
-from sklearn.preprocessing import normalize
-import matplotlib.pyplot as plt
 
 pi = np.pi
 twopi = np.pi*2
@@ -26,8 +29,6 @@ twopi = np.pi*2
 # Defaults for below were 2 and 16
 NUM_LAYERS = 2  # Hard-code number of layers in the edge/node/global models.
 LATENT_SIZE = 16  # Hard-code latent layer sizes for demos.
-DTG = 0.5
-NTG = int(60*24/DTG)
 
 def make_mlp_model(Lsize=LATENT_SIZE,Nlayer=NUM_LAYERS):
   """Instantiates a new MLP, followed by LayerNorm.
@@ -71,11 +72,19 @@ class MLPGraphIndependent(snt.AbstractModule):
 
 
 class MLPGraphNetwork(snt.AbstractModule):
-  """GraphNetwork with MLP edge, node, and global models."""
+  """GraphNetwork with MLP edge, node, and global models.
 
-  def __init__(self, name="MLPGraphNetwork"):
+  With shared_topology=True the inputs are shared-topology batches
+  (see SharedGraphNetwork). Variable names are the same in both modes.
+  """
+
+  def __init__(self, shared_topology=False, name="MLPGraphNetwork"):
     super(MLPGraphNetwork, self).__init__(name=name)
     with self._enter_variable_scope():
+      if shared_topology:
+        self._network = SharedGraphNetwork(make_mlp_model, make_mlp_model,
+                                           make_mlp_model)
+      else:
         self._network = \
             modules.GraphNetwork(make_mlp_model, make_mlp_model,
                 make_mlp_model,
@@ -86,11 +95,150 @@ class MLPGraphNetwork(snt.AbstractModule):
     return self._network(inputs)
 
 
+# Shared-topology batches
+#
+# Every snapshot has the same senders/receivers, so a batch of B snapshots
+# can be one GraphsTuple whose nodes are (B, N, F), edges (B, E, F) and
+# globals (B, G), with a single (E,) senders/receivers and n_node=[N],
+# n_edge=[E]. Message passing is then one gather and one segment sum over
+# the snapshot axis, rather than over B offset copies of the index arrays.
+
+def batch_apply(module, x):
+  """Applies a (rows, F) module to a (B, n, F) tensor."""
+  shape = tf.shape(x)
+  out = module(tf.reshape(x, [-1, x.shape[-1].value]))
+  return tf.reshape(out, tf.concat([shape[:-1], [out.shape[-1].value]], 0))
+
+
+def flatten_shared(graph):
+  """(B, n, F) nodes and edges to (B*n, F), for feature-wise modules."""
+  return graph.replace(
+      nodes=tf.reshape(graph.nodes, [-1, graph.nodes.shape[-1].value]),
+      edges=tf.reshape(graph.edges, [-1, graph.edges.shape[-1].value]))
+
+
+def unflatten_shared(graph, like):
+  """Inverse of flatten_shared, with the (B, n) dims of graph `like`."""
+  def unflatten(x, ref):
+    return tf.reshape(x, tf.concat([tf.shape(ref)[:-1], [x.shape[-1].value]], 0))
+  return graph.replace(nodes=unflatten(graph.nodes, like.nodes),
+                       edges=unflatten(graph.edges, like.edges))
+
+
+def apply_shared(module, graph):
+  """Runs a GraphIndependent-style module on a shared-topology batch."""
+  return unflatten_shared(module(flatten_shared(graph)), graph)
+
+
+def concat_shared(graphs):
+  """utils_tf.concat(graphs, axis=1) for shared-topology batches."""
+  return graphs[0].replace(
+      nodes=tf.concat([g.nodes for g in graphs], axis=-1),
+      edges=tf.concat([g.edges for g in graphs], axis=-1),
+      globals=tf.concat([g.globals for g in graphs], axis=-1))
+
+
+class SharedEdgeBlock(snt.AbstractModule):
+  """blocks.EdgeBlock (all inputs) over a shared-topology batch."""
+
+  def __init__(self, edge_model_fn, name="edge_block"):
+    super(SharedEdgeBlock, self).__init__(name=name)
+    with self._enter_variable_scope():
+      self._edge_model = edge_model_fn()
+
+  def _build(self, graph):
+    n_edge = tf.shape(graph.edges)[1]
+    # Same feature order as EdgeBlock: edges, receivers, senders, globals
+    collected = tf.concat([
+        graph.edges,
+        tf.gather(graph.nodes, graph.receivers, axis=1),
+        tf.gather(graph.nodes, graph.senders, axis=1),
+        tf.tile(tf.expand_dims(graph.globals, 1), [1, n_edge, 1])], axis=-1)
+    return graph.replace(edges=batch_apply(self._edge_model, collected))
+
+
+class SharedNodeBlock(snt.AbstractModule):
+  """blocks.NodeBlock (received edges, nodes, globals) over a shared-topology batch."""
+
+  def __init__(self, node_model_fn, name="node_block"):
+    super(SharedNodeBlock, self).__init__(name=name)
+    with self._enter_variable_scope():
+      self._node_model = node_model_fn()
+
+  def _build(self, graph):
+    n_node = tf.shape(graph.nodes)[1]
+    # Sum received edges per node with the edge axis leading, as segment ops need
+    received = tf.transpose(tf.math.unsorted_segment_sum(
+        tf.transpose(graph.edges, [1, 0, 2]), graph.receivers, n_node), [1, 0, 2])
+    collected = tf.concat([
+        received,
+        graph.nodes,
+        tf.tile(tf.expand_dims(graph.globals, 1), [1, n_node, 1])], axis=-1)
+    return graph.replace(nodes=batch_apply(self._node_model, collected))
+
+
+class SharedGlobalBlock(snt.AbstractModule):
+  """blocks.GlobalBlock with use_edges=use_nodes=False; globals are (B, G)."""
+
+  def __init__(self, global_model_fn, name="global_block"):
+    super(SharedGlobalBlock, self).__init__(name=name)
+    with self._enter_variable_scope():
+      self._global_model = global_model_fn()
+
+  def _build(self, graph):
+    return graph.replace(globals=self._global_model(graph.globals))
+
+
+class SharedGraphNetwork(snt.AbstractModule):
+  """modules.GraphNetwork, as MLPGraphNetwork configures it, for shared-topology batches.
+
+  Blocks and scopes are named as in modules.GraphNetwork so checkpoints
+  carry over between the two.
+  """
+
+  def __init__(self, edge_model_fn, node_model_fn, global_model_fn,
+               name="graph_network"):
+    super(SharedGraphNetwork, self).__init__(name=name)
+    with self._enter_variable_scope():
+      self._edge_block = SharedEdgeBlock(edge_model_fn)
+      self._node_block = SharedNodeBlock(node_model_fn)
+      self._global_block = SharedGlobalBlock(global_model_fn)
+
+  def _build(self, graph):
+    return self._global_block(self._node_block(self._edge_block(graph)))
+
+
+def shared_placeholders(sample, dtype=None, name="shared_graph"):
+  """Placeholders for shared-topology batches of any size B.
+
+  sample is a numpy shared-topology batch, e.g. SnapshotStore.shared_batch.
+  Its topology is baked in as constants; feed with shared_feed_dict.
+  dtype defaults to that of the sample's features (see dtypes.py).
+  """
+  dtype = dtype if dtype else tf.as_dtype(sample.nodes.dtype)
+  n_node, n_edge = sample.nodes.shape[1], sample.edges.shape[1]
+  with tf.name_scope(name):
+    return graphs.GraphsTuple(
+        nodes=tf.placeholder(dtype, [None, n_node, sample.nodes.shape[2]], name="nodes"),
+        edges=tf.placeholder(dtype, [None, n_edge, sample.edges.shape[2]], name="edges"),
+        globals=tf.placeholder(dtype, [None, sample.globals.shape[1]], name="globals"),
+        senders=tf.constant(sample.senders, dtype=tf.int32, name="senders"),
+        receivers=tf.constant(sample.receivers, dtype=tf.int32, name="receivers"),
+        n_node=tf.constant([n_node], dtype=tf.int32, name="n_node"),
+        n_edge=tf.constant([n_edge], dtype=tf.int32, name="n_edge"))
+
+
+def shared_feed_dict(placeholders, batch):
+  return {placeholders.nodes: batch.nodes,
+          placeholders.edges: batch.edges,
+          placeholders.globals: batch.globals}
+
+
 def get_empty_graph(nodeshape,edgeshape,glblshape,senders,receivers):
     dic = {
-        "globals": np.zeros(glblshape,dtype=np.float),
-        "nodes": np.zeros(nodeshape,dtype=np.float),
-        "edges": np.zeros(edgeshape,dtype=np.float),
+        "globals": np.zeros(glblshape,dtype=dtypes.dtype("feature")),
+        "nodes": np.zeros(nodeshape,dtype=dtypes.dtype("feature")),
+        "edges": np.zeros(edgeshape,dtype=dtypes.dtype("feature")),
         "senders": senders,
         "receivers": receivers
     }
@@ -145,16 +293,23 @@ class EncodeProcessDecode(snt.AbstractModule):
     Input --->| Encoder |  *->| Core |--*->| Decoder |---> Output(t)
               |         |---->|      |     |         |
               *---------*     *------*     *---------*
+
+    With shared_topology=True the model takes and returns shared-topology
+    batches, (B, N, F) nodes and (B, E, F) edges over one senders/receivers
+    (see SnapshotStore.shared_batch and shared_placeholders). Variables are
+    named as in the default mode, so a checkpoint works in either.
     """
 
     def __init__(self,
                  edge_output_size=None,
                  node_output_size=None,
                  global_output_size=None,
+                 shared_topology=False,
                  name="EncodeProcessDecode"):
         super(EncodeProcessDecode, self).__init__(name=name)
+        self._shared = shared_topology
         self._encoder = MLPGraphIndependent()
-        self._core = MLPGraphNetwork()
+        self._core = MLPGraphNetwork(shared_topology=shared_topology)
         self._decoder = MLPGraphIndependent()
         # Transforms the outputs into the appropriate shapes.
         if edge_output_size is None:
@@ -170,19 +325,178 @@ class EncodeProcessDecode(snt.AbstractModule):
                 modules.GraphIndependent(edge_fn, node_fn)
 
     def _build(self, input_op, num_processing_steps):
-        latent = self._encoder(input_op)
+        if self._shared:
+            independent = apply_shared
+            concat = concat_shared
+        else:
+            independent = lambda module, graph: module(graph)
+            concat = lambda graphs: utils_tf.concat(graphs, axis=1)
+        latent = independent(self._encoder, input_op)
         latent0 = latent
         output_ops = []
         for _ in range(num_processing_steps):
-            core_input = utils_tf.concat([latent0, latent], axis=1)
+            core_input = concat([latent0, latent])
             latent = self._core(core_input)
-            decoded_op = self._decoder(latent)
-            output_ops.append(self._output_transform(decoded_op).replace(
+            decoded_op = independent(self._decoder, latent)
+            output_ops.append(independent(self._output_transform, decoded_op).replace(
                               globals=input_op.globals))
         return output_ops
 
 
 
+def build_forecast_model(input_graph, num_processing_steps=3, node_output_size=4,
+                         edge_output_size=3, shared_topology=False, name="output"):
+    # The EncodeProcessDecode forecaster as trained in graph_nn.ipynb
+    # Returns the module and its final output graph, whose nodes and edges
+    # are the normalized next-tg node features and first edge features
+    model = EncodeProcessDecode(edge_output_size=edge_output_size,
+                                node_output_size=node_output_size,
+                                shared_topology=shared_topology, name=name)
+    output_graphs = model(input_graph, num_processing_steps=num_processing_steps)
+    return model, output_graphs[-1]
+
+
+def forecast_variables(model):
+    # EncodeProcessDecode builds its encoder, core and decoder outside its
+    # own variable scope, as the graph_nets demo does, so model.get_variables()
+    # only holds the output transform. Save and restore checkpoints with these
+    return (model._encoder.get_variables() + model._core.get_variables()
+            + model._decoder.get_variables() + model.get_variables())
+
+
+def advance_daytime(daytimes, ntg=NTG):
+    # Raw (B, 2) [day, tg] globals -> the next time group, row by row,
+    # wrapping tg into the next day and day into the next week
+    # Denormalized globals carry float error, so they are rounded back to
+    # whole values first; otherwise it builds up over a rollout and the
+    # wrap test can fire a step early or late
+    daytimes = tf.round(daytimes)
+    tg = daytimes[:,1] + 1.
+    wrap = tf.cast(tf.greater_equal(tg, ntg), daytimes.dtype)
+    day = tf.mod(daytimes[:,0] + wrap, 7.)
+    return tf.stack([day, tg - wrap*ntg], axis=1)
+
+
+def forecast_next_input(output_graph, input_graph, normalizer, ntg=NTG, dtg=DTG):
+    # Builds the next normalized input graph from a shared-topology forecast
+    # Predicted nodes are used as is. The 13 edge features are rebuilt from
+    # the 3 predicted ones as create_nn_inputset builds them, with edge length
+    # and covariances carried over from the input, and the globals advance
+    dtype = input_graph.edges.dtype
+    def stats(kind):
+        mean, std, inv_std = normalizer.stats[kind]
+        return tf.constant(mean, dtype), tf.constant(std, dtype)
+    e_mean, e_std = stats("edges")
+    g_mean, g_std = stats("globals")
+
+    edges_in = input_graph.edges*e_std + e_mean
+    e3 = output_graph.edges[...,:3]*e_std[:3] + e_mean[:3]
+    length, covs = edges_in[...,3:4], edges_in[...,4:7]
+    frac = (dtg/60.)*e3[...,1:2]/length
+    edges = tf.concat([e3, length, covs, covs*e3, e3[...,0:1]*e3[...,1:2],
+                       frac, frac*e3[...,0:1]], axis=-1)
+
+    daytimes = advance_daytime(input_graph.globals*g_std + g_mean, ntg)
+    return input_graph.replace(nodes=output_graph.nodes,
+                               edges=(edges - e_mean)/e_std,
+                               globals=(daytimes - g_mean)/g_std)
+
+
+def rollout(model, init_graph, num_steps, num_processing_steps, normalizer,
+            ntg=NTG, dtg=DTG, unnormalize=True):
+    '''
+    Autoregressive forecast of num_steps time groups in one tf.while_loop
+
+    model is an EncodeProcessDecode(shared_topology=True) from
+    build_forecast_model, init_graph a normalized shared-topology batch of
+    B start times (e.g. shared_placeholders fed with store.shared_batch)
+    and normalizer the snapstore.Normalizer of the input file. Each
+    prediction becomes the next input via forecast_next_input without
+    leaving the graph.
+
+    Returns stacked (K, B, N, Fn) nodes, (K, B, E, Fe) edges and the
+    (K, B, 2) raw [day, tg] each step forecasts, unnormalized unless
+    unnormalize=False
+    '''
+    if not model.is_connected:
+        # Variables have to exist before the loop body reuses them
+        model(init_graph, num_processing_steps=num_processing_steps)
+
+    def body(k, nodes, edges, glbls, ta_nodes, ta_edges, ta_glbls):
+        graph = init_graph.replace(nodes=nodes, edges=edges, globals=glbls)
+        out = model(graph, num_processing_steps=num_processing_steps)[-1]
+        nxt = forecast_next_input(out, graph, normalizer, ntg, dtg)
+        return (k+1, nxt.nodes, nxt.edges, nxt.globals,
+                ta_nodes.write(k, out.nodes),
+                ta_edges.write(k, out.edges),
+                ta_glbls.write(k, nxt.globals))
+
+    dtype = init_graph.nodes.dtype
+    loop_vars = (tf.constant(0), init_graph.nodes, init_graph.edges, init_graph.globals,
+                 tf.TensorArray(dtype, size=num_steps),
+                 tf.TensorArray(dtype, size=num_steps),
+                 tf.TensorArray(dtype, size=num_steps))
+    loop_out = tf.while_loop(lambda k, *_: k < num_steps, body, loop_vars,
+                             back_prop=False, name="rollout")
+    nodes, edges, glbls = [ta.stack() for ta in loop_out[4:]]
+
+    def unnorm(kind, arr):
+        mean, std = normalizer.stats[kind][:2]
+        nft = arr.shape[-1].value
+        return arr*std[:nft].astype(dtype.as_numpy_dtype) + mean[:nft].astype(dtype.as_numpy_dtype)
+    daytimes = tf.round(unnorm("globals", glbls))
+    if unnormalize:
+        nodes, edges = unnorm("nodes", nodes), unnorm("edges", edges)
+    return nodes, edges, daytimes
+
+
+def _linear_layers(module):
+  """(Linear, relu after it) for each layer of a Sequential / MLP / Linear."""
+  model = getattr(module, "_model", module)  # graph_nets WrappedModelFnModule
+  if isinstance(model, snt.Linear):
+    return [(model, False)]
+  if isinstance(model, snt.nets.MLP):
+    n = len(model.layers)
+    return [(layer, i < n-1 or model.activate_final)
+            for i, layer in enumerate(model.layers)]
+  if isinstance(model, snt.Sequential):
+    return [l for layer in model.layers for l in _linear_layers(layer)]
+  raise TypeError("Can't export "+type(model).__name__)
+
+
+def export_numpy_weights(sess, model, fname):
+  """Saves a connected EncodeProcessDecode's weights for npmodel.NumpyForecaster.
+
+  Keys are "<module>/<attr>/w<i>", "b<i>" and "act", for modules encoder,
+  core, decoder and output and attrs edges, nodes and globals.
+  """
+  core = model._core._network
+  independents = {
+      "encoder": model._encoder._network,
+      "decoder": model._decoder._network,
+      "output": model._output_transform}
+  models = {"core/edges": core._edge_block._edge_model,
+            "core/nodes": core._node_block._node_model,
+            "core/globals": core._global_block._global_model}
+  for name, net in independents.items():
+    for attr, model_attr in (("edges", "_edge_model"), ("nodes", "_node_model"),
+                             ("globals", "_global_model")):
+      # GraphIndependent leaves untransformed attributes as identity lambdas
+      if isinstance(getattr(net, model_attr), snt.AbstractModule):
+        models[name+"/"+attr] = getattr(net, model_attr)
+
+  tensors, arrays = {}, {}
+  for prefix, module in models.items():
+    layers = _linear_layers(module)
+    arrays[prefix+"/act"] = np.array([act for _, act in layers])
+    for i, (layer, _) in enumerate(layers):
+      tensors[prefix+"/w"+str(i)] = layer.w
+      tensors[prefix+"/b"+str(i)] = layer.b
+  arrays.update(sess.run(tensors))
+  np.savez(fname, **arrays)
+  return arrays
+
+
 class timecrement(snt.Module):
     # Custom sonnet module for incrementing the global feature. Yeesh
     def __init__(self,ntg,disable=False,name=None):
@@ -213,6 +527,9 @@ def get_node_coord_dict(h5):
     return d
 
 def draw_graph(graph, node_pos_dict, col_lims=None, is_normed=False, normfile=None):
+    # Plotting stacks are only loaded when something is drawn
+    import matplotlib.pyplot as plt
+    import networkx as nx
     if col_lims:
         vmin,vmax = col_lims[0], col_lims[1]
         e_vmin,e_vmax = col_lims[2], col_lims[3]
@@ -246,32 +563,20 @@ def draw_graph(graph, node_pos_dict, col_lims=None, is_normed=False, normfile=No
             arrowsize=10)
     return fig,ax
 
+def h5_snapdict(h5file,day,tg,normalize=True):
+    return read_snapdict(h5file,day,tg,file_ntg(h5file),normalize)
+
 def snap2graph(h5file,day,tg,use_tf=False,placeholder=False,name=None,normalize=True):
-    snapstr = 'day'+str(day)+'tg'+str(tg)
-    if normalize:
-        edges = h5file['nn_edge_features/'+snapstr]
-        nodes = h5file['nn_node_features/'+snapstr]
-        glbls = h5file['nn_glbl_features/'+snapstr]
+    # h5file is an open nn_inputs h5py.File or a SnapshotStore
+    # A store hands back views of its preloaded arrays instead of reading the file
+    if isinstance(h5file, SnapshotStore):
+        if h5file.normalize != normalize:
+            raise ValueError("SnapshotStore was loaded with normalize="+str(h5file.normalize))
+        if not use_tf:
+            return h5file.graph(day,tg)
+        graphdat_dict = h5file.data_dict(day,tg)
     else:
-        edges = h5file['nn_edge_features/'+snapstr]
-        nodes = h5file['node_features/'+snapstr]
-        glbls = h5file['glbl_features/'+snapstr]
-    senders = h5file['senders']
-    receivers = h5file['receivers']
-    
-    node_arr = nodes[:]
-    edge_arr = edges[:]
-    glbl_arr = glbls[0]
-
-    graphdat_dict = {
-        "globals": glbl_arr.astype(np.float),
-        "nodes": node_arr.astype(np.float),
-        "edges": edge_arr.astype(np.float),
-        "senders": senders[:],
-        "receivers": receivers[:],
-        "n_node": node_arr.shape[0],
-        "n_edge": edge_arr.shape[0]
-    }
+        graphdat_dict = h5_snapdict(h5file,day,tg,normalize)
 
     if not use_tf:
         graphs_tuple = utils_np.data_dicts_to_graphs_tuple([graphdat_dict])
@@ -285,291 +590,6 @@ def snap2graph(h5file,day,tg,use_tf=False,placeholder=False,name=None,normalize=
             
     return graphs_tuple
 
-def EdgeNodeCovariance(h5_name):
-    h5f = h5py.File(h5_name,'a')
-    try:
-        covs = h5f['edge_node_covs']
-        del covs, h5f['edge_node_covs']
-    except:
-        pass
-    senders = h5f['senders']
-    receivers = h5f['receivers']
-    nedge = senders.shape[0]
-    h5_cov = h5f.create_dataset("edge_node_covs",compression="gzip",
-                                compression_opts=6,shape=(nedge,3),dtype=np.double)
-    
-    # Iterate over senders and edges
-    # Note that these arrays have corresponding indices
-    # Each edge-node pair will have 7*NTG data points, gather these.
-    # We will have an array of shape=(nedge,2,3,2,7*NTG)
-    # First 2 is for send/receive nodes, and second 2 is for x,y data
-    np_dat = np.zeros(shape=(nedge,7*NTG,2,3),dtype=np.float)
-
-    t = 0
-    for day in range(7):
-        for tg in progressbar(range(0,NTG)):
-            tg_post = (tg+1)%NTG
-            day_post = day
-            if tg == (NTG-1):
-                day_post = (day+1)%7
-            edges = h5f['edge_features/day'+str(day)+'tg'+str(tg)]
-            send_idxs = np.argwhere(edges[:,0] > 0).flatten()
-            nodes_post = h5f['node_features/day'+str(day_post)+'tg'+str(tg_post)]
-
-            for i in send_idxs:
-                s,r = senders[i], receivers[i]
-                edge = edges[i]
-                x = edge[:3]
-                y = nodes_post[r]
-
-                np_dat[i,t] = np.array([x,y])
-            t += 1
-
-    for i in range(nedge):
-        covs = []
-        # np_dat is mostly zeros that we want to ignore
-        dat = np_dat[i, np_dat[i,:,0,0]>0]
-        if dat.shape[0] < 2: continue
-        for j in range(3):
-            covs.append(np.cov(dat[:,:,j],rowvar=False)[0,1])
-        h5_cov[i] = covs
-
-    h5f.close()
-
-def CalcMFactor(h5_name):
-    h5f = h5py.File(h5_name,'a')
-    senders = h5f['senders'][:]
-    receivers = h5f['receivers'][:]
-    n_node = h5f.attrs['n_nodes']
-    M_np = np.zeros((n_node),dtype=np.float)
-    ks = np.ones((n_node),dtype=np.float)
-
-    # Create lookup table of senders for each node
-    send_edges = {}
-    for i in range(n_node):
-        send_edges.update({i: np.argwhere(receivers==i).flatten()})
-
-    for day in range(7):
-        for tg in progressbar(range(NTG)):
-            tg_post = (tg+1)%NTG
-            day_post = day
-            if tg == (NTG-1):
-                day_post = (day+1)%7
-            nodes_post = h5f['node_features/day'+str(day_post)+'tg'+str(tg_post)]
-            edges = h5f['edge_features/day'+str(day)+'tg'+str(tg)]
-
-            ncars_n = nodes_post[:,0]
-            ncars_e = edges[:,0]
-            for i in range(n_node):
-                ncar_e = 0
-                for i_send in send_edges[i]:
-                    #j = list(set(np.where(senders==sender)[0]) & set(np.where(receivers==i)[0]))
-                    #assert len(j)==1
-                    #ncar_e += int(j_edge[0])
-                    ncar_e += ncars_e[i_send]
-
-                if (ncar_e==0) and (ncars_n[i]==0):
-                    # Nothing happening, skip this data
-                    continue
-                diff = ncars_n[0] - ncar_e
-                M_np[i] = M_np[i] + (diff - M_np[i])/ks[i]
-                ks[i] += 1
-
-    try:
-        h5f.create_dataset('M',data=M_np,compression="gzip",compression_opts=6)
-    except:
-        del h5f['M']
-        h5f.create_dataset('M',data=M_np,compression="gzip",compression_opts=6)
-
-    return
-
-
-    
-def create_nn_inputset(h5_name):
-    h5f = h5py.File(h5_name,'a')
-
-    try:
-        covs = h5f['edge_node_covs']
-    except:
-        print("edge_node_covs DNE, exiting.")
-        h5f.close()
-        return
-
-    try:
-        M = h5f['M']
-    except:
-        print("M factor dataset DNE, exiting.")
-        h5f.close()
-        return
-
-    try:
-        nn_edgegroup = h5f.create_group("nn_edge_features")
-    except:
-        print("nn_edge_features group already exists. Overwriting")
-        del h5f['nn_edge_features']
-        nn_edgegroup = h5f.create_group("nn_edge_features")
-    try:
-        nn_nodegroup = h5f.create_group("nn_node_features")
-    except:
-        print("nn_node_features group already exists. Overwriting")
-        del h5f['nn_node_features']
-        nn_nodegroup = h5f.create_group("nn_node_features")
-    try:
-        nn_glblgroup = h5f.create_group("nn_glbl_features")
-    except:
-        print("nn_glbl_features group already exists. Overwriting")
-        del h5f['nn_glbl_features']
-        nn_glblgroup = h5f.create_group("nn_glbl_features")
-
-    node_stats = np.zeros((2,4),dtype=np.float64)
-    edge_stats = np.zeros((2,13),dtype=np.float64)
-    glbl_stats = np.zeros((2,2),dtype=np.float64)
-    nk, ek = 1, 1
-
-    n_edge = h5f.attrs['n_edges']
-    n_node = h5f.attrs['n_nodes']
-    for d in progressbar(range(7)):
-        for tg in range(NTG):
-            snapstr = "day"+str(d)+"tg"+str(tg)
-            e_fts = np.zeros((n_edge,13),dtype=np.float64)
-            edges = h5f['edge_features/'+snapstr]
-            e_fts[:,:4] = edges[:]
-            e_fts[:,4:7] = covs[:]
-            e_fts[:,7:10] = covs[:]*edges[:,:3]
-            e_fts[:,10] = edges[:,0]*edges[:,1]
-            e_fts[:,11] = (DTG/60.)*edges[:,1]/edges[:,3]
-            e_fts[:,12] = e_fts[:,11] * edges[:,0]
-
-            n_fts = np.zeros((n_node,4),dtype=np.float64)
-            nodes = h5f['node_features/'+snapstr]
-            n_fts[:,:3] = nodes[:]
-            n_fts[:,3] = M[:]
-
-            # You could do some stat stuff here
-            np.random.shuffle(e_fts)
-            np.random.shuffle(n_fts)
-            for e_ft in e_fts[:50]:
-                m_k = edge_stats[0,:] + (e_ft - edge_stats[0,:])/ek
-                edge_stats[1,:] = edge_stats[1,:] + (e_ft - edge_stats[0,:])*(e_ft - m_k)
-                edge_stats[0,:] = m_k
-                ek+=1
-            for n_ft in n_fts[:20]:
-                m_k = node_stats[0,:] + (n_ft - node_stats[0,:])/nk
-                node_stats[1,:] = node_stats[1,:] + (n_ft - node_stats[0,:])*(n_ft - m_k)
-                node_stats[0,:] = m_k
-                nk+=1
-
-            nn_edgegroup.create_dataset(snapstr,data=e_fts,compression="gzip",compression_opts=6)
-            nn_nodegroup.create_dataset(snapstr,data=n_fts,compression='gzip',compression_opts=6)
-
-    print("Creating normalized dataset")
-
-    #
-    #
-    # Lets not have separate datasets for the unnormed and normed features
-    # Just overwrite the unnormed stuff with the normed stuff
-    #
-    #
-
-
-    try:
-        normed_edge_group = h5f.create_group("nn_edge_features_normed")
-        normed_node_group = h5f.create_group("nn_node_features_normed")
-        normed_glbl_group = h5f.create_group("nn_glbl_features_normed")
-    except:
-        print("Normed features exist. Overwriting")
-        del h5f['nn_edge_features_normed'], h5f['nn_node_features_normed'],\
-            h5f['nn_glbl_features_normed']
-        normed_edge_group = h5f.create_group("nn_edge_features_normed")
-        normed_node_group = h5f.create_group("nn_node_features_normed")
-        normed_glbl_group = h5f.create_group("nn_glbl_features_normed")
-
-    """
-    print("Calculating norm stats")
-    node_stats = np.zeros((2,4),dtype=np.float64)
-    edge_stats = np.zeros((2,13),dtype=np.float64)
-    glbl_stats = np.zeros((2,2),dtype=np.float64)
-    glblgroup = h5f['glbl_features']
-
-    # This loop goes over each tg and then each
-    # edge or node within the tg
-    # This is costly, let's do Sun,Mon,Thur,Sat
-    # and some random selection of 25% of the nodes/edges
-    # ...later
-    #
-    # You could also in theory gather stats as you build the
-    # nn_nodegroup.items in the above loops
-    #
-    k = 1 # data iter
-    for key,dset in progressbar(nn_nodegroup.items()):
-        np.random.shuffle(dset)
-        for row in dset[:10]:
-            m_k = node_stats[0,:] + (row - node_stats[0,:])/k
-            node_stats[1,:] = node_stats[1,:] + (row - node_stats[0,:])*(row - m_k)
-            node_stats[0,:] = m_k
-            k+=1
-    node_stats[1,:] = np.sqrt(node_stats[1,:]/(k-1))
-    
-    k = 1
-    for key,dset in progressbar(nn_edgegroup.items()):
-        np.random.shuffle(dset)
-        for row in dset[:10]:
-            m_k = edge_stats[0,:] + (row - edge_stats[0,:])/k
-            edge_stats[1,:] = edge_stats[1,:] + (row - edge_stats[0,:])*(row - m_k)
-            edge_stats[0,:] = m_k
-            k+=1
-    edge_stats[1,:] = np.sqrt(edge_stats[1,:]/(k-1))
-    """
-
-    node_stats[1,:] = np.sqrt(node_stats[1,:]/(nk-1))
-    edge_stats[1,:] = np.sqrt(edge_stats[1,:]/(ek-1))
-    glbl_stats[:] = [[3.0,2.0], [np.mean(range(NTG)),np.std(range(NTG))]]
-
-    glblgroup = h5f['glbl_features']
-    # Now that we have the norm stats, we apply it to the existing datasets
-    print("Applying norm to feature sets")
-    for d in progressbar(range(7)):
-        for tg in range(NTG):
-            snapstr="day"+str(d)+"tg"+str(tg)
-            nodes = nn_nodegroup[snapstr]
-            edges = nn_edgegroup[snapstr]
-            glbls = glblgroup[snapstr]
-            normed_nodes = mynorm(nodes,node_stats[0,:],node_stats[1,:])
-            normed_edges = mynorm(edges,edge_stats[0,:],edge_stats[1,:])
-            normed_glbls = mynorm(glbls,glbl_stats[0,:],glbl_stats[1,:])
-
-            if 0:
-                normed_node_group.create_dataset(snapstr,compression="gzip",compression_opts=6,
-                                                 data=normed_nodes)
-                normed_edge_group.create_dataset(snapstr,compression="gzip",compression_opts=6,
-                                                 data=normed_edges)
-                normed_glbl_group.create_dataset(snapstr,compression="gzip",compression_opts=6,
-                                                 data=normed_glbls)
-            else:
-                nodes[:] = normed_nodes.copy()
-                edges[:] = normed_edges.copy()
-                nn_glblgroup.create_dataset(snapstr,data=normed_glbls,compression='gzip',compression_opts=6)
-
-    # Save the stats to hdf5
-    try:
-        h5f.create_dataset('node_stats',compression="gzip",compression_opts=6,data=node_stats)
-        h5f.create_dataset('edge_stats',compression="gzip",compression_opts=6,data=edge_stats)
-        h5f.create_dataset('glbl_stats',compression="gzip",compression_opts=6,data=glbl_stats)
-    except:
-        del h5f['node_stats'], h5f['edge_stats'], h5f['glbl_stats']
-        h5f.create_dataset('node_stats',compression="gzip",compression_opts=6,data=node_stats)
-        h5f.create_dataset('edge_stats',compression="gzip",compression_opts=6,data=edge_stats)
-        h5f.create_dataset('glbl_stats',compression="gzip",compression_opts=6,data=glbl_stats)
-
-    h5f.close()
-
-
-def mynorm(nparr,mus,stds):
-    return np.divide(np.subtract(nparr,mus),stds)
-
-def my_unnorm(nparr,norms):
-    return np.add(np.multiply(nparr,norms[1,:]),norms[0,:])
-
 def unnorm_graph(graph, node_norms, edge_norms):
     return graph.replace(nodes=my_unnorm(graph.nodes,node_norms),
                          edges=my_unnorm(graph.edges,edge_norms))
@@ -580,60 +600,5 @@ def copy_graph(graphs_tuple):
         utils_np.graphs_tuple_to_data_dicts(graphs_tuple))
 
 
-def get_daytimes():
-    daytimes = np.zeros((7*NTG,2),dtype=int)
-    i=0
-    for d in range(7):
-        for tg in range(NTG):
-            daytimes[i] = [d,tg]
-            i+=1
-    return daytimes
-    
-
-def get_norm_stats(hfname):
-    h5f = h5py.File(hfname,'a')
-    node_stats = np.zeros((2,5),dtype=np.float64)
-    edge_stats = np.zeros((2,13),dtype=np.float64)
-    glbl_stats = np.zeros((2,2),dtype=np.float64)
-    nodegroup = h5f['nn_node_features']
-    edgegroup = h5f['nn_edge_features']
-    glblgroup = h5f['glbl_features']
-
-    print("Calculating norm stats")
-    k = 1 # data iter
-    for key,dset in progressbar(nodegroup.items()):
-        for row in dset:
-            m_k = node_stats[0,:] + (row - node_stats[0,:])/k
-            node_stats[1,:] = node_stats[1,:] + (row - node_stats[0,:])*(row - m_k)
-            node_stats[0,:] = m_k
-            k+=1
-    node_stats[1,:] = np.sqrt(node_stats[1,:]/(k-1))
-    
-    k = 1
-    for key,dset in progressbar(edgegroup.items()):
-        for row in dset:
-            m_k = edge_stats[0,:] + (row - edge_stats[0,:])/k
-            edge_stats[1,:] = edge_stats[1,:] + (row - edge_stats[0,:])*(row - m_k)
-            edge_stats[0,:] = m_k
-            k+=1
-    edge_stats[1,:] = np.sqrt(edge_stats[1,:]/(k-1))
-
-    glbl_stats[:] = [[3.0,2.0], [np.mean(range(NTG)),np.std(range(NTG))]]
-
-    # Save the stats to hdf5
-    try:
-        del h5f['node_stats'],h5f['edge_stats'],h5f['glbl_stats']
-    except:
-        pass
-    h5f.create_dataset('node_stats',compression="gzip",compression_opts=6,data=node_stats)
-    h5f.create_dataset('edge_stats',compression="gzip",compression_opts=6,data=edge_stats)
-    h5f.create_dataset('glbl_stats',compression="gzip",compression_opts=6,data=glbl_stats)
-
-    h5f.close()
-
-    return
-
-
-
-
-
+# Opt-in timing, hdf5 I/O and memory hooks on the functions above, see profiling.py
+profiling.instrument(globals())
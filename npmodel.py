@@ -0,0 +1,129 @@
+'''
+NumPy runtime for EncodeProcessDecode weights exported with
+my_graph_tools.export_numpy_weights
+
+Runs the same encode / process / decode pass as the TF model on numpy
+arrays only, so serving a forecast needs neither TensorFlow, Sonnet nor
+graph_nets. Inputs are normalized features as SnapshotStore hands them
+out, either one snapshot (nodes (N, F), edges (E, F), globals (1, G))
+or a shared-topology batch (B, N, F), (B, E, F), (B, G).
+
+model = NumpyForecaster("weights.npz", store.senders, store.receivers, store.n_node[0])
+outputs = model(batch.nodes, batch.edges, batch.globals)
+nodes, edges = outputs[-1]
+'''
+import numpy as np
+
+
+# Exported modules, as "<module>/<attr>/<key>" in the npz
+MODULES = ("encoder", "core", "decoder", "output")
+ATTRS = ("edges", "nodes", "globals")
+
+
+class NumpyMLP(object):
+    # snt.nets.MLP / snt.Linear stack; act[i] says whether layer i is followed by a relu
+    def __init__(self, ws, bs, act):
+        self.layers = list(zip(ws, bs, act))
+
+    def __call__(self, x):
+        for w, b, act in self.layers:
+            x = np.dot(x, w)
+            x += b
+            if act:
+                np.maximum(x, 0., out=x)
+        return x
+
+
+def load_weights(fname):
+    # npz -> {module: {attr: NumpyMLP}}; attrs the model doesn't transform are left out
+    mlps = {module: {} for module in MODULES}
+    with np.load(fname) as npz:
+        for module in MODULES:
+            for attr in ATTRS:
+                prefix = module+"/"+attr+"/"
+                if prefix+"act" not in npz:
+                    continue
+                act = npz[prefix+"act"]
+                mlps[module][attr] = NumpyMLP([npz[prefix+"w"+str(i)] for i in range(len(act))],
+                                              [npz[prefix+"b"+str(i)] for i in range(len(act))],
+                                              act)
+    return mlps
+
+
+class SegmentSum(object):
+    '''
+    Sum of edge rows onto their receiving nodes for a fixed topology
+
+    Edges are sorted by receiver once, so each call is a single
+    np.add.reduceat over the edge axis. Nodes without incoming edges
+    get zeros.
+    '''
+    def __init__(self, receivers, n_node):
+        receivers = np.asarray(receivers)
+        self.n_node = n_node
+        self.order = np.argsort(receivers, kind="stable")
+        counts = np.bincount(receivers, minlength=n_node)
+        self.nonempty = np.flatnonzero(counts)
+        self.starts = (np.cumsum(counts)-counts)[self.nonempty]
+
+    def __call__(self, edges):
+        out = np.zeros(edges.shape[:-2]+(self.n_node, edges.shape[-1]), dtype=edges.dtype)
+        if len(self.starts):
+            out[..., self.nonempty, :] = np.add.reduceat(
+                edges[..., self.order, :], self.starts, axis=-2)
+        return out
+
+
+class NumpyForecaster(object):
+    '''
+    EncodeProcessDecode forward pass on a fixed topology
+
+    Calling it returns one (nodes, edges) pair per processing step, as
+    the TF model returns one graph per step; globals pass through.
+    '''
+    def __init__(self, fname, senders, receivers, n_node):
+        self.mlps = load_weights(fname)
+        self.senders = np.asarray(senders)
+        self.receivers = np.asarray(receivers)
+        self.segment_sum = SegmentSum(self.receivers, n_node)
+
+    def independent(self, module, nodes, edges, glbls):
+        # GraphIndependent: each attribute through its own model, or unchanged
+        mlps = self.mlps[module]
+        apply = lambda attr, x: mlps[attr](x) if attr in mlps else x
+        return apply("nodes", nodes), apply("edges", edges), apply("globals", glbls)
+
+    def core(self, nodes, edges, glbls):
+        # GraphNetwork as MLPGraphNetwork configures it. Same concat orders as
+        # EdgeBlock (edges, receivers, senders, globals) and NodeBlock
+        # (received edges, nodes, globals); the global block sees globals only
+        mlps = self.mlps["core"]
+        n_edge, n_node = edges.shape[-2], nodes.shape[-2]
+        bcast = lambda g, n: np.broadcast_to(g[..., None, :], g.shape[:-1]+(n, g.shape[-1]))
+        edges = mlps["edges"](np.concatenate([
+            edges,
+            nodes[..., self.receivers, :],
+            nodes[..., self.senders, :],
+            bcast(glbls, n_edge)], axis=-1))
+        nodes = mlps["nodes"](np.concatenate([
+            self.segment_sum(edges),
+            nodes,
+            bcast(glbls, n_node)], axis=-1))
+        return nodes, edges, mlps["globals"](glbls)
+
+    def __call__(self, nodes, edges, glbls, num_processing_steps=3):
+        single = nodes.ndim == 2
+        if single:
+            nodes, edges, glbls = nodes[None], edges[None], np.reshape(glbls, (1, -1))
+        latent0 = self.independent("encoder", nodes, edges, glbls)
+        latent = latent0
+        outputs = []
+        for _ in range(num_processing_steps):
+            latent = self.core(*[np.concatenate([a, b], axis=-1)
+                                 for a, b in zip(latent0, latent)])
+            out_nodes, out_edges, _ = self.independent(
+                "output", *self.independent("decoder", *latent))
+            if single:
+                out_nodes, out_edges = out_nodes[0], out_edges[0]
+            outputs.append((out_nodes, out_edges))
+        return outputs
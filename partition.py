@@ -0,0 +1,208 @@
+'''
+Split the road graph into spatially compact tiles with k-hop halos
+
+Nodes are assigned to tiles by recursive coordinate bisection: the
+node set is cut across the longer side of its bounding box at the
+(weighted) node count that gives each side its share of the tiles, and
+each side is cut again until there are ntiles. Each tile then adds as
+halo every node within halo hops upstream (along edges, sender to
+receiver) of the nodes it owns.
+
+A tile's nodes are its owned nodes followed by its halo nodes, and its
+edges are those into owned nodes followed by those into halo nodes,
+with senders and receivers as indices into the tile's nodes. The model's
+outputs on owned nodes and the edges into them are exact as long as
+halo >= num_processing_steps, so tiles can be trained on as mini-batches
+(taking the loss over tile.owned_nodes / tile.owned_edges) and their
+outputs stitched back into whole-graph arrays at inference.
+
+tiles = partition_graph(coords_km, senders, receivers, ntiles=8, halo=3)
+batch = tiles[0].subgraph(store.shared_batch(daytimes))
+nodes, edges = stitch(tiles, tile_outputs, n_node, n_edge)
+
+Tiles of an nn_inputs file are saved into it (group "tiles") with
+
+    python partition.py [--tiles 8] [--halo 3] inputfname
+'''
+import sys, getopt
+import numpy as np
+import scipy.sparse as sp
+import h5py
+
+import graphtools as gt
+
+
+def bisect(coords, ntiles, weights=None):
+    # Tile id per node by recursive coordinate bisection, balancing total weight
+    n = len(coords)
+    if ntiles > n:
+        raise ValueError("More tiles than nodes ("+str(ntiles)+" > "+str(n)+")")
+    weights = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64)
+    parts = np.zeros(n, dtype=np.int32)
+    stack = [(np.arange(n), ntiles, 0)]
+    while stack:
+        idx, k, first = stack.pop()
+        if k == 1:
+            parts[idx] = first
+            continue
+        pts = coords[idx]
+        axis = np.argmax(pts.max(axis=0) - pts.min(axis=0))
+        order = idx[np.argsort(pts[:,axis], kind="stable")]
+        kleft = k//2
+        cum = np.cumsum(weights[order])
+        if cum[-1] > 0:
+            nleft = np.searchsorted(cum, cum[-1]*kleft/k) + 1
+        else:
+            nleft = len(idx)*kleft//k
+        # Every tile keeps at least one node
+        nleft = min(max(nleft, kleft), len(idx) - (k-kleft))
+        stack.append((order[:nleft], kleft, first))
+        stack.append((order[nleft:], k-kleft, first+kleft))
+    return parts
+
+
+class Tile(object):
+    '''
+    One tile of the graph and its maps to whole-graph indices
+
+    nodes      whole-graph ids of the tile's nodes, owned first then halo
+    edges      whole-graph ids of the tile's edges, those into owned nodes first
+    senders, receivers  tile-local, indexing nodes
+    n_owned, n_owned_edges  lengths of the owned blocks of nodes and edges
+    '''
+    def __init__(self, nodes, edges, senders, receivers, n_owned, n_owned_edges):
+        self.nodes = nodes
+        self.edges = edges
+        self.senders = senders
+        self.receivers = receivers
+        self.n_owned = int(n_owned)
+        self.n_owned_edges = int(n_owned_edges)
+
+    @property
+    def owned_nodes(self):
+        return slice(0, self.n_owned)
+
+    @property
+    def owned_edges(self):
+        return slice(0, self.n_owned_edges)
+
+    def subgraph(self, graph):
+        # The tile's part of a GraphsTuple over the whole graph, single or
+        # shared-topology batch (nodes (..., n_node, F), edges (..., n_edge, F))
+        return graph.replace(nodes=graph.nodes[..., self.nodes, :],
+                             edges=graph.edges[..., self.edges, :],
+                             senders=self.senders,
+                             receivers=self.receivers,
+                             n_node=np.array([len(self.nodes)], dtype=np.int32),
+                             n_edge=np.array([len(self.edges)], dtype=np.int32))
+
+
+def build_tile(owned, senders, receivers, upstream, halo):
+    # upstream[s, r] is set for each edge s -> r
+    n_node = upstream.shape[0]
+    is_owned = np.zeros(n_node, dtype=bool)
+    is_owned[owned] = True
+    reach = is_owned.copy()
+    for _ in range(halo):
+        reach |= upstream.dot(reach.astype(np.int32)) > 0
+    nodes = np.concatenate([np.flatnonzero(is_owned), np.flatnonzero(reach & ~is_owned)])
+
+    # Edges into a node whose sender is also in the tile
+    inside = reach[senders]
+    own_e = np.flatnonzero(inside & is_owned[receivers])
+    halo_e = np.flatnonzero(inside & reach[receivers] & ~is_owned[receivers])
+    edges = np.concatenate([own_e, halo_e])
+
+    local = np.full(n_node, -1, dtype=np.int64)
+    local[nodes] = np.arange(len(nodes))
+    return Tile(nodes.astype(np.int32), edges.astype(np.int32),
+                local[senders[edges]].astype(np.int32),
+                local[receivers[edges]].astype(np.int32),
+                is_owned.sum(), len(own_e))
+
+
+def partition_graph(coords, senders, receivers, ntiles, halo=3, weights=None):
+    '''
+    coords (n_node, 2) node positions in km, senders/receivers the edge list
+    weights, optional per-node loads to balance (default node counts)
+    Returns a list of ntiles Tile
+    '''
+    coords = np.asarray(coords, dtype=np.float64)
+    senders = np.asarray(senders, dtype=np.int64)
+    receivers = np.asarray(receivers, dtype=np.int64)
+    n_node = len(coords)
+    upstream = sp.csr_matrix((np.ones(len(senders), dtype=np.int32), (senders, receivers)),
+                             shape=(n_node, n_node))
+    parts = bisect(coords, ntiles, weights)
+    return [build_tile(np.flatnonzero(parts == i), senders, receivers, upstream, halo)
+            for i in range(ntiles)]
+
+
+def stitch(tiles, outputs, n_node, n_edge):
+    '''
+    Whole-graph (nodes, edges) from per-tile (nodes, edges) outputs, taking
+    each tile's owned nodes and the edges into them. Arrays may carry
+    leading batch dims, as (..., n, F). Edges into no tile's owned nodes
+    (only possible with halo=0) are left zero
+    '''
+    nodes0, edges0 = outputs[0]
+    nodes = np.zeros(nodes0.shape[:-2]+(n_node, nodes0.shape[-1]), dtype=nodes0.dtype)
+    edges = np.zeros(edges0.shape[:-2]+(n_edge, edges0.shape[-1]), dtype=edges0.dtype)
+    for tile, (tnodes, tedges) in zip(tiles, outputs):
+        nodes[..., tile.nodes[tile.owned_nodes], :] = tnodes[..., tile.owned_nodes, :]
+        edges[..., tile.edges[tile.owned_edges], :] = tedges[..., tile.owned_edges, :]
+    return nodes, edges
+
+
+def save_tiles(h5f, tiles, halo, name="tiles"):
+    if name in h5f:
+        del h5f[name]
+    grp = h5f.create_group(name)
+    grp.attrs["ntiles"] = len(tiles)
+    grp.attrs["halo"] = halo
+    for i, tile in enumerate(tiles):
+        tgrp = grp.create_group("tile"+str(i))
+        for key in ("nodes", "edges", "senders", "receivers"):
+            tgrp.create_dataset(key, data=getattr(tile, key))
+        tgrp.attrs["n_owned"] = tile.n_owned
+        tgrp.attrs["n_owned_edges"] = tile.n_owned_edges
+
+
+def load_tiles(h5f, name="tiles"):
+    grp = h5f[name]
+    tiles = []
+    for i in range(int(grp.attrs["ntiles"])):
+        tgrp = grp["tile"+str(i)]
+        tiles.append(Tile(*[tgrp[key][:] for key in ("nodes", "edges", "senders", "receivers")],
+                          tgrp.attrs["n_owned"], tgrp.attrs["n_owned_edges"]))
+    return tiles
+
+
+def h5_coords_km(h5f):
+    # node_coords are stored in GSI degrees
+    coords = h5f["node_coords"][:].astype(np.float64)
+    return np.stack([coords[:,0]*gt.long2km, coords[:,1]*gt.lat2km], axis=1)
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["tiles=", "halo="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    if len(args) != 1:
+        print(__doc__)
+        sys.exit(2)
+    opts = dict(opts)
+    ntiles, halo = int(opts.get("--tiles", 8)), int(opts.get("--halo", 3))
+
+    with h5py.File(args[0], 'a') as h5f:
+        senders, receivers = h5f["senders"][:], h5f["receivers"][:]
+        tiles = partition_graph(h5_coords_km(h5f), senders, receivers, ntiles, halo)
+        save_tiles(h5f, tiles, halo)
+    print("tile".ljust(6), "owned".rjust(8), "halo".rjust(8), "edges".rjust(8), "owned edges".rjust(12))
+    for i, tile in enumerate(tiles):
+        print(str(i).ljust(6), str(tile.n_owned).rjust(8), str(len(tile.nodes)-tile.n_owned).rjust(8),
+              str(len(tile.edges)).rjust(8), str(tile.n_owned_edges).rjust(12))
+    print("Saved", ntiles, "tiles with halo", halo, "to", args[0])
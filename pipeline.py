@@ -0,0 +1,264 @@
+r'''
+Build the derived datasets of an nn_inputs hdf5 file, skipping stages
+that are already up to date
+
+    covariance (edge_node_covs) --\
+                                   +--> inputset (nn_*_features, *_stats)
+    mfactor (M) ------------------/
+
+Each stage fingerprints its inputs (source datasets, or the fingerprint
+stamped on an upstream stage's outputs), its parameters (NTG, DTG,
+source names, options) and its code, the source of every module it
+runs through, so edits to helpers such as read_snap or nn_features
+count too. The fingerprint is stamped on the stage's outputs as
+attrs["pipeline_fp"], and a stage only reruns when its outputs are
+missing or carry a different stamp. covariance
+and mfactor only read the file, so they run concurrently in worker
+processes and the runner writes their outputs. Datasets rewritten
+outside the pipeline lose their stamp and are hashed by content. Sources
+are hashed once: the digest is cached on them as attrs["pipeline_digest"],
+keyed on the shape and dtype of their datasets, so an up to date run
+reads no data. In-place edits of a stamped output, or of a source that
+keep its shapes and dtypes, go unnoticed; use --force.
+
+Globals need no stage: they are normalized on read from glbl_stats.
+
+Usage:
+    python pipeline.py [options] inputfname
+
+Options:
+    --force        comma separated stages to rerun regardless, or "all"
+    --jobs         worker processes for independent stages (default 2)
+    --exact-stats  norm stats from every row rather than a sample
+    --seed         seed for the sampled norm stats
+    --dry-run      only report what would run
+'''
+import sys, getopt
+import time
+import json
+import hashlib
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import h5py
+
+import prep
+import snapstore
+import dtypes
+
+
+STAGES = [
+    {"name": "covariance",
+     "deps": [],
+     "inputs": ["receivers", "edge_features", "node_features"],
+     "outputs": ["edge_node_covs"],
+     "compute": prep.edge_node_covariance,
+     "code": [prep, snapstore, dtypes]},
+    {"name": "mfactor",
+     "deps": [],
+     "inputs": ["receivers", "edge_features", "node_features"],
+     "outputs": ["M"],
+     "compute": prep.m_factor,
+     "code": [prep, snapstore, dtypes]},
+    {"name": "inputset",
+     "deps": ["covariance", "mfactor"],
+     "inputs": ["edge_features", "node_features", "edge_node_covs", "M"],
+     "outputs": ["nn_edge_features", "nn_node_features",
+                 "node_stats", "edge_stats", "glbl_stats"],
+     "run": prep.create_nn_inputset,
+     "code": [prep, snapstore, dtypes]},
+]
+
+
+def content_digest(obj, rows=4096):
+    # Digest of a dataset's (or a group's) contents, read in row blocks
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(obj, h5py.Dataset):
+        h.update(str((obj.shape, obj.dtype.str)).encode())
+        if obj.shape == ():
+            h.update(np.asarray(obj[()]).tobytes())
+        else:
+            for i in range(0, obj.shape[0], rows):
+                h.update(np.ascontiguousarray(obj[i:i+rows]).tobytes())
+    else:
+        for name in sorted(obj):
+            h.update(name.encode())
+            h.update(input_digest(obj[name]).encode())
+    return h.hexdigest()
+
+
+def digest_key(obj):
+    # What a cached content digest is checked against: the shape and dtype
+    # of a dataset, or of every dataset in a group
+    if isinstance(obj, h5py.Dataset):
+        return str((obj.shape, obj.dtype.str))
+    h = hashlib.blake2b(digest_size=16)
+    for name in sorted(obj):
+        h.update(name.encode())
+        h.update(digest_key(obj[name]).encode())
+    return h.hexdigest()
+
+
+def input_digest(obj, fresh=None):
+    # Outputs of a stage carry that stage's fingerprint, which stands in for their contents
+    if "pipeline_fp" in obj.attrs:
+        return str(obj.attrs["pipeline_fp"])
+    key = digest_key(obj)
+    if obj.attrs.get("pipeline_digest_key") == key:
+        return str(obj.attrs["pipeline_digest"])
+    digest = content_digest(obj)
+    # Content digests computed here are left in fresh, by name, for cache_digests
+    if fresh is not None:
+        fresh[obj.name] = (digest, key)
+    return digest
+
+
+def cache_digests(h5f, fresh):
+    for name, (digest, key) in fresh.items():
+        h5f[name].attrs["pipeline_digest"] = digest
+        h5f[name].attrs["pipeline_digest_key"] = key
+
+
+def code_digest(stage):
+    # Source of the modules a stage runs through, not just its entry point
+    h = hashlib.blake2b(digest_size=16)
+    for module in stage["code"]:
+        h.update(module.__name__.encode())
+        h.update(inspect.getsource(module).encode())
+    return h.hexdigest()
+
+
+def stage_params(stage, h5f, options):
+    params = {"NTG": prep.file_ntg(h5f), "DTG": prep.DTG,
+              "n_nodes": int(h5f.attrs["n_nodes"]), "n_edges": int(h5f.attrs["n_edges"]),
+              "sources": stage["inputs"]}
+    if "run" in stage:
+        params.update(options)
+    return params
+
+
+def plan(h5f, options, force=(), fresh=None):
+    # Fingerprint every stage in order; returns [(stage, fingerprint, needs_run)]
+    # Each source is digested once, and those hashed by content are left in fresh
+    planned, produced, sources = [], {}, {}
+    for stage in STAGES:
+        digests = {}
+        for name in stage["inputs"]:
+            if name in produced:
+                digests[name] = produced[name]
+            elif name in sources:
+                digests[name] = sources[name]
+            elif name in h5f:
+                digests[name] = sources[name] = input_digest(h5f[name], fresh)
+            else:
+                raise KeyError("pipeline input "+name+" is missing from "+h5f.filename)
+        key = json.dumps({"stage": stage["name"],
+                          "params": stage_params(stage, h5f, options),
+                          "inputs": digests,
+                          "code": code_digest(stage)},
+                         sort_keys=True)
+        fp = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        stale = any((name not in h5f) or (h5f[name].attrs.get("pipeline_fp") != fp)
+                    for name in stage["outputs"])
+        # A rerun upstream means new inputs here
+        stale = stale or any(run for dep, _, run in planned
+                             if dep["name"] in stage["deps"])
+        planned.append((stage, fp, stale or ("all" in force) or (stage["name"] in force)))
+        for name in stage["outputs"]:
+            produced[name] = fp
+    return planned
+
+
+def _compute(fn, h5_name):
+    t0 = time.time()
+    with h5py.File(h5_name, 'r') as h5f:
+        out = fn(h5f)
+    return out, time.time()-t0
+
+
+def stamp(h5f, stage, fp):
+    for name in stage["outputs"]:
+        h5f[name].attrs["pipeline_fp"] = fp
+
+
+def run_pipeline(h5_name, force=(), jobs=2, options=None, dry_run=False):
+    options = options if options else {}
+    fresh = {}
+    with h5py.File(h5_name, 'r') as h5f:
+        planned = plan(h5f, options, force, fresh)
+    if fresh and not dry_run:
+        with h5py.File(h5_name, 'a') as h5f:
+            cache_digests(h5f, fresh)
+
+    report = []
+    done = set()
+    while len(done) < len(planned):
+        # Next level: every stage whose deps are done
+        level = [(s, fp, run) for s, fp, run in planned
+                 if s["name"] not in done and all(d in done for d in s["deps"])]
+        torun = [(s, fp) for s, fp, run in level if run]
+        for s, fp, run in level:
+            if not run or dry_run:
+                report.append((s["name"], "up to date" if not run else "would run", 0.))
+        if dry_run:
+            done.update(s["name"] for s, _, _ in level)
+            continue
+
+        compute = [(s, fp) for s, fp in torun if "compute" in s]
+        if len(compute) > 1 and jobs > 1:
+            with ProcessPoolExecutor(min(jobs, len(compute))) as pool:
+                futures = [pool.submit(_compute, s["compute"], h5_name) for s, _ in compute]
+                results = [f.result() for f in futures]
+        else:
+            results = [_compute(s["compute"], h5_name) for s, _ in compute]
+        for (s, fp), (out, dt) in zip(compute, results):
+            t0 = time.time()
+            with h5py.File(h5_name, 'a') as h5f:
+                prep.replace_dataset(h5f, s["outputs"][0], out)
+                stamp(h5f, s, fp)
+            report.append((s["name"], "ran", dt + time.time()-t0))
+
+        for s, fp in torun:
+            if "run" not in s:
+                continue
+            t0 = time.time()
+            s["run"](h5_name, **options)
+            with h5py.File(h5_name, 'a') as h5f:
+                stamp(h5f, s, fp)
+            report.append((s["name"], "ran", time.time()-t0))
+
+        done.update(s["name"] for s, _, _ in level)
+
+    print("stage".ljust(12), "status".ljust(12), "seconds".rjust(9))
+    for name, status, dt in report:
+        print(name.ljust(12), status.ljust(12), ("%.2f" % dt).rjust(9))
+    return report
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["force=", "jobs=", "exact-stats",
+                                                      "seed=", "dry-run"])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    if len(args) != 1:
+        print(__doc__)
+        sys.exit(2)
+
+    force, jobs, dry_run = (), 2, False
+    options = {"exact": False, "seed": None}
+    for opt, arg in opts:
+        if opt == "--force":
+            force = tuple(arg.split(","))
+        elif opt == "--jobs":
+            jobs = int(arg)
+        elif opt == "--exact-stats":
+            options["exact"] = True
+        elif opt == "--seed":
+            options["seed"] = int(arg)
+        elif opt == "--dry-run":
+            dry_run = True
+
+    run_pipeline(args[0], force, jobs, options, dry_run)
@@ -0,0 +1,317 @@
+'''
+Data-prep functions for nn_inputs files: edge/node covariance, the M
+factor, the nn input set and its norm stats
+
+Only NumPy and h5py are imported, so prep workers (pipeline.py, bench.py)
+start without the TensorFlow, graph_nets and plotting stacks that
+my_graph_tools loads. my_graph_tools re-exports everything here.
+'''
+import multiprocessing
+import numpy as np
+import h5py
+
+from snapstore import snapstr, read_snap, open_snapshots
+import profiling
+import dtypes
+
+try:
+    from progressbar import progressbar
+except ImportError:
+    def progressbar(iterable):
+        return iterable
+
+
+DTG = 0.5
+NTG = int(60*24/DTG)
+
+
+def file_ntg(h5file):
+    # Time groups per day of an input file, falling back on the module NTG
+    return int(h5file.attrs['nTG']) if 'nTG' in h5file.attrs else NTG
+
+
+def EdgeNodeCovariance(h5_name):
+    with h5py.File(h5_name,'r') as h5f:
+        covs = edge_node_covariance(h5f)
+    with h5py.File(h5_name,'a') as h5f:
+        replace_dataset(h5f,'edge_node_covs',covs)
+
+
+def replace_dataset(h5f,name,data):
+    if name in h5f:
+        del h5f[name]
+    return h5f.create_dataset(name,data=data,compression="gzip",compression_opts=6)
+
+
+def edge_node_covariance(h5f):
+    # Only reads h5f, so it can run alongside other readers (see pipeline.py)
+    receivers = h5f['receivers'][:].astype(int)
+    nedge = receivers.shape[0]
+    ntg = file_ntg(h5f)
+    
+    # For each edge we want cov(edge feature j, receiver node feature j at the
+    # next tg) for j in ncar, v_avg, v_std, over the snapshots where the edge
+    # has cars. Rather than gather all 7*NTG data points per edge we keep
+    # running co-moments (Welford) per edge and feature, so memory is O(nedge)
+    k = np.zeros((nedge,1),dtype=np.float64)
+    mean_x = np.zeros((nedge,3),dtype=np.float64)
+    mean_y = np.zeros((nedge,3),dtype=np.float64)
+    comoment = np.zeros((nedge,3),dtype=np.float64)
+
+    # Sparse edge_features (repack.py --sparse) only hand back active rows
+    edge_snaps = open_snapshots(h5f,'edge_features',ntg)
+    node_snaps = open_snapshots(h5f,'node_features',ntg)
+    for day in range(7):
+        for tg in progressbar(range(0,ntg)):
+            tg_post = (tg+1)%ntg
+            day_post = day
+            if tg == (ntg-1):
+                day_post = (day+1)%7
+            eidx, edges = edge_snaps.rows(day*ntg + tg)
+            nodes_post = node_snaps[day_post*ntg + tg_post]
+
+            has_cars = edges[:,0] > 0
+            active = eidx[has_cars]
+            x = edges[has_cars,:3]
+            y = nodes_post[receivers[active],:3]
+            k[active] += 1
+            dx = x - mean_x[active]
+            mean_x[active] += dx/k[active]
+            mean_y[active] += (y - mean_y[active])/k[active]
+            comoment[active] += dx*(y - mean_y[active])
+
+    # Sample covariance, as np.cov gives; edges with < 2 points stay 0
+    covs = np.zeros((nedge,3),dtype=np.float64)
+    enough = k[:,0] >= 2
+    covs[enough] = comoment[enough]/(k[enough]-1)
+    return covs
+
+
+def CalcMFactor(h5_name):
+    with h5py.File(h5_name,'r') as h5f:
+        M_np = m_factor(h5f)
+    with h5py.File(h5_name,'a') as h5f:
+        replace_dataset(h5f,'M',M_np)
+
+
+def m_factor(h5f):
+    # Only reads h5f, so it can run alongside other readers (see pipeline.py)
+    receivers = h5f['receivers'][:].astype(int)
+    n_node = h5f.attrs['n_nodes']
+    ntg = file_ntg(h5f)
+    M_np = np.zeros((n_node),dtype=np.float64)
+    ks = np.ones((n_node),dtype=np.float64)
+
+    edge_snaps = open_snapshots(h5f,'edge_features',ntg)
+    node_snaps = open_snapshots(h5f,'node_features',ntg)
+    for day in range(7):
+        for tg in progressbar(range(ntg)):
+            tg_post = (tg+1)%ntg
+            day_post = day
+            if tg == (ntg-1):
+                day_post = (day+1)%7
+            nodes_post = node_snaps[day_post*ntg + tg_post]
+            eidx, edges = edge_snaps.rows(day*ntg + tg)
+
+            ncars_n = nodes_post[:,0]
+            # Cars on each node's incoming edges, summed by receiver
+            ncars_e = np.bincount(receivers[eidx],weights=edges[:,0],minlength=n_node)
+
+            # Nodes with nothing happening are skipped
+            active = (ncars_e!=0) | (ncars_n!=0)
+            diff = ncars_n[active] - ncars_e[active]
+            M_np[active] += (diff - M_np[active])/ks[active]
+            ks[active] += 1
+
+    return M_np
+
+
+    
+def nn_features(nodes, edges, covs, M, dtg=DTG):
+    # nn node (4) and edge (13) features of one snapshot, from its node (3)
+    # and edge (4) features, the edge_node_covs and the M factor
+    e_fts = np.zeros((edges.shape[0],13),dtype=np.float64)
+    e_fts[:,:4] = edges
+    e_fts[:,4:7] = covs
+    e_fts[:,7:10] = covs*edges[:,:3]
+    e_fts[:,10] = edges[:,0]*edges[:,1]
+    e_fts[:,11] = (dtg/60.)*edges[:,1]/edges[:,3]
+    e_fts[:,12] = e_fts[:,11] * edges[:,0]
+
+    n_fts = np.zeros((nodes.shape[0],4),dtype=np.float64)
+    n_fts[:,:3] = nodes
+    n_fts[:,3] = M
+    return n_fts, e_fts
+
+
+def create_nn_inputset(h5_name, exact=False, nsample=(50,20), seed=None):
+    # Writes the raw nn_node_features and nn_edge_features once, together with
+    # node_stats, edge_stats and glbl_stats. Normalization happens as snapshots
+    # are read (see snapstore.Normalizer), so the file is marked nn_normalized=False
+    # nsample is the (edge, node) rows sampled per snapshot for the stats
+    h5f = h5py.File(h5_name,'a')
+
+    try:
+        covs = h5f['edge_node_covs'][:]
+    except:
+        print("edge_node_covs DNE, exiting.")
+        h5f.close()
+        return
+
+    try:
+        M = h5f['M'][:]
+    except:
+        print("M factor dataset DNE, exiting.")
+        h5f.close()
+        return
+
+    try:
+        nn_edgegroup = h5f.create_group("nn_edge_features")
+    except:
+        print("nn_edge_features group already exists. Overwriting")
+        del h5f['nn_edge_features']
+        nn_edgegroup = h5f.create_group("nn_edge_features")
+    try:
+        nn_nodegroup = h5f.create_group("nn_node_features")
+    except:
+        print("nn_node_features group already exists. Overwriting")
+        del h5f['nn_node_features']
+        nn_nodegroup = h5f.create_group("nn_node_features")
+    # Normalized copies from earlier versions would now be stale
+    for name in ['nn_glbl_features','nn_edge_features_normed',
+                 'nn_node_features_normed','nn_glbl_features_normed']:
+        if name in h5f:
+            print("Removing stale",name)
+            del h5f[name]
+
+    node_stats, edge_stats = (0, 0., 0.), (0, 0., 0.)
+    rng = np.random.RandomState(seed)
+
+    n_edge = h5f.attrs['n_edges']
+    n_node = h5f.attrs['n_nodes']
+    ntg = file_ntg(h5f)
+    for d in progressbar(range(7)):
+        for tg in range(ntg):
+            n_fts, e_fts = nn_features(read_snap(h5f,'node_features',d,tg,ntg),
+                                       read_snap(h5f,'edge_features',d,tg,ntg), covs, M)
+
+            # Computed in float64, stored in the policy feature dtype (dtypes.py)
+            nn_edgegroup.create_dataset(snapstr(d,tg),data=dtypes.cast("feature",e_fts),
+                                        compression="gzip",compression_opts=6)
+            nn_nodegroup.create_dataset(snapstr(d,tg),data=dtypes.cast("feature",n_fts),
+                                        compression='gzip',compression_opts=6)
+
+            # Stats are merged per snapshot, from all rows if exact
+            # or else from a random sample of nsample rows
+            if exact:
+                e_idx, n_idx = slice(None), slice(None)
+            else:
+                e_idx = rng.choice(n_edge,min(nsample[0],n_edge),replace=False)
+                n_idx = rng.choice(n_node,min(nsample[1],n_node),replace=False)
+            edge_stats = merge_stats(edge_stats,block_stats(e_fts[e_idx]))
+            node_stats = merge_stats(node_stats,block_stats(n_fts[n_idx]))
+
+    node_stats = stats_to_norm(node_stats)
+    edge_stats = stats_to_norm(edge_stats)
+    glbl_stats = np.array(glbl_norm_stats(ntg),dtype=np.float64)
+    save_norm_stats(h5f,node_stats,edge_stats,glbl_stats)
+    h5f.attrs['nn_normalized'] = False
+
+    h5f.close()
+
+
+def glbl_norm_stats(ntg=NTG):
+    # Globals are (day, tg); their norm stats are fixed rather than sampled
+    return [[3.0,2.0], [np.mean(range(ntg)),np.std(range(ntg))]]
+
+
+def save_norm_stats(h5f,node_stats,edge_stats,glbl_stats):
+    for name,stats in [('node_stats',node_stats),('edge_stats',edge_stats),
+                       ('glbl_stats',glbl_stats)]:
+        if name in h5f:
+            del h5f[name]
+        h5f.create_dataset(name,compression="gzip",compression_opts=6,data=stats)
+
+
+def mynorm(nparr,mus,stds):
+    return np.divide(np.subtract(nparr,mus),stds)
+
+def my_unnorm(nparr,norms):
+    return np.add(np.multiply(nparr,norms[1,:]),norms[0,:])
+
+def get_daytimes():
+    daytimes = np.zeros((7*NTG,2),dtype=int)
+    i=0
+    for d in range(7):
+        for tg in range(NTG):
+            daytimes[i] = [d,tg]
+            i+=1
+    return daytimes
+    
+
+def block_stats(arr):
+    # (count, mean, M2) over the rows of an (..., F) block
+    arr = arr.reshape(-1,arr.shape[-1])
+    mean = arr.mean(axis=0)
+    return arr.shape[0], mean, np.square(arr - mean).sum(axis=0)
+
+
+def merge_stats(a, b):
+    # Combine two (count, mean, M2) blocks, Chan et al.'s parallel update
+    na, mean_a, M2_a = a
+    nb, mean_b, M2_b = b
+    if na == 0: return b
+    if nb == 0: return a
+    n = na + nb
+    delta = mean_b - mean_a
+    return n, mean_a + delta*(nb/n), M2_a + M2_b + np.square(delta)*(na*nb/n)
+
+
+def stats_to_norm(stats):
+    # (count, mean, M2) -> (2,F) [mean; std] as stored in node_stats etc.
+    n, mean, M2 = stats
+    return np.array([mean, np.sqrt(M2/n)],dtype=np.float64)
+
+
+def _snapshot_stats(args):
+    # Merged block stats of name over snapshots isnaps; runs in a worker
+    hfname, name, isnaps = args
+    stats = (0, 0., 0.)
+    with h5py.File(hfname,'r') as h5f:
+        ntg = file_ntg(h5f)
+        for i in isnaps:
+            stats = merge_stats(stats, block_stats(read_snap(h5f,name,i//ntg,i%ntg,ntg)))
+    return stats
+
+
+def get_norm_stats(hfname, nproc=1):
+    # Exact node and edge norm stats over every row of every snapshot
+    # Snapshots are reduced as vectorized blocks and merged, split across
+    # nproc worker processes
+    with h5py.File(hfname,'r') as h5f:
+        ntg = file_ntg(h5f)
+    isnaps = np.arange(7*ntg)
+
+    print("Calculating norm stats")
+    norms = {}
+    for name in ['nn_node_features','nn_edge_features']:
+        jobs = [(hfname,name,part) for part in np.array_split(isnaps,nproc)]
+        if nproc > 1:
+            with multiprocessing.Pool(nproc) as pool:
+                parts = pool.map(_snapshot_stats,jobs)
+        else:
+            parts = [_snapshot_stats(jobs[0])]
+        stats = (0, 0., 0.)
+        for part in parts:
+            stats = merge_stats(stats,part)
+        norms[name] = stats_to_norm(stats)
+
+    with h5py.File(hfname,'a') as h5f:
+        save_norm_stats(h5f,norms['nn_node_features'],norms['nn_edge_features'],
+                        np.array(glbl_norm_stats(ntg),dtype=np.float64))
+
+    return
+
+
+# Opt-in timing, hdf5 I/O and memory hooks on the functions above, see profiling.py
+profiling.instrument(globals())
@@ -0,0 +1,254 @@
+'''
+Opt-in profiling of the public functions of graphtools and my_graph_tools
+
+Per function it records call counts, wall time (inclusive of callees),
+the bytes read from and written to hdf5 datasets inside the call
+(logical, uncompressed bytes) and the peak python memory above the
+level at entry (tracemalloc, which includes numpy buffers). tracemalloc
+has one process-wide peak, so peaks are only tracked for calls on the
+main thread: calls on other threads report a peak of 0, and main thread
+peaks include whatever other threads allocate meanwhile. Every call
+is also kept as a trace event, so a run can be opened in chrome://tracing
+or https://ui.perfetto.dev.
+
+Enable it for a whole run with the GRAPHNN_PROFILE environment variable:
+the summary is printed at exit, and if the value ends in .json the trace
+is written there.
+
+    GRAPHNN_PROFILE=prep_trace.json python graphsnapper.py
+
+or for a block of code:
+
+    with profiling.profile(trace="trace.json") as prof:
+        mgt.create_nn_inputset(fname)
+    prof.summary()
+
+While profiling is off, instrumented functions cost one flag check per call.
+'''
+import os
+import sys
+import time
+import json
+import atexit
+import functools
+import threading
+import tracemalloc
+import numpy as np
+
+_active = False
+_stats = None
+_started_tracemalloc = False
+
+
+class Profile(object):
+    def __init__(self):
+        self.funcs = {}   # name -> [calls, seconds, bytes read, bytes written, peak bytes]
+        self.events = []
+        self.t0 = time.time()
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def stack(self):
+        # Per thread, one entry per active call:
+        # [bytes read, bytes written, child peak, traced bytes at entry]
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def add_io(self, nread=0, nwritten=0):
+        if self.stack:
+            self.stack[-1][0] += nread
+            self.stack[-1][1] += nwritten
+
+    def summary(self, sort="seconds", file=None):
+        # Table of every instrumented function that ran, slowest first
+        file = file if file else sys.stdout
+        col = {"calls": 0, "seconds": 1, "read": 2, "written": 3, "peak": 4}[sort]
+        rows = sorted(self.funcs.items(), key=lambda kv: -kv[1][col])
+        print("function".ljust(40), "calls".rjust(8), "seconds".rjust(10), "s/call".rjust(10),
+              "read MB".rjust(10), "written MB".rjust(11), "peak MB".rjust(9), file=file)
+        for name, (calls, secs, nread, nwritten, peak) in rows:
+            print(name[-40:].ljust(40), str(calls).rjust(8), ("%.3f" % secs).rjust(10),
+                  ("%.2e" % (secs/calls)).rjust(10), ("%.1f" % (nread/2**20)).rjust(10),
+                  ("%.1f" % (nwritten/2**20)).rjust(11), ("%.1f" % (peak/2**20)).rjust(9),
+                  file=file)
+
+    def write_trace(self, fname):
+        # Chrome trace event format, complete ("X") events in microseconds
+        with open(fname, 'w') as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+def _enter(prof):
+    # Off the main thread the peak is left alone, as reset_peak would clear it for every thread
+    if threading.current_thread() is not threading.main_thread():
+        prof.stack.append([0, 0, 0, None])
+        return
+    traced, peak = tracemalloc.get_traced_memory()
+    if prof.stack:
+        # The parent's peak so far would be lost in reset_peak
+        prof.stack[-1][2] = max(prof.stack[-1][2], peak)
+    tracemalloc.reset_peak()
+    prof.stack.append([0, 0, 0, traced])
+
+
+def _exit(prof, name, t0, t1):
+    nread, nwritten, child_peak, traced0 = prof.stack.pop()
+    if traced0 is None:
+        # Not tracked, see _enter
+        peak = traced0 = 0
+    else:
+        peak = max(tracemalloc.get_traced_memory()[1], child_peak)
+    if prof.stack:
+        parent = prof.stack[-1]
+        parent[0] += nread
+        parent[1] += nwritten
+        parent[2] = max(parent[2], peak)
+    rec = prof.funcs.setdefault(name, [0, 0., 0, 0, 0])
+    rec[0] += 1
+    rec[1] += t1-t0
+    rec[2] += nread
+    rec[3] += nwritten
+    rec[4] = max(rec[4], peak-traced0)
+    prof.events.append({"name": name, "ph": "X", "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "ts": 1e6*(t0-prof.t0), "dur": 1e6*(t1-t0),
+                        "args": {"read": nread, "written": nwritten,
+                                 "peak": peak-traced0}})
+
+
+def profiled(fn, name=None):
+    name = name if name else fn.__module__+"."+fn.__qualname__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _active:
+            return fn(*args, **kwargs)
+        prof = _stats
+        with prof.lock:
+            _enter(prof)
+        t0 = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            t1 = time.time()
+            with prof.lock:
+                _exit(prof, name, t0, t1)
+    wrapper.__wrapped_profiled__ = True
+    return wrapper
+
+
+def instrument(namespace):
+    # Wraps every public function defined in a module, given its globals()
+    # Internal calls go through the module globals, so they are recorded too
+    modname = namespace["__name__"]
+    for key, obj in list(namespace.items()):
+        if key.startswith("_") or not callable(obj) or isinstance(obj, type):
+            continue
+        if getattr(obj, "__module__", None) != modname or hasattr(obj, "__wrapped_profiled__"):
+            continue
+        namespace[key] = profiled(obj)
+
+
+# hdf5 byte counting, patched onto h5py only while profiling is on
+_h5_originals = {}
+
+
+def _patch_h5py():
+    import h5py
+    Dataset, Group = h5py.Dataset, h5py.Group
+    _h5_originals.update({"getitem": Dataset.__getitem__, "setitem": Dataset.__setitem__,
+                          "read_direct": Dataset.read_direct,
+                          "create_dataset": Group.create_dataset})
+
+    def getitem(self, args, *rest, **kwargs):
+        out = _h5_originals["getitem"](self, args, *rest, **kwargs)
+        if _active:
+            _stats.add_io(nread=getattr(out, "nbytes", 0))
+        return out
+
+    def setitem(self, args, val):
+        _h5_originals["setitem"](self, args, val)
+        if _active:
+            _stats.add_io(nwritten=np.asarray(val).nbytes)
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        _h5_originals["read_direct"](self, dest, source_sel, dest_sel)
+        if _active:
+            _stats.add_io(nread=(dest[dest_sel] if dest_sel else dest).nbytes)
+
+    def create_dataset(self, name, shape=None, dtype=None, data=None, **kwds):
+        out = _h5_originals["create_dataset"](self, name, shape, dtype, data, **kwds)
+        if _active and data is not None:
+            _stats.add_io(nwritten=np.asarray(data).nbytes)
+        return out
+
+    Dataset.__getitem__, Dataset.__setitem__ = getitem, setitem
+    Dataset.read_direct, Group.create_dataset = read_direct, create_dataset
+
+
+def _unpatch_h5py():
+    if not _h5_originals:
+        return
+    import h5py
+    h5py.Dataset.__getitem__ = _h5_originals.pop("getitem")
+    h5py.Dataset.__setitem__ = _h5_originals.pop("setitem")
+    h5py.Dataset.read_direct = _h5_originals.pop("read_direct")
+    h5py.Group.create_dataset = _h5_originals.pop("create_dataset")
+
+
+def enable():
+    global _active, _stats, _started_tracemalloc
+    if _active:
+        return _stats
+    _stats = Profile()
+    _started_tracemalloc = not tracemalloc.is_tracing()
+    if _started_tracemalloc:
+        tracemalloc.start()
+    _patch_h5py()
+    _active = True
+    return _stats
+
+
+def disable():
+    global _active
+    _active = False
+    _unpatch_h5py()
+    if _started_tracemalloc:
+        tracemalloc.stop()
+    return _stats
+
+
+class profile(object):
+    '''
+    Profiles the instrumented calls made inside the block
+    trace, if given, is the file the chrome trace is written to on exit
+    Inside an already running profile (e.g. GRAPHNN_PROFILE) it adds to that one
+    '''
+    def __init__(self, trace=None):
+        self.trace = trace
+        self.owner = False
+
+    def __enter__(self):
+        self.owner = not _active
+        return enable()
+
+    def __exit__(self, *args):
+        prof = disable() if self.owner else _stats
+        if self.trace:
+            prof.write_trace(self.trace)
+
+
+def _profile_at_exit(target):
+    prof = disable()
+    prof.summary(file=sys.stderr)
+    if target.endswith(".json"):
+        prof.write_trace(target)
+        print("Profile trace written to", target, file=sys.stderr)
+
+
+_env = os.environ.get("GRAPHNN_PROFILE", "")
+if _env and _env != "0":
+    enable()
+    atexit.register(_profile_at_exit, _env)
@@ -0,0 +1,247 @@
+'''
+Repack the per-snapshot groups of an nn_inputs hdf5 file
+(e.g. nn_edge_features/day0tg0 ... day6tg{NTG-1}) into single
+stacked (7*NTG, n, F) datasets, snapshot index day*NTG + tg.
+
+Groups named in --sparse are instead stored CSR over snapshots, keeping
+the rows that are active (first feature, the car count, above zero) or
+differ from each row's inactive value (see snapstore.SparseSnapshots). Disk use and read time then scale with
+the number of active nodes/edges rather than with n.
+
+Usage:
+    python repack.py [options] src.hdf5 dst.hdf5
+    python repack.py --bench src.hdf5 dst.hdf5
+    python repack.py --check src.hdf5 dst.hdf5
+
+Options:
+    --compression  none, lzf, gzip or gzip:<level> (default lzf)
+    --chunk-snaps  snapshots per chunk (default 1, one snapshot per read)
+    --groups       comma separated groups to stack (default all snapshot groups)
+    --sparse       comma separated groups to store sparse instead, e.g.
+                   node_features,edge_features,nn_node_features,nn_edge_features
+    --bench        time random snapshot reads from src against dst
+    --nread        number of reads in the benchmark (default 500)
+    --check        compare every snapshot of the sparse groups of dst with src,
+                   and the covariance and M factor computed from each
+'''
+import sys, getopt
+import time
+import numpy as np
+import h5py
+
+from snapstore import snapstr, read_snap, read_snap_rows, is_sparse, is_stacked, SparseSnapshots
+import prep
+
+
+def parse_compression(spec):
+    # "none" | "lzf" | "gzip" | "gzip:4" -> create_dataset kwargs
+    if spec in (None, "", "none"):
+        return {}
+    if spec.startswith("gzip"):
+        level = int(spec.split(":")[1]) if ":" in spec else 4
+        return {"compression": "gzip", "compression_opts": level}
+    return {"compression": spec}
+
+
+def snapshot_groups(h5f, ntg):
+    # Every top-level group laid out as one dataset per snapshot
+    names = []
+    for name, obj in h5f.items():
+        if isinstance(obj, h5py.Group) and snapstr(0,0) in obj \
+                and len(obj) == 7*ntg:
+            names.append(name)
+    return names
+
+
+def repack_group(src, dst, name, ntg, chunk_snaps=1, compression=None):
+    grp = src[name]
+    first = grp[snapstr(0,0)]
+    nsnap = 7*ntg
+    chunk_snaps = max(1, min(chunk_snaps, nsnap))
+    dset = dst.create_dataset(name, shape=(nsnap,)+first.shape, dtype=first.dtype,
+                              chunks=(chunk_snaps,)+first.shape,
+                              **parse_compression(compression))
+    dset.attrs["layout"] = "stacked"
+    # Fill one chunk row at a time so each chunk is compressed exactly once
+    buf = np.empty((chunk_snaps,)+first.shape, dtype=first.dtype)
+    for i0 in range(0, nsnap, chunk_snaps):
+        i1 = min(i0+chunk_snaps, nsnap)
+        for i in range(i0, i1):
+            grp[snapstr(i//ntg, i%ntg)].read_direct(buf[i-i0])
+        dset[i0:i1] = buf[:i1-i0]
+    return dset
+
+
+def sparse_base(src, name, ntg):
+    # Each row's inactive value: its value in the snapshot where its
+    # first feature (the car count) is smallest. A row busy in every
+    # snapshot gets a non-zero base, so active rows are always stored
+    # regardless (see repack_sparse)
+    nsnap = 7*ntg
+    base = read_snap(src, name, 0, 0, ntg).copy()
+    for i in range(1, nsnap):
+        arr = read_snap(src, name, i//ntg, i%ntg, ntg)
+        lower = arr[:,0] < base[:,0]
+        base[lower] = arr[lower]
+    return base
+
+
+def repack_sparse(src, dst, name, ntg, chunk_rows=4096, compression=None):
+    # Writes name as a sparse group (see snapstore.SparseSnapshots) from any layout
+    nsnap = 7*ntg
+    base = sparse_base(src, name, ntg)
+    grp = dst.create_group(name)
+    grp.attrs["layout"] = "sparse"
+    grp.create_dataset("base", data=base, **parse_compression(compression))
+    nft = base.shape[1]
+    indices = grp.create_dataset("indices", shape=(0,), maxshape=(None,), dtype=np.int32,
+                                 chunks=(chunk_rows,), **parse_compression(compression))
+    values = grp.create_dataset("values", shape=(0, nft), maxshape=(None, nft), dtype=base.dtype,
+                                chunks=(chunk_rows, nft), **parse_compression(compression))
+    indptr = np.zeros(nsnap+1, dtype=np.int64)
+    for i in range(nsnap):
+        idx, rows = read_snap_rows(src, name, i//ntg, i%ntg, ntg)
+        # Active rows are kept even when they equal the base, so rows()
+        # hands back every row with cars (see prep.edge_node_covariance)
+        keep = (rows[:,0] > 0) | np.any(rows != base[idx], axis=1)
+        idx, rows = idx[keep], rows[keep]
+        lo, hi = indptr[i], indptr[i]+len(idx)
+        indices.resize((hi,))
+        values.resize((hi, nft))
+        indices[lo:hi] = idx
+        values[lo:hi] = rows
+        indptr[i+1] = hi
+    grp.create_dataset("indptr", data=indptr)
+    return grp
+
+
+def repack(src_name, dst_name, groups=None, chunk_snaps=1, compression="lzf", sparse=()):
+    with h5py.File(src_name, 'r') as src, h5py.File(dst_name, 'w') as dst:
+        ntg = int(src.attrs['nTG'])
+        dst.attrs.update(src.attrs)
+        if not groups:
+            groups = snapshot_groups(src, ntg)
+        for name in src:
+            t0 = time.time()
+            if name in sparse:
+                grp = repack_sparse(src, dst, name, ntg, compression=compression)
+                print("Sparsified", name, "in", round(time.time()-t0, 2), "s,",
+                      "%.1f%%" % (100.*grp['indices'].shape[0]/(7*ntg*grp['base'].shape[0])),
+                      "of rows stored")
+            elif name in groups:
+                repack_group(src, dst, name, ntg, chunk_snaps, compression)
+                print("Stacked", name, "in", round(time.time()-t0, 2), "s")
+            else:
+                src.copy(name, dst)
+    return groups
+
+
+def layout(h5f, name):
+    # "sparse", "stacked" or "grouped" (one dataset per snapshot)
+    if is_sparse(h5f, name):
+        return "sparse"
+    return "stacked" if is_stacked(h5f, name) else "grouped"
+
+
+def bench_read(h5_name, groups, nread=500, seed=0):
+    # Mean seconds per random snapshot read, and the layout read, per group
+    times, layouts = {}, {}
+    with h5py.File(h5_name, 'r') as h5f:
+        ntg = int(h5f.attrs['nTG'])
+        idxs = np.random.RandomState(seed).randint(0, 7*ntg, nread)
+        for name in groups:
+            layouts[name] = layout(h5f, name)
+            t0 = time.time()
+            for i in idxs:
+                read_snap(h5f, name, i//ntg, i%ntg, ntg)
+            times[name] = (time.time()-t0)/nread
+    return times, layouts
+
+
+def check_sparse(src_name, dst_name):
+    '''
+    Max abs differences between the dense src and the sparse groups of
+    its repack dst: every snapshot read back, and the edge_node_covs and
+    M factor (which only see SparseSnapshots.rows) when edge_features and
+    node_features are sparse. Raises ValueError if a snapshot's rows
+    miss one of its active rows
+    '''
+    diffs = {}
+    with h5py.File(src_name, 'r') as src, h5py.File(dst_name, 'r') as dst:
+        ntg = int(src.attrs['nTG'])
+        names = [name for name in dst if is_sparse(dst, name)]
+        for name in names:
+            snaps = SparseSnapshots(dst[name])
+            diff = 0.
+            for i in range(7*ntg):
+                dense = read_snap(src, name, i//ntg, i%ntg, ntg)
+                idx, _ = snaps.rows(i)
+                missing = np.setdiff1d(np.flatnonzero(dense[:,0] > 0), idx)
+                if len(missing):
+                    raise ValueError(name+" snapshot "+str(i)+" is missing active rows "
+                                     +str(missing[:10]))
+                diff = max(diff, np.abs(snaps[i] - dense).max())
+            diffs[name] = diff
+        if "edge_features" in names and "node_features" in names:
+            diffs["edge_node_covs"] = np.abs(prep.edge_node_covariance(dst)
+                                             - prep.edge_node_covariance(src)).max()
+            diffs["M"] = np.abs(prep.m_factor(dst) - prep.m_factor(src)).max()
+    return diffs
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["compression=", "chunk-snaps=",
+                                                      "groups=", "sparse=", "bench", "nread=",
+                                                      "check"])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+
+    compression = "lzf"
+    chunk_snaps = 1
+    groups = None
+    sparse = ()
+    bench = False
+    check = False
+    nread = 500
+    for opt, arg in opts:
+        if opt == "--compression":
+            compression = arg
+        elif opt == "--chunk-snaps":
+            chunk_snaps = int(arg)
+        elif opt == "--groups":
+            groups = arg.split(",")
+        elif opt == "--sparse":
+            sparse = tuple(arg.split(","))
+        elif opt == "--bench":
+            bench = True
+        elif opt == "--nread":
+            nread = int(arg)
+        elif opt == "--check":
+            check = True
+
+    if len(args) != 2:
+        print(__doc__)
+        sys.exit(2)
+    src_name, dst_name = args
+
+    if check:
+        for name, diff in check_sparse(src_name, dst_name).items():
+            print(name.ljust(24), "max abs difference", diff)
+    elif not bench:
+        repack(src_name, dst_name, groups, chunk_snaps, compression, sparse)
+    else:
+        if not groups:
+            with h5py.File(dst_name, 'r') as h5f:
+                groups = [name for name in h5f if h5f[name].attrs.get("layout")
+                          in ("stacked", "sparse")]
+        t_src, l_src = bench_read(src_name, groups, nread)
+        t_dst, l_dst = bench_read(dst_name, groups, nread)
+        print("group".ljust(24), "src layout".rjust(10), "ms".rjust(9),
+              "dst layout".rjust(10), "ms".rjust(9), "speedup".rjust(9))
+        for name in groups:
+            print(name.ljust(24), l_src[name].rjust(10), ("%.3f" % (1e3*t_src[name])).rjust(9),
+                  l_dst[name].rjust(10), ("%.3f" % (1e3*t_dst[name])).rjust(9),
+                  ("%.1fx" % (t_src[name]/t_dst[name])).rjust(9))
@@ -0,0 +1,93 @@
+'''
+Replay an OUT0 file as a live GPS stream, for stream.py
+
+The fixes of all drivers are merged into time order and written one per
+line as "ID,lon,lat,timeU70,sent", sent being the wall time (seconds)
+the line went out. Lines are paced so that stream time runs speedup
+times faster than real time; fixes that fall due together go out in one
+write.
+
+Usage:
+    python replay.py [options] OUT0
+
+Options:
+    --speedup  stream seconds per wall second (default 60)
+    --port     serve the stream to one client on localhost:port
+               (stream.py --socket localhost:port)
+    --out      append the stream to this file instead (stream.py --follow)
+    --limit    stop after this many fixes
+'''
+import sys, getopt
+import time
+import socket
+import numpy as np
+
+
+def read_out0(fname):
+    # Every fix of every driver: ids (bytes), lon, lat, timeU70, in time order
+    ids, rows = [], []
+    with open(fname, 'rb') as f:
+        for line in f:
+            driver, _, data = line.rstrip(b"\n").partition(b"  ")
+            for pt in data.split(b"|"):
+                w = pt.split(b",")
+                if len(w) < 3:
+                    continue
+                ids.append(driver)
+                rows.append((float(w[0]), float(w[1]), float(w[2])))
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    order = np.argsort(rows[:,2], kind="stable")
+    return np.array(ids, dtype=object)[order], rows[order]
+
+
+def replay(write, ids, rows, speedup=60., wait=0.05):
+    # Calls write(bytes) with the lines due so far until every fix is out
+    # Returns the number of fixes sent and the wall time it took
+    wall0 = time.time()
+    due = wall0 + (rows[:,2] - rows[0,2])/1000./speedup
+    i = 0
+    while i < len(rows):
+        now = time.time()
+        j = np.searchsorted(due, now, side="right")
+        if j == i:
+            time.sleep(min(due[i] - now, wait))
+            continue
+        sent = b"%.6f" % time.time()
+        write(b"".join(b"%s,%.6f,%.6f,%d,%s\n" % (ids[k], rows[k,0], rows[k,1], rows[k,2], sent)
+                       for k in range(i, j)))
+        i = j
+    return len(rows), time.time() - wall0
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["speedup=", "port=", "out=", "limit="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    opts = dict(opts)
+    if len(args) != 1 or ("--port" in opts) == ("--out" in opts):
+        print(__doc__)
+        sys.exit(2)
+
+    ids, rows = read_out0(args[0])
+    if "--limit" in opts:
+        ids, rows = ids[:int(opts["--limit"])], rows[:int(opts["--limit"])]
+    speedup = float(opts.get("--speedup", 60.))
+    print(len(rows), "fixes over", "%.1f" % ((rows[-1,2] - rows[0,2])/60000.),
+          "stream minutes, at", speedup, "x")
+
+    if "--port" in opts:
+        server = socket.create_server(("localhost", int(opts["--port"])))
+        print("Waiting for a client on port", opts["--port"])
+        conn, _ = server.accept()
+        try:
+            nsent, secs = replay(conn.sendall, ids, rows, speedup)
+        finally:
+            conn.close()
+            server.close()
+    else:
+        with open(opts["--out"], 'ab', buffering=0) as f:
+            nsent, secs = replay(f.write, ids, rows, speedup)
+    print("Sent", nsent, "fixes in", "%.1f" % secs, "s")
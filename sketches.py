@@ -0,0 +1,70 @@
+'''
+Fixed-bin speed histograms per cell (node, or edge and direction)
+
+Every cell has the same bins, so a histogram is one (ncells, nbins)
+count array: adding a block of speeds is a single bincount, and merging
+two histograms (other snapshots, other workers, a whole week) is a sum;
+synth.write_nn_inputs merges every snapshot into week percentiles.
+Memory per cell is fixed by the bins, however many speeds arrive.
+Quantiles are interpolated linearly inside the bin they fall in, so
+they are exact to within a bin width (2 km/h by default); speeds beyond
+the last edge are kept in the last bin.
+
+hist = SpeedHistogram(n_nodes)
+hist.add(node_ids, speeds)
+p10, p50, p90 = hist.quantiles().T
+'''
+import numpy as np
+
+
+# km/hr, as gen_vels.py computes speeds
+BINS = np.arange(0., 162., 2.)
+PERCENTILES = (0.1, 0.5, 0.9)
+
+
+class SpeedHistogram(object):
+    def __init__(self, ncells, bins=BINS, counts=None):
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.nbins = len(self.bins) - 1
+        self.counts = np.zeros((ncells, self.nbins), dtype=np.uint32) if counts is None else counts
+
+    @property
+    def ncells(self):
+        return self.counts.shape[0]
+
+    def add(self, cells, v):
+        # One speed v[i] into cell cells[i], for every i
+        # Counted per distinct (cell, bin), so the temporaries scale with len(v) not ncells
+        # Keys are distinct, so a fancy-indexed += counts each once, on counts of any strides
+        b = np.clip(np.searchsorted(self.bins, v, side='right') - 1, 0, self.nbins-1)
+        keys, n = np.unique(np.asarray(cells, dtype=np.int64)*self.nbins + b, return_counts=True)
+        self.counts[keys // self.nbins, keys % self.nbins] += n.astype(self.counts.dtype)
+
+    def merge(self, other):
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError("Histograms with different bins can't be merged")
+        self.counts += other.counts
+        return self
+
+    def clear(self):
+        self.counts[:] = 0
+
+    def total(self):
+        return self.counts.sum(axis=1)
+
+    def quantiles(self, qs=PERCENTILES):
+        # (ncells, len(qs)) speeds, 0 for empty cells as for the mean features
+        counts = self.counts.astype(np.float64)
+        cum = np.cumsum(counts, axis=1)
+        total = cum[:,-1:]
+        out = np.zeros((self.ncells, len(qs)), dtype=np.float64)
+        for j, q in enumerate(qs):
+            target = q*total
+            b = np.minimum((cum < target).sum(axis=1), self.nbins-1)
+            rows = np.arange(self.ncells)
+            below = cum[rows,b] - counts[rows,b]
+            frac = np.where(counts[rows,b] > 0,
+                            (target[:,0] - below)/np.maximum(counts[rows,b], 1.), 0.)
+            out[:,j] = self.bins[b] + np.clip(frac, 0., 1.)*(self.bins[b+1] - self.bins[b])
+        out[total[:,0] == 0] = 0.
+        return out
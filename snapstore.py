@@ -0,0 +1,397 @@
+import os
+import hashlib
+import numpy as np
+import h5py
+
+import dtypes
+
+
+def snapstr(day, tg):
+    return 'day'+str(day)+'tg'+str(tg)
+
+
+def is_raw(h5f):
+    # create_nn_inputset now stores raw nn features plus their stats and
+    # marks the file nn_normalized=False. Older files were normalized in place
+    return not h5f.attrs.get('nn_normalized', True)
+
+
+def feature_groups(normalize=True, raw=False):
+    # The (node, edge, global) groups snap2graph reads from
+    # Raw files have no nn_glbl_features; glbl_features is normalized on read
+    if not normalize:
+        return 'node_features', 'nn_edge_features', 'glbl_features'
+    if raw:
+        return 'nn_node_features', 'nn_edge_features', 'glbl_features'
+    return 'nn_node_features', 'nn_edge_features', 'nn_glbl_features'
+
+
+def norm_on_read(kind, normalize=True, raw=False):
+    # Whether the "nodes", "edges" or "globals" group of feature_groups is
+    # normalized as it is read. Only raw files need it: all three with
+    # normalize, and with normalize=False nn_edge_features, which older
+    # files hold normalized in place
+    return raw and (normalize or kind == "edges")
+
+
+class Normalizer(object):
+    '''
+    Lazy (x - mean)/std transform of node, edge and global features,
+    from the (2,F) node_stats, edge_stats and glbl_stats of an input file
+
+    Works on any (..., F) array, so a whole (nsnap, n, F) stack is done in
+    one pass. Arrays narrower than F (e.g. 3 predicted edge features) use
+    the leading columns of the stats. Zero stds are treated as 1.
+    '''
+    def __init__(self, node_stats, edge_stats, glbl_stats):
+        self.stats = {}
+        for kind, stats in (("nodes", node_stats), ("edges", edge_stats),
+                            ("globals", glbl_stats)):
+            stats = np.asarray(stats, dtype=np.float64)
+            std = np.where(stats[1] > 0, stats[1], 1.)
+            self.stats[kind] = (stats[0], std, 1./std)
+
+    @classmethod
+    def from_h5(cls, h5f):
+        return cls(h5f['node_stats'][:], h5f['edge_stats'][:], h5f['glbl_stats'][:])
+
+    def norm(self, kind, arr, out=None):
+        mean, std, inv_std = self.stats[kind]
+        nft = arr.shape[-1]
+        out = np.subtract(arr, mean[:nft], out=out)
+        return np.multiply(out, inv_std[:nft], out=out)
+
+    def unnorm(self, kind, arr, out=None):
+        mean, std, inv_std = self.stats[kind]
+        nft = arr.shape[-1]
+        out = np.multiply(arr, std[:nft], out=out)
+        return np.add(out, mean[:nft], out=out)
+
+
+def is_stacked(h5f, name):
+    # Repacked files (see repack.py) hold each feature set as a
+    # single (nsnap, n, F) dataset instead of a group of snapshots
+    return isinstance(h5f[name], h5py.Dataset)
+
+
+def is_sparse(h5f, name):
+    # Sparse layout (repack.py --sparse), see SparseSnapshots
+    obj = h5f[name]
+    return isinstance(obj, h5py.Group) and obj.attrs.get("layout") == "sparse"
+
+
+class SparseSnapshots(object):
+    '''
+    A feature set stored CSR over snapshots: only the rows of each
+    snapshot that are active (first feature above zero) or differ from
+    a static base row are kept
+
+        base     (n, F)       each row's value whenever it is inactive,
+                              e.g. zero counts and speeds but its edge length
+        indptr   (nsnap+1,)   snapshot isnap owns entries indptr[isnap]:indptr[isnap+1]
+        indices  (nnz,)       row of each entry within its snapshot
+        values   (nnz, F)     those rows
+
+    Indexing with a snapshot gives the dense (n, F) array, like a stacked
+    dataset; rows(isnap) gives the sparse (indices, values) form
+    '''
+    def __init__(self, grp):
+        self.grp = grp
+        self.base = grp['base'][:]
+        self.indptr = grp['indptr'][:]
+        self.shape = (len(self.indptr)-1,) + self.base.shape
+        self.dtype = grp['values'].dtype
+
+    def rows(self, isnap):
+        lo, hi = self.indptr[isnap], self.indptr[isnap+1]
+        return self.grp['indices'][lo:hi], self.grp['values'][lo:hi]
+
+    def __getitem__(self, isnap):
+        idx, vals = self.rows(isnap)
+        out = self.base.copy()
+        out[idx] = vals
+        return out
+
+    def read_all(self, out=None):
+        # Every snapshot, densely, with one read per dataset
+        if out is None:
+            out = np.empty(self.shape, dtype=dtypes.dtype("feature"))
+        out[:] = self.base
+        isnap = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        out[isnap, self.grp['indices'][:]] = self.grp['values'][:]
+        return out
+
+
+class DenseSnapshots(object):
+    # The stacked and per-snapshot group layouts behind the SparseSnapshots interface
+    def __init__(self, h5f, name, ntg):
+        self.h5f, self.name, self.ntg = h5f, name, ntg
+
+    def __getitem__(self, isnap):
+        return read_snap(self.h5f, self.name, isnap//self.ntg, isnap%self.ntg, self.ntg)
+
+    def rows(self, isnap):
+        arr = self[isnap]
+        return np.arange(arr.shape[0]), arr
+
+
+def open_snapshots(h5f, name, ntg):
+    # Snapshot reader for any layout: reader[isnap] is dense, reader.rows(isnap)
+    # sparse where the layout is. Use it to loop over many snapshots
+    if is_sparse(h5f, name):
+        return SparseSnapshots(h5f[name])
+    return DenseSnapshots(h5f, name, ntg)
+
+
+def read_snap(h5f, name, day, tg, ntg):
+    # One dense snapshot from any layout
+    if is_stacked(h5f, name):
+        return h5f[name][day*ntg + tg]
+    if is_sparse(h5f, name):
+        idx, vals = read_snap_rows(h5f, name, day, tg, ntg)
+        out = h5f[name]['base'][:]
+        out[idx] = vals
+        return out
+    return h5f[name][snapstr(day,tg)][:]
+
+
+def read_snap_rows(h5f, name, day, tg, ntg):
+    # (row indices, rows) of one snapshot. For a sparse feature set these
+    # are only its active rows; otherwise every row
+    if is_sparse(h5f, name):
+        grp = h5f[name]
+        isnap = day*ntg + tg
+        lo, hi = grp['indptr'][isnap:isnap+2]
+        return grp['indices'][lo:hi], grp['values'][lo:hi]
+    arr = read_snap(h5f, name, day, tg, ntg)
+    return np.arange(arr.shape[0]), arr
+
+
+def read_stack(h5f, name, ntg, out=None):
+    '''
+    Read the per-snapshot datasets name/day{d}tg{tg} into one
+    contiguous (7*ntg, n, F) array of the policy feature dtype,
+    snapshot index day*ntg + tg
+    If out is given (e.g. a memmap) it is filled in place
+    '''
+    if is_stacked(h5f, name):
+        dset = h5f[name]
+        if out is None:
+            out = np.empty(dset.shape, dtype=dtypes.dtype("feature"))
+        dset.read_direct(out)
+        return out
+    if is_sparse(h5f, name):
+        return SparseSnapshots(h5f[name]).read_all(out)
+
+    grp = h5f[name]
+    if out is None:
+        shape = grp[snapstr(0,0)].shape
+        out = np.empty((7*ntg,)+shape, dtype=dtypes.dtype("feature"))
+    for day in range(7):
+        for tg in range(ntg):
+            grp[snapstr(day,tg)].read_direct(out[day*ntg + tg])
+    return out
+
+
+def read_snapdict(h5f, day, tg, ntg, normalize=True, senders=None, receivers=None,
+                  normalizer=None):
+    # graph_nets data dict for one snapshot, in either layout
+    # Pass senders/receivers (and a Normalizer) to skip re-reading them
+    # Features come back in the policy feature dtype (see dtypes.py)
+    raw = is_raw(h5f)
+    node_grp, edge_grp, glbl_grp = feature_groups(normalize, raw)
+    node_arr = dtypes.cast("feature", read_snap(h5f, node_grp, day, tg, ntg))
+    edge_arr = dtypes.cast("feature", read_snap(h5f, edge_grp, day, tg, ntg))
+    glbl_arr = dtypes.cast("feature", read_snap(h5f, glbl_grp, day, tg, ntg)[0])
+    if raw:
+        normalizer = normalizer if normalizer else Normalizer.from_h5(h5f)
+        if norm_on_read("nodes", normalize, raw):
+            node_arr = normalizer.norm("nodes", node_arr, out=node_arr)
+        if norm_on_read("edges", normalize, raw):
+            edge_arr = normalizer.norm("edges", edge_arr, out=edge_arr)
+        if norm_on_read("globals", normalize, raw):
+            glbl_arr = normalizer.norm("globals", glbl_arr)
+    return {
+        "globals": glbl_arr,
+        "nodes": node_arr,
+        "edges": edge_arr,
+        "senders": dtypes.cast("index", h5f['senders'][:]) if senders is None else senders,
+        "receivers": dtypes.cast("index", h5f['receivers'][:]) if receivers is None else receivers,
+        "n_node": node_arr.shape[0],
+        "n_edge": edge_arr.shape[0]
+    }
+
+
+def snap_shape(h5f, name):
+    # Shape of a single snapshot of name, in any layout
+    if is_stacked(h5f, name):
+        return h5f[name].shape[1:]
+    if is_sparse(h5f, name):
+        return h5f[name]['base'].shape
+    return h5f[name][snapstr(0,0)].shape
+
+
+class NormedDataset(object):
+    # Normalizes a stacked (or SparseSnapshots) raw dataset as it is read
+    def __init__(self, dset, normalizer, kind):
+        self.dset = dset
+        self.normalizer = normalizer
+        self.kind = kind
+        self.shape = dset.shape
+
+    def __getitem__(self, idx):
+        arr = np.asarray(self.dset[idx], dtype=dtypes.dtype("feature"))
+        return self.normalizer.norm(self.kind, arr, out=arr)
+
+
+class SnapshotStore(object):
+    '''
+    All snapshots of an nn_inputs hdf5 file, loaded once
+
+    Static topology (senders, receivers) is read a single time and the
+    node, edge and global features are held as contiguous (nsnap, n, F)
+    arrays, either in memory or as .npy memmaps under mmap_dir.
+    data_dict and graph return views into these arrays, so fetching a
+    snapshot costs no hdf5 reads and no copies. Raw input files are
+    normalized once, as the stacks are loaded. Features are held in the
+    dtypes.py policy feature dtype.
+
+    With preload=False a repacked (stacked or sparse) file is instead
+    kept open and snapshots are read (and normalized) on demand through
+    an hdf5 chunk cache of cache_mb megabytes. Call close() when done.
+
+    store = SnapshotStore(inputfname)
+    graph = store.graph(day, tg)
+    '''
+    def __init__(self, h5_name, normalize=True, mmap_dir=None, ntg=None,
+                 preload=True, cache_mb=64):
+        self.h5_name = h5_name
+        self.normalize = normalize
+        self.h5f = None
+        if preload:
+            with h5py.File(h5_name, 'r') as h5f:
+                self._read_header(h5f, ntg)
+                node_grp, edge_grp, glbl_grp = feature_groups(normalize, self.raw)
+                self.nodes = self._load(h5f, node_grp, "nodes", mmap_dir)
+                self.edges = self._load(h5f, edge_grp, "edges", mmap_dir)
+                # Global datasets are (1, F), so globals[isnap] is GraphsTuple-shaped
+                self.globals = self._load(h5f, glbl_grp, "globals", mmap_dir)
+        else:
+            self.h5f = h5py.File(h5_name, 'r', rdcc_nbytes=int(cache_mb*2**20), rdcc_nslots=10007)
+            self._read_header(self.h5f, ntg)
+            node_grp, edge_grp, glbl_grp = feature_groups(normalize, self.raw)
+            for name in (node_grp, edge_grp, glbl_grp):
+                if not (is_stacked(self.h5f, name) or is_sparse(self.h5f, name)):
+                    self.h5f.close()
+                    raise ValueError(name+" is not stacked, run repack.py or use preload=True")
+            # These index like the arrays above, one snapshot per read
+            self.nodes = self._view(self._dataset(node_grp), "nodes")
+            self.edges = self._view(self._dataset(edge_grp), "edges")
+            self.globals = self._view(self._dataset(glbl_grp), "globals")
+        self.nsnap = self.nodes.shape[0]
+        self.n_node = np.array([self.nodes.shape[1]], dtype=np.int32)
+        self.n_edge = np.array([self.edges.shape[1]], dtype=np.int32)
+
+    def _read_header(self, h5f, ntg):
+        self.ntg = int(ntg if ntg else h5f.attrs['nTG'])
+        self.senders = h5f['senders'][:].astype(np.int32)
+        self.receivers = h5f['receivers'][:].astype(np.int32)
+        self.raw = is_raw(h5f)
+        self.normalizer = Normalizer.from_h5(h5f) if self.raw else None
+
+    def _dataset(self, name):
+        if is_sparse(self.h5f, name):
+            return SparseSnapshots(self.h5f[name])
+        return self.h5f[name]
+
+    def _view(self, dset, kind):
+        if norm_on_read(kind, self.normalize, self.raw):
+            return NormedDataset(dset, self.normalizer, kind)
+        return dset
+
+    def close(self):
+        if self.h5f:
+            self.h5f.close()
+            self.h5f = None
+
+    def _load(self, h5f, name, kind, mmap_dir):
+        normed = norm_on_read(kind, self.normalize, self.raw)
+        if not mmap_dir:
+            arr = read_stack(h5f, name, self.ntg)
+            if normed:
+                self.normalizer.norm(kind, arr, out=arr)
+            return arr
+
+        # Cache files are keyed on the source file's absolute path, mtime (ns)
+        # and size, so neither a rewritten input set nor another file of the
+        # same name is served stale
+        path = os.path.abspath(self.h5_name)
+        st = os.stat(path)
+        stamp = (os.path.basename(path)+'_'
+                 +hashlib.blake2b(path.encode(), digest_size=8).hexdigest()
+                 +'_'+str(st.st_mtime_ns)+'_'+str(st.st_size))
+        cachedir = os.path.join(mmap_dir, stamp)
+        feature = dtypes.dtype("feature")
+        fname = os.path.join(cachedir, name+('_normed' if normed else '')
+                             +('' if feature == np.float64 else '_'+feature.name)+'.npy')
+        if not os.path.exists(fname):
+            os.makedirs(cachedir, exist_ok=True)
+            shape = (7*self.ntg,) + snap_shape(h5f, name)
+            tmpname = fname+'.tmp.npy'
+            arr = np.lib.format.open_memmap(tmpname, mode='w+', dtype=feature, shape=shape)
+            read_stack(h5f, name, self.ntg, out=arr)
+            if normed:
+                self.normalizer.norm(kind, arr, out=arr)
+            arr.flush()
+            del arr
+            os.replace(tmpname, fname)
+        return np.load(fname, mmap_mode='r')
+
+    def index(self, day, tg):
+        return day*self.ntg + tg
+
+    def data_dict(self, day, tg):
+        i = self.index(day, tg)
+        return {
+            "globals": self.globals[i][0],
+            "nodes": self.nodes[i],
+            "edges": self.edges[i],
+            "senders": self.senders,
+            "receivers": self.receivers,
+            "n_node": self.n_node[0],
+            "n_edge": self.n_edge[0]
+        }
+
+    def graph(self, day, tg):
+        # Single-graph GraphsTuple, equivalent to utils_np.data_dicts_to_graphs_tuple
+        # on data_dict(day, tg) but without the concatenation copies
+        # graph_nets is only imported here, so data-prep imports of snapstore skip it
+        from graph_nets import graphs
+        i = self.index(day, tg)
+        return graphs.GraphsTuple(nodes=self.nodes[i],
+                                  edges=self.edges[i],
+                                  globals=self.globals[i],
+                                  senders=self.senders,
+                                  receivers=self.receivers,
+                                  n_node=self.n_node,
+                                  n_edge=self.n_edge)
+
+    def shared_batch(self, daytimes):
+        '''
+        Shared-topology batch of the (day, tg) pairs in daytimes: nodes
+        (B, n_node, F), edges (B, n_edge, F) and globals (B, G) over the one
+        senders/receivers, for EncodeProcessDecode(shared_topology=True)
+        '''
+        from graph_nets import graphs
+        idx = [self.index(day, tg) for day, tg in daytimes]
+        if isinstance(self.nodes, np.ndarray):
+            take = lambda arr: arr[idx]
+        else:
+            take = lambda dset: np.stack([dset[i] for i in idx])
+        return graphs.GraphsTuple(nodes=take(self.nodes),
+                                  edges=take(self.edges),
+                                  globals=take(self.globals)[:,0],
+                                  senders=self.senders,
+                                  receivers=self.receivers,
+                                  n_node=self.n_node,
+                                  n_edge=self.n_edge)
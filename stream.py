@@ -0,0 +1,325 @@
+'''
+Live snapshots from a stream of GPS fixes
+
+Fixes arrive one per line as "ID,lon,lat,timeU70[,sent]", either from a
+TCP socket or from a file that is being appended to; replay.py serves an
+OUT0 file this way. For each driver the last fix is kept, and a new fix
+within tcutoff minutes of it makes a velocity exactly as gen_vels.add
+does: it belongs to the day and tg of the earlier fix. Velocities are
+snapped onto the graph of an nn_inputs file in micro-batches, and their
+per node and edge count, sum and sum of squares are added to the open
+(day, tg) (graphtools.cell_sums).
+
+A time group closes once stream time (the latest timeU70 seen) passes
+its end by tcutoff, since none of its velocities can arrive after that.
+Its statistics are then turned into nn features with the file's
+edge_node_covs and M (prep.nn_features), normalized with the file's
+stats and handed on as a GraphsTuple, quiet time groups included.
+Velocities that arrive for an already closed time group are counted as
+late and dropped.
+
+Per snapshot the latency from receiving the fix that closed it to its
+graph being ready is recorded, and also from that fix's send stamp if
+it has one (end to end, through the replay socket or file).
+
+Usage:
+    python stream.py [options] inputfname
+
+Options:
+    --socket    host:port to read fixes from (e.g. replay.py --port)
+    --follow    file to tail for fixes (e.g. replay.py --out)
+    --idle      with --follow, stop after this many seconds without new lines
+    --tglen     minutes per time group (default 10, must match inputfname)
+    --tcutoff   max minutes between fixes for a velocity (default 1.0)
+    --velmin    min speed in km/hr (default 0.0)
+    --snapping  radius or segment; defaults to, and must match, the
+                "snapping" attr inputfname was built with (radius if unset)
+    --weights   exported .npz (my_graph_tools.export_numpy_weights) to
+                run each snapshot through npmodel.NumpyForecaster
+'''
+import sys, getopt
+import time
+import socket
+import numpy as np
+import pandas as pd
+import h5py
+
+import graphtools as gt
+import prep
+import dtypes
+from snapstore import Normalizer
+from npmodel import NumpyForecaster
+
+
+TZ_MS = gt.TZ_MS
+DAY_MS = 24*3600*1000
+
+
+def socket_chunks(host, port, wait=0.05):
+    # Lists of complete lines as they arrive, until the sender closes
+    sock = socket.create_connection((host, port))
+    sock.settimeout(wait)
+    buf = b""
+    try:
+        while True:
+            try:
+                data = sock.recv(1 << 16)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            *lines, buf = (buf + data).split(b"\n")
+            yield lines
+    finally:
+        sock.close()
+
+
+def follow_chunks(fname, wait=0.05, idle=None):
+    # Lists of complete lines appended to fname, like tail -f
+    quiet = 0.
+    buf = b""
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(1 << 16)
+            if not data:
+                if idle is not None and quiet >= idle:
+                    break
+                time.sleep(wait)
+                quiet += wait
+                continue
+            quiet = 0.
+            *lines, buf = (buf + data).split(b"\n")
+            yield lines
+
+
+def parse_fixes(lines):
+    # "ID,lon,lat,timeU70[,sent]" lines -> ids, x_km, y_km, timeU70, sent (nan if absent)
+    ids, rows = [], []
+    for line in lines:
+        w = line.split(b",")
+        if len(w) < 4:
+            continue
+        ids.append(w[0])
+        rows.append((float(w[1]), float(w[2]), float(w[3]), float(w[4]) if len(w) > 4 else np.nan))
+    arr = np.array(rows, dtype=np.float64).reshape(-1, 4)
+    return ids, arr[:,0]*gt.long2km, arr[:,1]*gt.lat2km, arr[:,2], arr[:,3]
+
+
+class LiveSnapshots(object):
+    '''
+    Incremental (day, tg) snapshots of the graph of an nn_inputs file
+
+    live = LiveSnapshots(inputfname, on_snapshot=callback)
+    for lines in socket_chunks(host, port):
+        live.push(lines)
+    live.finish()
+
+    callback(day, tg, graph, info) gets each closed snapshot as a
+    normalized GraphsTuple, with info holding its velocity count and
+    latencies in seconds
+
+    Velocities are snapped as the file's features were (its "snapping"
+    and "within" attrs); passing a different snapping or within raises
+    '''
+    def __init__(self, h5_name, tglen=10, tcutoff=1.0, velmin=0.0, snapping=None,
+                 within=None, on_snapshot=None):
+        with h5py.File(h5_name, 'r') as h5f:
+            # Features have to be built the way the file's were, or its norm
+            # stats don't apply. Files without the attrs predate segment snapping
+            file_snapping = str(h5f.attrs.get("snapping", "radius"))
+            file_within = float(h5f.attrs.get("within", 1.0))
+            self.ntg = prep.file_ntg(h5f)
+            if self.ntg != 60*24//tglen:
+                raise ValueError(h5_name+" has nTG "+str(self.ntg)+", not "+str(60*24//tglen))
+            senders = h5f['senders'][:].astype(np.int64)
+            receivers = h5f['receivers'][:].astype(np.int64)
+            coords = h5f['node_coords'][:].astype(np.float64)
+            self.covs = h5f['edge_node_covs'][:]
+            self.M = h5f['M'][:]
+            self.normalizer = Normalizer.from_h5(h5f)
+        xy = np.stack([coords[:,0]*gt.long2km, coords[:,1]*gt.lat2km], axis=1)
+        dr = xy[receivers] - xy[senders]
+        self.nodes = pd.DataFrame({"coords_km": list(xy)})
+        self.edges = pd.DataFrame({"sender": senders, "receiver": receivers,
+                                   "angle": np.arctan2(dr[:,1], dr[:,0])})
+        self.lengths = np.linalg.norm(dr, axis=1)
+        self.senders = dtypes.cast("index", senders)
+        self.receivers = dtypes.cast("index", receivers)
+        self.n_nodes, self.n_edges = len(xy), len(senders)
+
+        for name, asked, built in (("snapping", snapping, file_snapping),
+                                   ("within", within, file_within)):
+            if asked is not None and asked != built:
+                raise ValueError(h5_name+" was built with "+name+" "+str(built)+", not "+str(asked))
+        snapping, within = file_snapping, file_within
+
+        self.tg_ms = tglen*60*1000
+        self.tcutoff, self.velmin, self.within = tcutoff, velmin, within
+        self.snapping = snapping
+        if snapping == "segment":
+            self.matcher = gt.SegmentMatcher(self.nodes, self.edges)
+        else:
+            self.S = gt.sender_matrix(self.edges, self.n_nodes)
+        self.on_snapshot = on_snapshot
+
+        self.last = {}       # driver -> (timeU70, x_km, y_km)
+        self.sums = {}       # absolute tg -> [node, outgoing edge, incoming edge] cell sums
+        self.next_tg = None  # first absolute tg not yet closed
+        self.watermark = -np.inf
+        self.counts = {"fixes": 0, "vels": 0, "late": 0, "snapshots": 0}
+        self.latencies = []
+
+    def abs_tg(self, t):
+        # Time groups since the epoch, in Beijing local time as gen_vels.py bins them
+        return ((t + TZ_MS)//self.tg_ms).astype(np.int64)
+
+    def daytime(self, k):
+        # (day, tg) of an absolute time group; 1970-01-01 was a thursday
+        return int((k*self.tg_ms//DAY_MS - 4) % 7), int(k % self.ntg)
+
+    def velocities(self, ids, x, y, t):
+        # Rows (x, y, vx, vy, v) and the absolute tg of the earlier fix,
+        # from each fix and its driver's previous one
+        rows, tgs = [], []
+        for i, driver in enumerate(ids):
+            prev = self.last.get(driver)
+            self.last[driver] = (t[i], x[i], y[i])
+            if prev is None:
+                continue
+            dT = (t[i] - prev[0])/60000.
+            if dT <= 0 or dT > self.tcutoff:
+                continue
+            vx, vy = (x[i] - prev[1])/(dT/60.), (y[i] - prev[2])/(dT/60.)
+            v = np.sqrt(vx*vx + vy*vy)
+            if v < self.velmin:
+                continue
+            rows.append((prev[1], prev[2], vx, vy, v))
+            tgs.append(prev[0])
+        return np.array(rows, dtype=np.float64).reshape(-1, 5), self.abs_tg(np.array(tgs))
+
+    def cells(self, vels):
+        if self.snapping == "segment":
+            edge_ids, ts, _, headings = self.matcher.match(vels, maxdist=self.within)
+            return gt.matched_cells(self.matcher, edge_ids, ts, headings)
+        A = gt.vel_node_matrix(vels, self.nodes, self.within)
+        return gt.radius_cells(A, self.S, vels, self.edges["angle"].to_numpy())
+
+    def push(self, lines, received=None):
+        # A micro-batch of fix lines, received at wall time received
+        received = time.time() if received is None else received
+        ids, x, y, t, sent = parse_fixes(lines)
+        if not len(t):
+            return
+        self.counts["fixes"] += len(t)
+        if self.next_tg is None:
+            self.next_tg = self.abs_tg(t[:1])[0]
+
+        rows, tgs = self.velocities(ids, x, y, t)
+        late = tgs < self.next_tg
+        self.counts["late"] += int(late.sum())
+        rows, tgs = rows[~late], tgs[~late]
+        self.counts["vels"] += len(rows)
+        if len(rows):
+            vels = np.zeros((len(rows), 7), dtype=np.float64)
+            vels[:,2:] = rows
+            cells = self.cells(vels)
+            for k in np.unique(tgs):
+                # The (row, cell) pairs of this time group's velocities
+                kcells = [(rows_[tgs[rows_] == k], c[tgs[rows_] == k]) for rows_, c in cells]
+                acc = self.sums.setdefault(k, [np.zeros((self.n_nodes,3)), np.zeros((self.n_edges,3)),
+                                               np.zeros((self.n_edges,3))])
+                for a, b in zip(acc, gt.cell_sums(kcells, vels, self.n_nodes, self.n_edges)):
+                    a += b
+
+        # Time groups whose velocities can no longer arrive are closed in order
+        i_last = np.argmax(t)
+        self.watermark = max(self.watermark, t[i_last])
+        while (self.next_tg+1)*self.tg_ms - TZ_MS + self.tcutoff*60000 <= self.watermark:
+            self.close(self.next_tg, received, sent[i_last])
+            self.next_tg += 1
+
+    def finish(self):
+        # End of stream: close every time group that has velocities
+        now = time.time()
+        while self.sums:
+            self.close(self.next_tg, now, np.nan)
+            self.next_tg += 1
+
+    def close(self, k, received, sent):
+        from graph_nets import graphs
+        empty = [np.zeros((self.n_nodes,3)), np.zeros((self.n_edges,3)), np.zeros((self.n_edges,3))]
+        node_fts, edge_fts = gt.cell_stats(*self.sums.pop(k, empty))
+        edge_fts = np.concatenate([edge_fts[:,:3], self.lengths[:,None]], axis=1)
+        n_fts, e_fts = prep.nn_features(node_fts, edge_fts, self.covs, self.M)
+        day, tg = self.daytime(k)
+        glbls = np.array([[day, tg]], dtype=np.float64)
+        cast = lambda kind, arr: dtypes.cast("feature", self.normalizer.norm(kind, arr, out=arr))
+        graph = graphs.GraphsTuple(nodes=cast("nodes", n_fts), edges=cast("edges", e_fts),
+                                   globals=cast("globals", glbls),
+                                   senders=self.senders, receivers=self.receivers,
+                                   n_node=np.array([self.n_nodes], dtype=np.int32),
+                                   n_edge=np.array([self.n_edges], dtype=np.int32))
+        ready = time.time()
+        info = {"ncar": float(node_fts[:,0].sum()), "close_latency": ready - received,
+                "e2e_latency": ready - sent}
+        self.counts["snapshots"] += 1
+        self.latencies.append(info)
+        if self.on_snapshot:
+            self.on_snapshot(day, tg, graph, info)
+
+    def summary(self):
+        out = dict(self.counts)
+        for key in ("close_latency", "e2e_latency"):
+            lat = np.array([info[key] for info in self.latencies])
+            lat = lat[np.isfinite(lat)]
+            if len(lat):
+                out[key] = {"p50": float(np.median(lat)), "p95": float(np.percentile(lat, 95)),
+                            "max": float(lat.max())}
+        return out
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["socket=", "follow=", "idle=", "tglen=",
+                                                      "tcutoff=", "velmin=", "snapping=", "weights="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    opts = dict(opts)
+    if len(args) != 1 or ("--socket" in opts) == ("--follow" in opts):
+        print(__doc__)
+        sys.exit(2)
+
+    def report(day, tg, graph, info):
+        line = "day %d tg %4d  %7.0f cars  close %7.1f ms" % (day, tg, info["ncar"],
+                                                           1e3*info["close_latency"])
+        if np.isfinite(info["e2e_latency"]):
+            line += "  end to end %7.1f ms" % (1e3*info["e2e_latency"])
+        if model:
+            t0 = time.time()
+            model(graph.nodes, graph.edges, graph.globals)
+            line += "  forecast %6.1f ms" % (1e3*(time.time() - t0))
+        print(line)
+
+    live = LiveSnapshots(args[0], tglen=int(opts.get("--tglen", 10)),
+                         tcutoff=float(opts.get("--tcutoff", 1.0)),
+                         velmin=float(opts.get("--velmin", 0.0)),
+                         snapping=opts.get("--snapping"), on_snapshot=report)
+    model = NumpyForecaster(opts["--weights"], live.senders, live.receivers, live.n_nodes) \
+        if "--weights" in opts else None
+
+    if "--socket" in opts:
+        host, port = opts["--socket"].rsplit(":", 1)
+        chunks = socket_chunks(host, int(port))
+    else:
+        idle = float(opts["--idle"]) if "--idle" in opts else None
+        chunks = follow_chunks(opts["--follow"], idle=idle)
+    try:
+        for lines in chunks:
+            live.push(lines)
+    except KeyboardInterrupt:
+        pass
+    live.finish()
+    for key, val in live.summary().items():
+        print(key.ljust(14), val)
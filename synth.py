@@ -0,0 +1,335 @@
+'''
+Synthetic highway points and driver trajectories, written in the same
+formats as the real inputs, so every stage can be run (and timed, see
+bench.py) away from the cluster
+
+    hwy_pts.csv         lon,lat of points along each road (generate_nodes)
+    OUT0                one driver per line, "ID  lon,lat,timeU70,YYYY-MM-DD HH:MM:SS|..."
+                        (gen_vels.py --source)
+    vels, vels.info     "d tg x y vx vy v" per line (get_velarr, graphsnapper.py)
+    vels.hdf5           veldat dataset as gen_vels.py writes it
+    nn_inputs.hdf5      node_features, edge_features, glbl_features per snapshot,
+                        senders, receivers and node_coords (my_graph_tools);
+                        with segment snapping also node_percentiles and
+                        edge_percentiles per snapshot, and for the week
+
+Roads run roughly east-west and north-south across the second ring.
+Drivers pick a road, a direction and a speed and report a noisy fix
+every dt seconds, at a random time in one week.
+
+Usage:
+    python synth.py [options] outdir
+
+Options:
+    --roads    number of roads (default 20)
+    --drivers  number of drivers (default 2000)
+    --points   fixes per driver (default 40)
+    --tglen    minutes per time group (default 10)
+    --seed     random seed (default 0)
+'''
+import os
+import sys, getopt
+import numpy as np
+import pandas as pd
+import h5py
+from scipy.spatial import cKDTree
+
+import graphtools as gt
+import dtypes
+import sketches
+from snapstore import snapstr
+
+
+# Second ring, in degrees [lonmin, lonmax, latmin, latmax]
+REGION = [116.33085226800, 116.44826879600, 39.85573366870, 39.96366920310]
+# Monday 2015-10-05 00:00 Beijing time, as ms since 1970 (timeU70)
+WEEK0 = 1443974400000
+TZ_MS = gt.TZ_MS
+WEEK_MS = 7*24*3600*1000
+
+
+def make_roads(nroads, region=REGION, spacing_km=0.05, wiggle_km=0.3, rng=None):
+    # Polylines in km coords, alternately east-west and north-south,
+    # each a gentle sine wave between two random points on opposite sides
+    rng = rng if rng else np.random.RandomState(0)
+    xmin, xmax = region[0]*gt.long2km, region[1]*gt.long2km
+    ymin, ymax = region[2]*gt.lat2km, region[3]*gt.lat2km
+    roads = []
+    for i in range(nroads):
+        if i%2 == 0:
+            a = np.array([xmin, rng.uniform(ymin, ymax)])
+            b = np.array([xmax, rng.uniform(ymin, ymax)])
+        else:
+            a = np.array([rng.uniform(xmin, xmax), ymin])
+            b = np.array([rng.uniform(xmin, xmax), ymax])
+        length = np.linalg.norm(b-a)
+        s = np.linspace(0., 1., max(2, int(length/spacing_km)))
+        pts = a + s[:,None]*(b-a)
+        normal = np.array([a[1]-b[1], b[0]-a[0]])/length
+        phase, nwave = rng.uniform(0, 2*np.pi), rng.uniform(0.5, 2.)
+        pts += wiggle_km*np.sin(2*np.pi*nwave*s + phase)[:,None]*normal
+        pts[:,0] = np.clip(pts[:,0], xmin, xmax)
+        pts[:,1] = np.clip(pts[:,1], ymin, ymax)
+        roads.append(pts)
+    return roads
+
+
+def write_hwy_pts(fname, roads):
+    pts = np.concatenate(roads)
+    np.savetxt(fname, np.stack([pts[:,0]/gt.long2km, pts[:,1]/gt.lat2km], axis=1),
+               fmt="%.8f", delimiter=",", header="lon,lat", comments="")
+    return len(pts)
+
+
+def drive(roads, ndrivers, npts, dt=30., speed=(20., 80.), noise_km=0.01, rng=None):
+    '''
+    Fixes of ndrivers drivers, npts each, dt seconds apart
+    Returns (ids, x_km, y_km, timeU70) sorted by driver then time
+    Drivers turn around at the end of their road
+    '''
+    rng = rng if rng else np.random.RandomState(0)
+    arclens = [np.concatenate([[0.], np.cumsum(np.linalg.norm(np.diff(r, axis=0), axis=1))])
+               for r in roads]
+    iroad = rng.randint(len(roads), size=ndrivers)
+    v = rng.uniform(speed[0], speed[1], ndrivers)*rng.choice([-1., 1.], ndrivers)
+    t0 = WEEK0 + rng.randint(0, WEEK_MS - int(npts*dt*1000), ndrivers)
+    t = t0[:,None] + (1000*dt*np.arange(npts)).astype(np.int64)
+
+    x = np.empty((ndrivers, npts))
+    y = np.empty((ndrivers, npts))
+    for r, (road, arclen) in enumerate(zip(roads, arclens)):
+        idr = np.flatnonzero(iroad == r)
+        if len(idr) == 0:
+            continue
+        total = arclen[-1]
+        s = rng.uniform(0, total, len(idr))[:,None] + v[idr,None]*(dt/3600.)*np.arange(npts)
+        # Reflect at the road ends
+        s = np.abs((s + total) % (2*total) - total)
+        x[idr] = np.interp(s, arclen, road[:,0])
+        y[idr] = np.interp(s, arclen, road[:,1])
+    x += rng.normal(0, noise_km, x.shape)
+    y += rng.normal(0, noise_km, y.shape)
+    ids = np.repeat(np.arange(ndrivers), npts)
+    return ids, x.ravel(), y.ravel(), t.ravel()
+
+
+def local_times(t):
+    # timeU70 ms -> "YYYY-MM-DD HH:MM:SS" in Beijing time
+    stamps = np.datetime_as_string((t + TZ_MS).astype('datetime64[ms]'), unit='s')
+    return np.char.replace(stamps, 'T', ' ')
+
+
+def write_out0(fname, ids, x, y, t):
+    # One line per driver, fixes separated by |
+    lon, lat, stamps = x/gt.long2km, y/gt.lat2km, local_times(t)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    ends = np.r_[starts[1:], len(ids)]
+    with open(fname, 'w') as f:
+        for i0, i1 in zip(starts, ends):
+            pts = ["%.6f,%.6f,%d,%s" % (lon[i], lat[i], t[i], stamps[i]) for i in range(i0, i1)]
+            f.write("synth%07d  " % ids[i0] + "|".join(pts) + "\n")
+
+
+def daytimes(t, tglen):
+    # Weekday (monday = 0) and time group of each timeU70, as gen_vels.py bins them
+    local = (t + TZ_MS).astype('datetime64[ms]')
+    day = (local.astype('datetime64[D]').view(np.int64) - 4) % 7  # 1970-01-01 was a thursday
+    minute = (local - local.astype('datetime64[D]')).astype('timedelta64[m]').view(np.int64)
+    return day, minute//tglen
+
+
+def velocities(ids, x, y, t, tglen, tcutoff=1.0, velmin=0.0):
+    # (nvel,7) [day, tg, x, y, vx, vy, v] from consecutive fixes of each driver,
+    # filtered on dT and speed as gen_vels.add does. Rows keep the first fix's day, tg
+    day, tg = daytimes(t, tglen)
+    dT = np.diff(t)/60000.
+    keep = (ids[1:] == ids[:-1]) & (dT <= tcutoff) & (dT > 0)
+    dT = dT[keep]
+    vx = np.diff(x)[keep]/(dT/60.)
+    vy = np.diff(y)[keep]/(dT/60.)
+    v = np.sqrt(vx*vx + vy*vy)
+    fast = v >= velmin
+    i0 = np.flatnonzero(keep)[fast]
+    return np.stack([day[i0], tg[i0], x[i0], y[i0], vx[fast], vy[fast], v[fast]], axis=1)
+
+
+def vel_attrs(region, tcutoff, velmin, tglen, source):
+    return {"xmin": region[0]*gt.long2km, "xmax": region[1]*gt.long2km,
+            "ymin": region[2]*gt.lat2km, "ymax": region[3]*gt.lat2km,
+            "tcutoff": tcutoff, "velmin": velmin, "tglen": tglen,
+            "nTG": 60*24//tglen, "source": source}
+
+
+def write_vels(fname, vels, attrs, ndrivers):
+    # Text velocities plus the .info file gt.get_info_dict reads
+    np.savetxt(fname, vels, fmt="%d %d %.6f %.6f %.6f %.6f %.6f")
+    with open(fname+".info", 'w') as finfo:
+        for key in ["xmin", "xmax", "ymin", "ymax", "tcutoff", "velmin", "tglen", "nTG", "source"]:
+            finfo.write(key+" "+str(attrs[key])+"\n")
+        finfo.write(str(ndrivers)+" drivers scanned\n"+str(len(vels))
+                    +" points successfully added to "+fname+"\n")
+
+
+def write_veldat(fname, vels, attrs):
+    with h5py.File(fname, 'w') as f5:
+        f5.attrs.update(attrs)
+        f5.attrs["nvel"] = len(vels)
+        f5.create_dataset("veldat", data=dtypes.cast("feature", vels), maxshape=(None,7))
+
+
+def road_graph(roads, mindist=0.5, maxdist=2., maxnbr=8):
+    '''
+    Nodes and edges as generate_nodes makes them, straight from the road
+    points: points closer than mindist to a kept point are dropped, then
+    each node links to its (up to maxnbr) nearest nodes within maxdist
+    '''
+    pts = np.concatenate(roads)
+    tree = cKDTree(pts)
+    dropped = np.zeros(len(pts), dtype=bool)
+    for i, close in enumerate(tree.query_ball_point(pts, mindist)):
+        if not dropped[i]:
+            dropped[[j for j in close if j > i]] = True
+    pts = pts[~dropped]
+
+    dist, nbr = cKDTree(pts).query(pts, k=min(maxnbr+1, len(pts)), distance_upper_bound=maxdist)
+    dist, nbr = dist[:,1:], nbr[:,1:]
+    linked = np.isfinite(dist)
+    senders = np.repeat(np.arange(len(pts)), linked.sum(axis=1))
+    receivers = nbr[linked]
+    dr = pts[receivers] - pts[senders]
+
+    nodes = pd.DataFrame({"coords": list(np.stack([pts[:,0]/gt.long2km, pts[:,1]/gt.lat2km], 1)),
+                          "coords_km": list(pts)})
+    edges = pd.DataFrame({"sender": senders, "receiver": receivers,
+                          "angle": np.angle(dr[:,0] + 1j*dr[:,1])})
+    return nodes, edges
+
+
+def write_nn_inputs(fname, nodes, edges, vels, ntg, within=1.0, snapping="radius"):
+    '''
+    graphsnapper.py's per-snapshot stats, stored in the per-snapshot group
+    layout of an nn_inputs file, in the dtypes.py policy. Edge features are
+    the outgoing (ncar, v_avg, v_std) of snapshot_stats plus the edge length in km
+    snapping is "radius" (every node within "within" km) or "segment"
+    (gt.SegmentMatcher, matches up to "within" km away); both are stored
+    as attrs, so readers such as stream.LiveSnapshots build matching features
+    Segment snapping also stores graphsnapper.py's p10/p50/p90 speeds per
+    snapshot, node_percentiles (n_nodes,3) and edge_percentiles (n_edges,6,
+    outgoing then incoming), and the same over the whole week as
+    node_percentiles_week and edge_percentiles_week. They are a feature set
+    of their own: prep.nn_features does not read them
+    '''
+    n_nodes, n_edges = len(nodes), len(edges)
+    vels = vels[np.lexsort((vels[:,1], vels[:,0]))]
+    offsets = gt.snap_offsets(vels, ntg)
+    if snapping == "segment":
+        matcher = gt.SegmentMatcher(nodes, edges)
+        edge_ids, ts, _, headings = matcher.match(vels, maxdist=within)
+        node_hist, edge_hist = sketches.SpeedHistogram(n_nodes), sketches.SpeedHistogram(2*n_edges)
+        node_week, edge_week = sketches.SpeedHistogram(n_nodes), sketches.SpeedHistogram(2*n_edges)
+    else:
+        A = gt.vel_node_matrix(vels, nodes, within)
+        S = gt.sender_matrix(edges, n_nodes)
+    angles = edges["angle"].to_numpy(dtype=np.float64)
+    senders = edges["sender"].to_numpy(dtype=np.int64)
+    receivers = edges["receiver"].to_numpy(dtype=np.int64)
+    xy = np.asarray(nodes["coords_km"].tolist(), dtype=np.float64)
+    lengths = np.linalg.norm(xy[receivers] - xy[senders], axis=1)
+
+    with h5py.File(fname, 'w') as h5f:
+        h5f.attrs.update({"nTG": ntg, "n_nodes": n_nodes, "n_edges": n_edges,
+                          "snapping": snapping, "within": within})
+        h5f.create_dataset("senders", data=dtypes.cast("index", senders))
+        h5f.create_dataset("receivers", data=dtypes.cast("index", receivers))
+        h5f.create_dataset("node_coords", data=np.asarray(nodes["coords"].tolist()))
+        node_grp = h5f.create_group("node_features")
+        edge_grp = h5f.create_group("edge_features")
+        glbl_grp = h5f.create_group("glbl_features")
+        if snapping == "segment":
+            node_pctl_grp = h5f.create_group("node_percentiles")
+            edge_pctl_grp = h5f.create_group("edge_percentiles")
+        e_fts = np.empty((n_edges,4), dtype=np.float64)
+        e_fts[:,3] = lengths
+        for day in range(7):
+            for tg in range(ntg):
+                isnap = day*ntg + tg
+                lo, hi = offsets[isnap], offsets[isnap+1]
+                if snapping == "segment":
+                    n_fts, snap_e_fts = gt.matched_snapshot_stats(
+                        matcher, edge_ids[lo:hi], ts[lo:hi], headings[lo:hi], vels[lo:hi])
+                    n_pctl, e_pctl = gt.matched_snapshot_percentiles(
+                        matcher, edge_ids[lo:hi], ts[lo:hi], headings[lo:hi], vels[lo:hi],
+                        node_hist, edge_hist)
+                    node_week.merge(node_hist)
+                    edge_week.merge(edge_hist)
+                    node_pctl_grp.create_dataset(snapstr(day,tg), data=dtypes.cast("feature", n_pctl),
+                                                 compression="gzip", compression_opts=6)
+                    edge_pctl_grp.create_dataset(snapstr(day,tg), data=dtypes.cast("feature", e_pctl),
+                                                 compression="gzip", compression_opts=6)
+                else:
+                    n_fts, snap_e_fts = gt.snapshot_stats(A[lo:hi], S, vels[lo:hi], angles)
+                e_fts[:,:3] = snap_e_fts[:,:3]
+                node_grp.create_dataset(snapstr(day,tg), data=dtypes.cast("feature", n_fts),
+                                        compression="gzip", compression_opts=6)
+                edge_grp.create_dataset(snapstr(day,tg), data=dtypes.cast("feature", e_fts),
+                                        compression="gzip", compression_opts=6)
+                glbl_grp.create_dataset(snapstr(day,tg), data=dtypes.cast("daytime", [[day, tg]]))
+        if snapping == "segment":
+            edge_q = edge_week.quantiles()
+            h5f.create_dataset("node_percentiles_week", data=dtypes.cast("feature", node_week.quantiles()))
+            h5f.create_dataset("edge_percentiles_week", data=dtypes.cast(
+                "feature", np.concatenate([edge_q[:n_edges], edge_q[n_edges:]], axis=1)))
+    return n_nodes, n_edges
+
+
+def generate(outdir, nroads=20, ndrivers=2000, npts=40, tglen=10, seed=0,
+             tcutoff=1.0, velmin=0.0):
+    # Writes every file listed above to outdir and returns their paths
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    paths = {key: os.path.join(outdir, name) for key, name in
+             [("hwy", "hwy_pts.csv"), ("out0", "OUT0"), ("vels", "vels"),
+              ("veldat", "vels.hdf5"), ("nn_inputs", "nn_inputs.hdf5")]}
+
+    roads = make_roads(nroads, rng=rng)
+    write_hwy_pts(paths["hwy"], roads)
+    ids, x, y, t = drive(roads, ndrivers, npts, rng=rng)
+    write_out0(paths["out0"], ids, x, y, t)
+
+    vels = velocities(ids, x, y, t, tglen, tcutoff, velmin)
+    attrs = vel_attrs(REGION, tcutoff, velmin, tglen, paths["out0"])
+    write_vels(paths["vels"], vels, attrs, ndrivers)
+    write_veldat(paths["veldat"], vels, attrs)
+
+    nodes, edges = road_graph(roads)
+    write_nn_inputs(paths["nn_inputs"], nodes, edges, vels, attrs["nTG"])
+    return paths
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["roads=", "drivers=", "points=",
+                                                      "tglen=", "seed="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    if len(args) != 1:
+        print(__doc__)
+        sys.exit(2)
+
+    kwargs = {}
+    for opt, arg in opts:
+        if opt == "--roads":
+            kwargs["nroads"] = int(arg)
+        elif opt == "--drivers":
+            kwargs["ndrivers"] = int(arg)
+        elif opt == "--points":
+            kwargs["npts"] = int(arg)
+        elif opt == "--tglen":
+            kwargs["tglen"] = int(arg)
+        elif opt == "--seed":
+            kwargs["seed"] = int(arg)
+
+    for key, path in generate(args[0], **kwargs).items():
+        print(key.ljust(10), path)
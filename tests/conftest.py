@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synth
+import prep
+
+
+@pytest.fixture(scope="session")
+def week(tmp_path_factory):
+    # A small synthetic week, hourly time groups, with its nn inputset built
+    paths = synth.generate(str(tmp_path_factory.mktemp("week")), nroads=6, ndrivers=300,
+                           npts=20, tglen=60, seed=1)
+    prep.EdgeNodeCovariance(paths["nn_inputs"])
+    prep.CalcMFactor(paths["nn_inputs"])
+    prep.create_nn_inputset(paths["nn_inputs"], exact=True)
+    return paths
@@ -0,0 +1,31 @@
+import h5py
+import numpy as np
+
+import dtypes
+import evaluate
+from snapstore import is_raw, open_snapshots
+
+
+def test_perfect_predictions_score_zero(week, tmp_path):
+    predfname = str(tmp_path/"pred.hdf5")
+    with h5py.File(week["nn_inputs"], 'r') as h5f, h5py.File(predfname, 'w') as h5p:
+        assert is_raw(h5f)
+        ntg = int(h5f.attrs["nTG"])
+        h5p.attrs.update({"nTG": ntg, "source": week["nn_inputs"]})
+        # Row i forecasts snapshot i+1, wrapping from the end of the week
+        for pname, lname, nft in (("pred_node_features", "nn_node_features", 4),
+                                  ("pred_edge_features", "nn_edge_features", 3)):
+            labels = open_snapshots(h5f, lname, ntg)
+            h5p.create_dataset(pname, data=dtypes.cast("feature", np.stack(
+                [labels[(i+1)%(7*ntg)][:, :nft] for i in range(7*ntg)])))
+
+    results = evaluate.evaluate(predfname, block=10)
+    for kind, nft in (("nodes", 4), ("edges", 3)):
+        tables = results[kind]
+        assert tables["overall"].shape == (nft, 3)
+        assert tables["by_tg"].shape == (ntg, nft, 3) and tables["by_day"].shape == (7, nft, 3)
+        for table in tables.values():
+            # MAE and RMSE, and MAPE wherever a label was scored
+            assert (table[..., :2] == 0).all()
+            assert np.all((table[..., 2] == 0) | np.isnan(table[..., 2]))
+        assert (tables["overall"][:, 2] == 0).all()
@@ -0,0 +1,50 @@
+import h5py
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("graph_nets")
+from graph_nets import utils_np, utils_tf
+
+import my_graph_tools as mgt
+import infer
+from snapstore import SnapshotStore, Normalizer
+
+
+@pytest.fixture(scope="module")
+def checkpoint(week, tmp_path_factory):
+    # A randomly initialized forecaster, and its outputs on a few snapshots
+    store = SnapshotStore(week["nn_inputs"])
+    ckpt = str(tmp_path_factory.mktemp("ckpt") / "model.ckpt")
+    tf.reset_default_graph()
+    input_ph = utils_tf.placeholders_from_data_dicts(
+        [store.data_dict(0, 0)], force_dynamic_num_graphs=True, name="input")
+    model, output = mgt.build_forecast_model(input_ph, 3, 4, 3)
+    expected = {}
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        for day, tg in [(0, 0), (3, 7), (6, store.ntg-1)]:
+            graph = utils_np.data_dicts_to_graphs_tuple([store.data_dict(day, tg)])
+            expected[store.index(day, tg)] = sess.run(
+                [output.nodes, output.edges], feed_dict=utils_tf.get_feed_dict(input_ph, graph))
+        tf.train.Saver(var_list=mgt.forecast_variables(model)).save(sess, ckpt)
+    return ckpt, expected
+
+
+@pytest.mark.parametrize("shared", [True, False])
+def test_run_inference(week, checkpoint, tmp_path, shared):
+    ckpt, expected = checkpoint
+    outfname = str(tmp_path / "preds.hdf5")
+    npz = str(tmp_path / "weights.npz") if shared else None
+    # 5 does not divide 7*24, so the last batch is partial
+    infer.run_inference(week["nn_inputs"], ckpt, outfname, batch_size=5, shared=shared,
+                        export=npz)
+    with h5py.File(week["nn_inputs"], 'r') as h5f:
+        normalizer = Normalizer.from_h5(h5f)
+    with h5py.File(outfname, 'r') as h5out:
+        assert h5out["pred_node_features"].shape[0] == 7*24
+        for isnap, (nodes, edges) in expected.items():
+            np.testing.assert_allclose(h5out["pred_node_features"][isnap],
+                                       normalizer.unnorm("nodes", nodes), rtol=1e-9, atol=1e-9)
+            np.testing.assert_allclose(h5out["pred_edge_features"][isnap],
+                                       normalizer.unnorm("edges", edges), rtol=1e-9, atol=1e-9)
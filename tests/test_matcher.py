@@ -0,0 +1,39 @@
+import numpy as np
+
+import graphtools as gt
+import synth
+
+
+def test_match_is_exhaustive_best():
+    rng = np.random.RandomState(5)
+    roads = synth.make_roads(6, rng=rng)
+    ids, x, y, t = synth.drive(roads, 200, 20, rng=rng)
+    vels = synth.velocities(ids, x, y, t, 60, 1.0, 0.0)
+    # Some fixes far off any road and some without a heading
+    vels[::97, 2:4] += rng.uniform(-3., 3., (len(vels[::97]), 2))
+    vels[::13, 4:6] = 0.
+    nodes, edges = synth.road_graph(roads)
+    matcher = gt.SegmentMatcher(nodes, edges)
+    edge_ids, ts, dists, headings = matcher.match(vels, maxdist=1.0)
+
+    # Score of every velocity against every edge
+    rel = vels[:,None,2:4] - matcher.p0[None]
+    allt = np.clip(np.einsum('ijk,jk->ij', rel, matcher.seg)/matcher.len2, 0., 1.)
+    alldist = np.linalg.norm(rel - allt[...,None]*matcher.seg[None], axis=2)
+    moving = (vels[:,4] != 0) | (vels[:,5] != 0)
+    allhead = np.where(moving[:,None],
+                       np.cos(np.arctan2(vels[:,5], vels[:,4])[:,None] - matcher.angle[None]), 0.)
+    score = alldist + matcher.heading_penalty*(1.-allhead)/2.
+    best = score.min(axis=1)
+
+    matched = edge_ids >= 0
+    assert matched.any() and not matched.all()
+    rows = np.flatnonzero(matched)
+    np.testing.assert_allclose(score[rows, edge_ids[rows]], best[rows], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(dists[rows], alldist[rows, edge_ids[rows]], atol=1e-12)
+    np.testing.assert_allclose(ts[rows], allt[rows, edge_ids[rows]], atol=1e-12)
+    np.testing.assert_allclose(headings[rows], allhead[rows, edge_ids[rows]], atol=1e-12)
+    # The rest are those whose best scoring edge is beyond maxdist
+    rows = np.flatnonzero(~matched)
+    assert (dists[matched] <= 1.0).all()
+    assert (alldist[rows, score[rows].argmin(axis=1)] > 1.0).all()
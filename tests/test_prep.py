@@ -0,0 +1,31 @@
+import h5py
+import numpy as np
+
+import prep
+from snapstore import open_snapshots
+
+
+def test_merged_block_stats_match_one_shot():
+    rng = np.random.RandomState(0)
+    arr = rng.normal(3., 2., (1000, 4))*rng.uniform(0.5, 5., 4)
+    stats = (0, 0., 0.)
+    # Uneven blocks, merged onto the empty start
+    for lo, hi in zip([0, 7, 300, 651], [7, 300, 651, 1000]):
+        stats = prep.merge_stats(stats, prep.block_stats(arr[lo:hi]))
+    n, mean, M2 = stats
+    assert n == len(arr)
+    np.testing.assert_allclose(mean, arr.mean(axis=0), rtol=1e-12)
+    np.testing.assert_allclose(prep.stats_to_norm(stats),
+                               np.array([arr.mean(axis=0), arr.std(axis=0)]), rtol=1e-12)
+
+
+def test_inputset_stats_match_one_shot(week):
+    # The exact stats create_nn_inputset stored, against every snapshot at once
+    with h5py.File(week["nn_inputs"], 'r') as h5f:
+        ntg = prep.file_ntg(h5f)
+        for name, stats in (("nn_node_features", "node_stats"), ("nn_edge_features", "edge_stats")):
+            snaps = open_snapshots(h5f, name, ntg)
+            arr = np.stack([snaps[i] for i in range(7*ntg)]).astype(np.float64)
+            arr = arr.reshape(-1, arr.shape[-1])
+            np.testing.assert_allclose(h5f[stats][:], np.array([arr.mean(axis=0), arr.std(axis=0)]),
+                                       rtol=1e-9, atol=1e-12)
@@ -0,0 +1,29 @@
+import h5py
+import numpy as np
+
+import repack
+from snapstore import read_snap, is_stacked, is_sparse
+
+
+def test_stacked_round_trip(week, tmp_path):
+    dst_name = str(tmp_path/"stacked.hdf5")
+    groups = repack.repack(week["nn_inputs"], dst_name)
+    assert "node_features" in groups and "nn_edge_features" in groups
+    with h5py.File(week["nn_inputs"], 'r') as src, h5py.File(dst_name, 'r') as dst:
+        ntg = int(src.attrs["nTG"])
+        for name in groups:
+            assert is_stacked(dst, name)
+            for i in range(7*ntg):
+                np.testing.assert_array_equal(read_snap(dst, name, i//ntg, i%ntg, ntg),
+                                              read_snap(src, name, i//ntg, i%ntg, ntg))
+
+
+def test_sparse_round_trip(week, tmp_path):
+    dst_name = str(tmp_path/"sparse.hdf5")
+    repack.repack(week["nn_inputs"], dst_name, sparse=("edge_features", "node_features"))
+    with h5py.File(dst_name, 'r') as dst:
+        assert is_sparse(dst, "edge_features") and is_sparse(dst, "node_features")
+    diffs = repack.check_sparse(week["nn_inputs"], dst_name)
+    assert set(diffs) == {"edge_features", "node_features", "edge_node_covs", "M"}
+    assert diffs["edge_features"] == diffs["node_features"] == 0.
+    assert diffs["edge_node_covs"] < 1e-9 and diffs["M"] < 1e-9
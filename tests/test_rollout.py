@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("graph_nets")
+
+import my_graph_tools as mgt
+from loader import label_daytime
+from snapstore import SnapshotStore
+
+
+def test_rollout_matches_chained_steps(week):
+    store = SnapshotStore(week["nn_inputs"])
+    ntg, dtg, nsteps = store.ntg, 60, 5
+    # Rollouts across the end of a day and of the week
+    daytimes = [(2, ntg-2), (6, ntg-3)]
+    batch = store.shared_batch(daytimes)
+
+    tf.reset_default_graph()
+    input_ph = mgt.shared_placeholders(batch, name="input")
+    model, output = mgt.build_forecast_model(input_ph, 3, 4, 3, shared_topology=True)
+    step = mgt.forecast_next_input(output, input_ph, store.normalizer, ntg, dtg)
+    nodes, edges, rolled = mgt.rollout(model, input_ph, nsteps, 3, store.normalizer,
+                                       ntg, dtg, unnormalize=False)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        r_nodes, r_edges, r_daytimes = sess.run([nodes, edges, rolled],
+                                                feed_dict=mgt.shared_feed_dict(input_ph, batch))
+        graph = batch
+        expected = list(daytimes)
+        for k in range(nsteps):
+            s_nodes, s_edges, nxt = sess.run([output.nodes, output.edges, step],
+                                             feed_dict=mgt.shared_feed_dict(input_ph, graph))
+            np.testing.assert_allclose(r_nodes[k], s_nodes, rtol=1e-9, atol=1e-9)
+            np.testing.assert_allclose(r_edges[k], s_edges, rtol=1e-9, atol=1e-9)
+            expected = [label_daytime(day, tg, ntg) for day, tg in expected]
+            np.testing.assert_array_equal(r_daytimes[k], np.array(expected, dtype=np.float64))
+            graph = graph.replace(nodes=nxt.nodes, edges=nxt.edges, globals=nxt.globals)
+    assert r_nodes.shape == (nsteps, len(daytimes), store.n_node[0], 4)
+    assert tuple(r_daytimes[-1][1]) == (0, 2)
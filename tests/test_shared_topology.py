@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("graph_nets")
+from graph_nets import utils_np, utils_tf
+
+import my_graph_tools as mgt
+from snapstore import SnapshotStore
+
+
+DAYTIMES = [(0, 0), (2, 13), (6, 23)]
+
+
+def test_shared_matches_concat(week, tmp_path):
+    # Default mode on utils_tf.concat of B snapshots, then the shared-topology
+    # model restored from its checkpoint on the same B as one batch
+    store = SnapshotStore(week["nn_inputs"])
+    ckpt = str(tmp_path / "model.ckpt")
+
+    tf.reset_default_graph()
+    input_ph = utils_tf.placeholders_from_data_dicts(
+        [store.data_dict(0, 0)], force_dynamic_num_graphs=True, name="input")
+    _, output = mgt.build_forecast_model(input_ph, 3, 4, 3)
+    graphs = utils_np.data_dicts_to_graphs_tuple([store.data_dict(*dt) for dt in DAYTIMES])
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        nodes, edges = sess.run([output.nodes, output.edges],
+                                feed_dict=utils_tf.get_feed_dict(input_ph, graphs))
+        tf.train.Saver().save(sess, ckpt)
+
+    tf.reset_default_graph()
+    batch = store.shared_batch(DAYTIMES)
+    shared_ph = mgt.shared_placeholders(batch, name="input")
+    _, shared_out = mgt.build_forecast_model(shared_ph, 3, 4, 3, shared_topology=True)
+    with tf.Session() as sess:
+        # Every variable restores by name, so the two modes share checkpoints
+        tf.train.Saver().restore(sess, ckpt)
+        s_nodes, s_edges = sess.run([shared_out.nodes, shared_out.edges],
+                                    feed_dict=mgt.shared_feed_dict(shared_ph, batch))
+
+    B = len(DAYTIMES)
+    np.testing.assert_allclose(s_nodes, nodes.reshape(B, store.n_node[0], -1), rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(s_edges, edges.reshape(B, store.n_edge[0], -1), rtol=1e-9, atol=1e-9)
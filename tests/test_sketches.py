@@ -0,0 +1,42 @@
+import numpy as np
+import h5py
+
+import graphtools as gt
+import sketches
+import synth
+
+
+def test_add_on_strided_counts():
+    rng = np.random.RandomState(0)
+    cells, v = rng.randint(0, 7, 500), rng.uniform(0., 170., 500)
+    dense = sketches.SpeedHistogram(7)
+    dense.add(cells, v)
+    # Every other column of a wider array, and a column-major copy
+    wide = np.zeros((7, 2*dense.nbins), dtype=np.uint32)
+    for counts in (wide[:, ::2], np.zeros((7, dense.nbins), dtype=np.uint32, order='F')):
+        hist = sketches.SpeedHistogram(7, counts=counts)
+        hist.add(cells, v)
+        np.testing.assert_array_equal(counts, dense.counts)
+
+
+def test_week_percentiles_merge_every_snapshot(tmp_path):
+    rng = np.random.RandomState(3)
+    roads = synth.make_roads(5, rng=rng)
+    ids, x, y, t = synth.drive(roads, 200, 20, rng=rng)
+    vels = synth.velocities(ids, x, y, t, 60, 1.0, 0.0)
+    nodes, edges = synth.road_graph(roads)
+    fname = str(tmp_path/"nn_inputs.hdf5")
+    synth.write_nn_inputs(fname, nodes, edges, vels, 24, snapping="segment")
+
+    # One histogram of every matched speed in the week, filled at once
+    matcher = gt.SegmentMatcher(nodes, edges)
+    edge_ids, ts, _, headings = matcher.match(vels, maxdist=1.0)
+    node_hist = sketches.SpeedHistogram(len(nodes))
+    edge_hist = sketches.SpeedHistogram(2*len(edges))
+    n_pctl, e_pctl = gt.matched_snapshot_percentiles(matcher, edge_ids, ts, headings, vels,
+                                                     node_hist, edge_hist)
+    with h5py.File(fname, 'r') as h5f:
+        assert len(h5f["node_percentiles"]) == len(h5f["edge_percentiles"]) == 7*24
+        np.testing.assert_allclose(h5f["node_percentiles_week"][:], n_pctl, rtol=1e-6)
+        np.testing.assert_allclose(h5f["edge_percentiles_week"][:], e_pctl, rtol=1e-6)
+        assert h5f["edge_percentiles"][synth.snapstr(0, 0)].shape == (len(edges), 6)
@@ -0,0 +1,56 @@
+import os
+import h5py
+import numpy as np
+import pytest
+
+from snapstore import SnapshotStore, Normalizer, read_snap, read_snapdict
+
+
+@pytest.mark.parametrize("normalize", [True, False])
+def test_raw_file_groups(week, tmp_path, normalize):
+    with h5py.File(week["nn_inputs"], 'r') as h5f:
+        ntg = int(h5f.attrs["nTG"])
+        normalizer = Normalizer.from_h5(h5f)
+        snap = read_snapdict(h5f, 3, 5, ntg, normalize)
+        nodes = read_snap(h5f, "nn_node_features" if normalize else "node_features", 3, 5, ntg)
+        edges = read_snap(h5f, "nn_edge_features", 3, 5, ntg)
+        glbls = read_snap(h5f, "glbl_features", 3, 5, ntg)[0]
+    # normalize=False keeps the groups of files normalized in place: raw
+    # node_features and globals, normalized nn_edge_features
+    edges = normalizer.norm("edges", edges.astype(np.float64))
+    if normalize:
+        nodes = normalizer.norm("nodes", nodes.astype(np.float64))
+        glbls = normalizer.norm("globals", glbls.astype(np.float64))
+    assert snap["nodes"].shape == nodes.shape
+    np.testing.assert_allclose(snap["nodes"], nodes, rtol=1e-6)
+    np.testing.assert_allclose(snap["edges"], edges, rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(snap["globals"], glbls, rtol=1e-6)
+
+    # The stores, in memory and memmapped, read the same
+    for mmap_dir in (None, str(tmp_path)):
+        store = SnapshotStore(week["nn_inputs"], normalize=normalize, mmap_dir=mmap_dir)
+        data = store.data_dict(3, 5)
+        for key in ("nodes", "edges", "globals"):
+            np.testing.assert_array_equal(data[key], snap[key])
+
+
+def test_mmap_cache_follows_the_file(week, tmp_path):
+    # Two files of the same name and mtime in different directories
+    cache = str(tmp_path/"cache")
+    stores = []
+    for sub, scale in (("a", 1.), ("b", 2.)):
+        (tmp_path/sub).mkdir()
+        fname = str(tmp_path/sub/"nn_inputs.hdf5")
+        with h5py.File(week["nn_inputs"], 'r') as src, h5py.File(fname, 'w') as dst:
+            dst.attrs.update(src.attrs)
+            for name in ("senders", "receivers", "node_stats", "edge_stats", "glbl_stats"):
+                src.copy(name, dst)
+            src.copy("glbl_features", dst)
+            for name in ("nn_node_features", "nn_edge_features"):
+                grp = dst.create_group(name)
+                for key in src[name]:
+                    grp.create_dataset(key, data=scale*src[name][key][:])
+        os.utime(fname, ns=(10**18, 10**18))
+        stores.append(SnapshotStore(fname, mmap_dir=cache).nodes)
+    assert len(os.listdir(cache)) == 2
+    assert not np.array_equal(stores[0], stores[1])
@@ -0,0 +1,48 @@
+import shutil
+import h5py
+import numpy as np
+import pytest
+
+import velquery
+
+
+@pytest.fixture(scope="module")
+def indexed(week, tmp_path_factory):
+    fname = str(tmp_path_factory.mktemp("velquery")/"vels.hdf5")
+    shutil.copy(week["veldat"], fname)
+    velquery.build_index(fname, cell_km=0.5, chunk_rows=1000)
+    with h5py.File(fname, 'r') as f5:
+        veldat = f5["veldat"][:]
+    return fname, veldat
+
+
+def rowsort(rows):
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+@pytest.mark.parametrize("days, tgs, frac", [
+    ([0], (5, 9), (0.2, 0.7, 0.1, 0.6)),
+    ([1, 4, 6], (0, 24), (0., 0.5, 0.5, 1.)),
+    (range(7), None, (0.3, 0.31, 0.3, 0.9)),
+    ([2, 3], (23, 24), None),
+    ([5], (7, 7), (0., 1., 0., 1.)),
+])
+def test_query_matches_mask(indexed, days, tgs, frac):
+    fname, veldat = indexed
+    with velquery.VelQuery(fname) as q:
+        if frac:
+            x0, x1 = veldat[:,2].min(), veldat[:,2].max()
+            y0, y1 = veldat[:,3].min(), veldat[:,3].max()
+            bbox = (x0 + frac[0]*(x1-x0), x0 + frac[1]*(x1-x0),
+                    y0 + frac[2]*(y1-y0), y0 + frac[3]*(y1-y0))
+        else:
+            bbox = None
+        # gap=0 reads every range on its own, the default merges neighbours
+        for gap in (0, 4096):
+            got = q.query(bbox, days=days, tgs=tgs, gap=gap)
+            tg0, tg1 = tgs if tgs else (0, q.ntg)
+            mask = np.isin(veldat[:,0], list(days)) & (veldat[:,1] >= tg0) & (veldat[:,1] < tg1)
+            if bbox:
+                mask &= ((veldat[:,2] >= bbox[0]) & (veldat[:,2] <= bbox[1])
+                         & (veldat[:,3] >= bbox[2]) & (veldat[:,3] <= bbox[3]))
+            np.testing.assert_array_equal(rowsort(got), rowsort(veldat[mask]))
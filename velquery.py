@@ -0,0 +1,180 @@
+'''
+Spatio-temporal range queries over a veldat store (gen_vels.py output)
+
+build_index adds a "velindex" group to the store: a copy of veldat
+sorted by (snapshot, grid cell), with snapshot day*nTG + tg and cells
+cell_km on a side over x_km / y_km, plus the start row of every
+non-empty (snapshot, cell). The store is rewritten one day at a time,
+so building needs memory for one day of rows, not the whole file.
+
+A query for a bounding box over days and a tg range then reads only the
+cells it overlaps. Within a snapshot, the cells of one grid row that
+fall in the box are adjacent in the sorted copy, so each (snapshot,
+grid row) is one contiguous slice. Slices a few chunks apart are read
+together and the rows between them dropped, and rows in the edge cells
+are then cut to the box exactly.
+
+    python velquery.py [--cell-km 0.5] vels.hdf5
+
+The graphtools viewer draws query results in its inset with
+viewer.set_overlay(q, days, tgs).
+
+q = VelQuery("vels.hdf5")
+vels = q.query((xmin, xmax, ymin, ymax), days=[1], tgs=(48, 54))
+'''
+import sys, getopt
+import numpy as np
+import h5py
+
+
+def _grid_keys(rows, x0, y0, cell_km, nx, ny, ntg):
+    # (snapshot, cell) key of each [day, tg, x, y, ...] row
+    cx = np.clip(((rows[:,2] - x0)//cell_km).astype(np.int64), 0, nx-1)
+    cy = np.clip(((rows[:,3] - y0)//cell_km).astype(np.int64), 0, ny-1)
+    snap = rows[:,0].astype(np.int64)*ntg + rows[:,1].astype(np.int64)
+    return snap*(nx*ny) + cy*nx + cx
+
+
+def build_index(fname, cell_km=0.5, chunk_rows=2**20, name="velindex"):
+    with h5py.File(fname, 'a') as f5:
+        src = f5["veldat"]
+        nvel, ntg = int(f5.attrs["nvel"]), int(f5.attrs["nTG"])
+        x0, x1 = float(f5.attrs["xmin"]), float(f5.attrs["xmax"])
+        y0, y1 = float(f5.attrs["ymin"]), float(f5.attrs["ymax"])
+        nx = max(int(np.ceil((x1 - x0)/cell_km)), 1)
+        ny = max(int(np.ceil((y1 - y0)/cell_km)), 1)
+        if name in f5:
+            del f5[name]
+        grp = f5.create_group(name)
+        grp.attrs.update({"cell_km": cell_km, "x0": x0, "y0": y0, "nx": nx, "ny": ny,
+                          "nTG": ntg, "nvel": nvel})
+        dst = grp.create_dataset("rows", shape=(nvel, 7), dtype=src.dtype,
+                                 chunks=(min(16384, max(nvel, 1)), 7), compression="lzf")
+        keys, starts = [], []
+        nout = 0
+        for day in range(7):
+            parts = []
+            for lo in range(0, nvel, chunk_rows):
+                block = src[lo:min(lo+chunk_rows, nvel)]
+                parts.append(block[block[:,0] == day])
+            block = np.concatenate(parts) if parts else np.zeros((0, 7), dtype=src.dtype)
+            bkeys = _grid_keys(block, x0, y0, cell_km, nx, ny, ntg)
+            order = np.argsort(bkeys, kind="stable")
+            block, bkeys = block[order], bkeys[order]
+            dst[nout:nout+len(block)] = block
+            ukeys, first = np.unique(bkeys, return_index=True)
+            keys.append(ukeys)
+            starts.append(first + nout)
+            nout += len(block)
+        grp.create_dataset("keys", data=np.concatenate(keys))
+        grp.create_dataset("starts", data=np.concatenate(starts + [[nout]]))
+        if nout != nvel:
+            raise ValueError("veldat has days outside 0-6, "+str(nvel-nout)+" rows not indexed")
+    return nout
+
+
+class VelQuery(object):
+    '''
+    Queries on a store indexed by build_index; the key arrays are held in
+    memory and the sorted rows read through an hdf5 chunk cache of
+    cache_mb megabytes. Call close() when done, or use it in a with block
+    '''
+    def __init__(self, fname, cache_mb=64, name="velindex"):
+        self.f5 = h5py.File(fname, 'r', rdcc_nbytes=int(cache_mb*2**20), rdcc_nslots=10007)
+        if name not in self.f5:
+            self.f5.close()
+            raise ValueError(fname+" has no "+name+", run velquery.py on it first")
+        grp = self.f5[name]
+        self.rows = grp["rows"]
+        self.keys = grp["keys"][:]
+        self.starts = grp["starts"][:]
+        for attr in ("cell_km", "x0", "y0"):
+            setattr(self, attr, float(grp.attrs[attr]))
+        self.nx, self.ny, self.ntg = int(grp.attrs["nx"]), int(grp.attrs["ny"]), int(grp.attrs["nTG"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f5.close()
+
+    def cells(self, bbox):
+        # Cell column and row ranges [cx0, cx1], [cy0, cy1] overlapping bbox
+        xmin, xmax, ymin, ymax = bbox
+        cx = np.clip((np.array([xmin, xmax]) - self.x0)//self.cell_km, 0, self.nx-1).astype(np.int64)
+        cy = np.clip((np.array([ymin, ymax]) - self.y0)//self.cell_km, 0, self.ny-1).astype(np.int64)
+        return cx, cy
+
+    def ranges(self, bbox=None, days=range(7), tgs=None):
+        # Merged [start, stop) row ranges of the sorted copy that cover the query
+        cx, cy = self.cells(bbox) if bbox else (np.array([0, self.nx-1]), np.array([0, self.ny-1]))
+        tg0, tg1 = tgs if tgs else (0, self.ntg)
+        days = np.asarray(days, dtype=np.int64)
+        # Snapshots are day*nTG + tg, so out of range values would read a neighbouring day
+        if not 0 <= tg0 <= tg1 <= self.ntg:
+            raise ValueError("tgs must satisfy 0 <= tg0 <= tg1 <= "+str(self.ntg)+", got "+str(tgs))
+        if np.any((days < 0) | (days > 6)):
+            raise ValueError("days must be in 0-6, got "+str(days))
+        snaps = (days[:,None]*self.ntg
+                 + np.arange(tg0, tg1)[None,:]).ravel()
+        rowkeys = (snaps[:,None]*(self.nx*self.ny) + np.arange(cy[0], cy[1]+1)[None,:]*self.nx).ravel()
+        # First and one past the last non-empty key of each (snapshot, grid row) run
+        lo = np.searchsorted(self.keys, rowkeys + cx[0])
+        hi = np.searchsorted(self.keys, rowkeys + cx[1], side="right")
+        keep = hi > lo
+        start, stop = self.starts[lo[keep]], self.starts[hi[keep]]
+        if not len(start):
+            return start, stop
+        order = np.argsort(start)
+        start, stop = start[order], stop[order]
+        # Ranges that touch are read together
+        new = np.r_[True, start[1:] > stop[:-1]]
+        return start[new], np.maximum.reduceat(stop, np.flatnonzero(new))
+
+    def query(self, bbox=None, days=range(7), tgs=None, gap=4096):
+        '''
+        Velocity rows [day, tg, x, y, vx, vy, v] with x, y (km) inside
+        bbox = (xmin, xmax, ymin, ymax), day in days and tg0 <= tg < tg1
+        for tgs = (tg0, tg1), 0 <= tg0 <= tg1 <= nTG. bbox and tgs default
+        to everything
+        Ranges less than gap rows apart are read as one slice and the rows
+        between them dropped, since a read costs more than a few chunks
+        '''
+        start, stop = self.ranges(bbox, days, tgs)
+        if not len(start):
+            return np.zeros((0, 7), dtype=self.rows.dtype)
+        span = np.flatnonzero(np.r_[True, start[1:] - stop[:-1] > gap])
+        span_start, span_stop = start[span], np.r_[stop[span[1:]-1], stop[-1]]
+        buf = np.empty((int((span_stop - span_start).sum()), 7), dtype=self.rows.dtype)
+        n = 0
+        for a, b in zip(span_start, span_stop):
+            self.rows.read_direct(buf, np.s_[a:b], np.s_[n:n+b-a])
+            n += b - a
+        # Rows of buf wanted: each range, offset by where its span landed in buf
+        offset = np.repeat(np.cumsum(np.r_[0, span_stop - span_start][:-1]) - span_start,
+                           np.diff(np.r_[span, len(start)]))
+        lens = stop - start
+        first = np.repeat(start + offset - np.cumsum(np.r_[0, lens[:-1]]), lens)
+        out = buf[first + np.arange(lens.sum())]
+        if bbox:
+            xmin, xmax, ymin, ymax = bbox
+            out = out[(out[:,2] >= xmin) & (out[:,2] <= xmax) & (out[:,3] >= ymin) & (out[:,3] <= ymax)]
+        return out
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["cell-km="])
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(2)
+    if len(args) != 1:
+        print(__doc__)
+        sys.exit(2)
+    cell_km = float(dict(opts).get("--cell-km", 0.5))
+    n = build_index(args[0], cell_km)
+    print("Indexed", n, "velocities of", args[0], "on", cell_km, "km cells")